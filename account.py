@@ -1,32 +1,152 @@
 import numpy as np
 import pandas as pd
 
+from data.bar_cursor import BarCursor
+from data.dates import to_int
 from report import Report
 
 
+class HoldingsBook(object):
+    # 持仓簿，代码映射成整数编号，数量、最新价和持仓成本用平行数组记录
+    # 对外保留字典的读取方式，values()返回{'code','qty','price'}形式的持仓
+    def __init__(self, capacity=64):
+        self._ids = {}  # 代码到编号
+        self._codes = []  # 编号到代码
+        self.qty = np.zeros(capacity)
+        self.price = np.zeros(capacity)
+        self.cost = np.zeros(capacity)  # 持仓成本总额，清仓后保留余额
+        self._held = None  # 当前持仓编号的缓存，交易后重置
+        self.sell_win = 0  # 盈利卖出数
+        self.sell_lose = 0  # 亏损卖出数
+        self.sell_win_amount = 0  # 卖出盈利额
+        self.sell_lose_amount = 0  # 卖出亏损额
+
+    def code_id(self, code):
+        if code not in self._ids:
+            i = len(self._codes)
+            if i == len(self.qty):
+                # 容量不够时翻倍扩容
+                self.qty = np.concatenate([self.qty, np.zeros(i)])
+                self.price = np.concatenate([self.price, np.zeros(i)])
+                self.cost = np.concatenate([self.cost, np.zeros(i)])
+            self._ids[code] = i
+            self._codes.append(code)
+        return self._ids[code]
+
+    def held_ids(self):
+        if self._held is None:
+            self._held = np.flatnonzero(self.qty[:len(self._codes)] != 0)
+        return self._held
+
+    def codes(self, ids):
+        return [self._codes[i] for i in ids]
+
+    def __contains__(self, code):
+        i = self._ids.get(code)
+        return i is not None and self.qty[i] != 0
+
+    def __len__(self):
+        return len(self.held_ids())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, code):
+        if code not in self:
+            raise KeyError(code)
+        i = self._ids[code]
+        return {'code': code, 'qty': self.qty[i], 'price': self.price[i]}
+
+    def keys(self):
+        return self.codes(self.held_ids())
+
+    def values(self):
+        return [self[code] for code in self.keys()]
+
+    def items(self):
+        return [(code, self[code]) for code in self.keys()]
+
+    def holding_cost(self):
+        return dict(zip(self._codes, self.cost[:len(self._codes)]))
+
+    def value(self):
+        # 持仓市值
+        ids = self.held_ids()
+        return float(np.dot(self.qty[ids], self.price[ids]))
+
+    def mark(self, ids, prices):
+        # 一次更新多只持仓的价格，没有价格（停牌）的保持原价
+        prices = np.asarray(prices, dtype=np.float64)
+        self.price[ids] = np.where(np.isnan(prices), self.price[ids], prices)
+
+    def update_price(self, code, price):
+        if code in self:
+            self.price[self._ids[code]] = price
+
+    def trade(self, code, price, qty, cost):
+        # 记录成交，cost是含手续费的支出，qty为正就是买，为负就是卖
+        i = self.code_id(code)
+        if qty > 0:  # 买入时记录成本
+            self.cost[i] += cost
+        else:  # 卖出时判断盈亏，增加卖出笔数
+            avg_cost = self.cost[i] / self.qty[i]
+            balance = avg_cost * qty
+            gains = balance - cost  # 获利额度，注意cost和balance都应是负数
+            if gains > 0:
+                self.sell_win += 1
+                self.sell_win_amount += gains
+            else:
+                self.sell_lose += 1
+                self.sell_lose_amount += gains
+            # 卖出后成本加上保本卖出额
+            self.cost[i] += balance  # 注意，balance是负的，因为卖出时qty为负数
+
+        # 新开仓记录成交价
+        if self.qty[i] == 0:
+            self.price[i] = price
+        self.qty[i] += qty
+        self._held = None
+
+
 class Account(object):
+    _price_source = 'adj_daily'  # 盯市价格面板的数据来源
+
     def __init__(self, init_cash=1000000, data=None):
         # 初始化账户的基础状态
         self._cash = init_cash  # 账户的初始现金默认100万
-        self._holdings = {}  # 账户的持仓,用字典记录每个股票持仓
-        self._date = None  # 当前日期
+        self._holdings = HoldingsBook()  # 账户的持仓，持仓簿同时记录持仓成本和卖出盈亏
+        self._date = None  # 当前日期，整数日期
+        self._pos = -1  # 当前日期在交易日历上的位置
         self._amount = 0  # 当日交易额
         self._commision = 0  # 当日手续费
         self._records = []  # 账户的序列记录，用字典记录包括日期、净值
         self.data = data
-        self._holding_cost = {}  # 记录持仓成本总额
-        self._sell_win = 0  # 盈利卖出数
-        self._sell_lose = 0  # 亏损卖出数
-        self._sell_win_amount = 0  # 卖出盈利额
-        self._sell_lose_amount = 0  # 卖出亏损额
+        self._cursor = BarCursor(self._load_bars)  # 随交易日推进的行情游标
+        self._price_panel = None  # 盯市用的收盘价面板
+
+    @property
+    def _holding_cost(self):
+        return self._holdings.holding_cost()
+
+    @property
+    def _sell_win(self):
+        return self._holdings.sell_win
+
+    @property
+    def _sell_lose(self):
+        return self._holdings.sell_lose
+
+    @property
+    def _sell_win_amount(self):
+        return self._holdings.sell_win_amount
+
+    @property
+    def _sell_lose_amount(self):
+        return self._holdings.sell_lose_amount
 
     def holding_value(self):
         # 持仓市值
-        value = 0
-        if len(self._holdings) > 0:
-            values = [item['price'] * item['qty'] for item in self._holdings.values()]
-            value = sum(values)
-        return value
+        return self._holdings.value()
 
     def portfolio_value(self):
         # 整个组合的净值 = 现金+持仓市值
@@ -34,24 +154,44 @@ class Account(object):
 
     def update_price(self, code, price):
         # 更新持仓价格
-        if code in self._holdings:
-            item = self._holdings[code]
-            item['price'] = price
+        self._holdings.update_price(code, price)
+
+    def _price_row(self, codes):
+        # 从收盘价面板一次取出多个代码当天的价格，当天没有行情的为NaN
+        panel = self._price_panel
+        if panel is None or not all(panel.has(code) for code in codes):
+            panel = self.data.load_panel('close', codes, source=self._price_source)
+            self._price_panel = panel
+        # 面板和交易日历的日期一致，直接按位置取行
+        if self._pos < 0 or self._pos >= len(panel.dates) or panel.dates[self._pos] != self._date:
+            return np.full(len(codes), np.nan)
+        return panel.values[self._pos, panel.columns(codes)]
+
+    def _load_bars(self, code):
+        # 游标使用的完整行情
+        return self.data.get_daily_adj(code)
 
     def get_price(self, code):
         # 获取当前日期的价格
-        return self.data.get_price(code, self._date)
+        return self._cursor.price(code)
 
     def get_bars(self, code):
         # 获取当前日期的序列
-        return self.data.get_bars(code, self._date)
+        return self._cursor.frame(code)
+
+    def get_bar_view(self, code):
+        # 获取当前日期的行情视图，字段是numpy切片，如view.close[-n:]
+        return self._cursor.view(code)
 
     def update(self, date):
         # 更新账户的日期和当日的持仓价格
-        self._date = date
-        for code in self._holdings.keys():
-            price = self.get_price(code)  # 获取当前价格来更新
-            self.update_price(code, price)
+        self._date = to_int(date)
+        self._pos = self.data.get_calendar().position(self._date)
+        self._cursor.advance(self._date)
+        ids = self._holdings.held_ids()
+        if len(ids) > 0:
+            # 整个持仓簿一次盯市，停牌的沿用上一个价格
+            self._holdings.mark(ids, self._price_row(self._holdings.codes(ids)))
 
         # 初始化当日交易额和手续费
         self._amount = 0
@@ -110,42 +250,15 @@ class Account(object):
 
         hold_qty = 0
         if code in self._holdings:
-            item = self._holdings[code]
-            hold_qty = item['qty']
+            hold_qty = self._holdings[code]['qty']
 
         if hold_qty + qty < 0:
             raise Exception(f'{self._date}:持仓余额不足：{qty}')
 
         # 现金和持仓都足够，可以确认交易完成
-        # 根据持仓成本计算盈亏
-        if code not in self._holding_cost:
-            self._holding_cost[code] = 0
-
-        if qty > 0:  # 买入时记录成本
-            self._holding_cost[code] += cost
-        else:  # 卖出时判断盈亏，增加卖出笔数
-            avg_cost = self._holding_cost[code] / self._holdings[code]['qty']
-            balance = avg_cost * qty
-            gains = balance - cost  # 获利额度，注意cost和balance都应是负数
-            if gains > 0:
-                self._sell_win += 1
-                self._sell_win_amount += gains
-            else:
-                self._sell_lose += 1
-                self._sell_lose_amount += gains
-            # 卖出后成本加上保本卖出额
-            self._holding_cost[code] += balance  # 注意，balance是负的，因为卖出时qty为负数
-
-        # 处理现金和持仓变化
+        # 持仓簿根据持仓成本计算盈亏，并处理持仓变化
+        self._holdings.trade(code, price, qty, cost)
         self._cash -= cost
-        if code not in self._holdings:
-            self._holdings[code] = {'code': code, 'qty': qty, 'price': price}
-        else:
-            item = self._holdings[code]
-            item['qty'] += qty
-            # 如果持仓为0就删掉
-            if item['qty'] == 0:
-                del self._holdings[code]
 
         # 记录增加当日交易额和手续费
         self._amount += abs(order_value)
@@ -153,15 +266,10 @@ class Account(object):
 
 
 class IndexAccount(Account):
+    _price_source = 'index_daily'
+
     def __init__(self, init_cash=1000000, data=None):
         super().__init__(init_cash, data)
 
-    def get_price(self, code):
-        df = self.get_bars(code)
-        if len(df) == 0:
-            return None
-        return df['close'].values[-1]
-
-    def get_bars(self, code):
-        df = self.data.get_index_daily(index_code=code)
-        return df.loc[:self._date]
+    def _load_bars(self, code):
+        return self.data.get_index_daily(index_code=code)
@@ -2,9 +2,32 @@ from account import Account
 from data.cache_data import CacheData
 
 
+_datasource = None  # set_datasource设置后，所有回测和模型共用这个数据对象
+
+
+def set_datasource(name='tushare', **params):
+    '''
+    选择回测使用的数据源
+
+    :param name: tushare使用本地MongoDB和tushare接口；synthetic使用离线合成行情，参数传给data.synthetic.make_datasource
+    '''
+    global _datasource
+    if name == 'tushare':
+        _datasource = None
+    elif name == 'synthetic':
+        from data.synthetic import make_datasource
+        _datasource = make_datasource(**params)
+    else:
+        raise ValueError(f'unknown datasource {name}')
+    return get_datasource()
+
+
 def get_datasource():
+    if _datasource is not None:
+        return _datasource
     return CacheData()
 
+
 def prepare_account(strategy):
     # 如果策略没有配置账户，设置一个默认的回测账户
     if strategy.account is None:
@@ -13,26 +36,30 @@ def prepare_account(strategy):
     return strategy.account
 
 
-def backtest(strategy, start, end, benchmark='399300.SZ'):
+def backtest(strategy, start, end, benchmark='399300.SZ', save_cache=True, profiler=None):
     # 配置回测账户
     account = prepare_account(strategy)
 
-    # 通过数据对象获取交易日数据，轮询执行交易
-    dates = account.data.get_trade_dates(start, end)
-    for date in dates:
-        # 更新当天持仓信息
-        account.update(date)
-        # 策略产生当天的交易信号，并在内部执行
-        strategy.run(date)
-        # 交易日结束，记录净值
-        account.write_record()
-        # print(f'debug - {date} : 持仓{len(account._holdings)}只')
+    # 通过交易日历获取区间内的开市日，轮询执行交易
+    dates = account.data.get_calendar().range(start, end)
+    if profiler is not None:
+        # 传入profiler.Profiler时用带分阶段计时的循环
+        profiler.run(account, strategy, dates)
+    else:
+        for date in dates:
+            # 更新当天持仓信息
+            account.update(date)
+            # 策略产生当天的交易信号，并在内部执行
+            strategy.run(date)
+            # 交易日结束，记录净值
+            account.write_record()
+            # print(f'debug - {date} : 持仓{len(account._holdings)}只')
 
     # 回测结束，返回报告
     report = account.create_report(benchmark)
 
     # 将缓存写入文件
-    if type(account.data) is CacheData:
+    if save_cache and type(account.data) is CacheData:
         account.data.save_cache()
 
     return report
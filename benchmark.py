@@ -0,0 +1,298 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import backtest
+from data.dates import to_int
+
+try:
+    import resource
+except ImportError:  # windows没有resource模块，不统计内存峰值
+    resource = None
+
+STRATEGIES = ('BuyAndHold', 'MOM', 'RSRS_Strategy', 'FFStrategy', 'LowBeta', 'ResidualMomentum', 'FVStrategy')
+KERNELS = ('calc_rsrs', 'calc_ff_weights', 'get_factors', 'calc_fma', 'calc_atr', 'account_order', 'account_update',
+           'pickle_cache_save', 'pickle_cache_load', 'sharded_cache_save', 'sharded_cache_load')
+INDEX_CODE = '000300.SH'  # FF类策略使用的指数
+
+
+def _peak_rss():
+    # 进程的内存峰值字节数，linux的ru_maxrss单位是KB，mac是字节
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _periods(years, start='20150101'):
+    # 合成数据多生成一年作为指标的预热期，回测区间是后面的years年
+    start = pd.Timestamp(start)
+    bt_start = start + pd.DateOffset(years=1)
+    end = bt_start + pd.DateOffset(years=years) - pd.Timedelta(days=1)
+    return start.strftime('%Y%m%d'), bt_start.strftime('%Y%m%d'), end.strftime('%Y%m%d')
+
+
+def _universe(data, date, n_codes):
+    # 回测开始前已经上市的前n_codes只股票
+    stocks = data.get_stock_basic()
+    stocks = stocks[(stocks['list_date'] <= to_int(date)) & (stocks['list_status'] == 'L')]
+    return stocks.index[:n_codes].tolist()
+
+
+def _make_strategy(name, codes):
+    from strategy import strategy
+
+    if name == 'BuyAndHold':
+        return strategy.BuyAndHold(codes)
+    if name == 'MOM':
+        return strategy.MOM(codes)
+    if name == 'RSRS_Strategy':
+        return strategy.RSRS_Strategy(codes, index=False)
+    if name in ('FFStrategy', 'LowBeta', 'ResidualMomentum'):
+        return getattr(strategy, name)(INDEX_CODE)
+    if name == 'FVStrategy':
+        return strategy.FVStrategy()
+    raise ValueError(f'unknown strategy {name}')
+
+
+def _bench_strategy(case, data, start, end):
+    from account import Account
+
+    codes = _universe(data, start, case['n_codes'])
+    days = len(data.get_trade_dates(start, end))
+    walls = []
+    for i in range(case['repeat']):
+        # 第一次是冷缓存，之后复用数据对象里已经加载的缓存
+        strategy = _make_strategy(case['name'], codes)
+        strategy.account = Account(data=data)
+        t0 = time.perf_counter()
+        report = backtest.backtest(strategy, start, end, benchmark=INDEX_CODE, save_cache=False)
+        walls.append(time.perf_counter() - t0)
+    return {
+        'wall': walls[0],
+        'wall_warm': min(walls[1:]) if len(walls) > 1 else None,
+        'days': days,
+        'days_per_sec': days / walls[0],
+        'final_value': float(report._records['净值'].values[-1]),
+    }
+
+
+def _kernel(name, data, start, end, n_codes, tmp_dir):
+    # 返回(被测函数, 每次调用处理的数据量, 单位)
+    from account import Account
+    from data.pickle_cache import PickleCache, ShardedCache
+    from indicators import calc_atr, calc_fma
+    from models import ff_model, rsrs_model
+
+    codes = _universe(data, start, n_codes)
+    if name == 'calc_rsrs':
+        highs = data.get_panel('high', codes).values
+        lows = data.get_panel('low', codes).values
+        return lambda: rsrs_model._calc_rsrs(highs, lows, 18), highs.size, 'bars'
+    if name in ('calc_ff_weights', 'get_factors'):
+        model = ff_model.FF()
+        rets, factors, cols = model.get_factors(INDEX_CODE, 120, end)
+        if name == 'get_factors':
+            return lambda: model.get_factors(INDEX_CODE, 120, end), rets.size, 'returns'
+        cols = ['alpha'] + cols
+        return lambda: ff_model._calc_ff_weights(rets, factors, cols), rets.size, 'returns'
+    if name in ('calc_fma', 'calc_atr'):
+        klines = data.get_daily_adj(codes[0])
+        if name == 'calc_fma':
+            return lambda: calc_fma(klines['close'], 20), len(klines), 'bars'
+        return lambda: calc_atr(klines, 20), len(klines), 'bars'
+    if name == 'account_order':
+        account = Account(data=data)
+        account.update(data.get_trade_dates(start, end)[-1])
+        prices = [(code, account.get_price(code)) for code in codes]
+        prices = [(code, price) for code, price in prices if price is not None]
+
+        def orders():
+            for code, price in prices:
+                account.order(code, price, 100)
+            for code, price in prices:
+                account.order(code, price, -100)
+        return orders, 2 * len(prices), 'orders'
+    if name == 'account_update':
+        dates = data.get_trade_dates(start, end)
+        account = Account(init_cash=1e12, data=data)
+        account.update(dates[0])
+        for code in codes:
+            price = account.get_price(code)
+            if price is not None:
+                account.order(code, price, 100)
+
+        def updates():
+            for date in dates:
+                account.update(date)
+        return updates, len(dates), 'days'
+    if name.endswith('_cache_save') or name.endswith('_cache_load'):
+        frames = {code: data.get_daily_adj(code) for code in codes}
+        rows = sum(len(df) for df in frames.values())
+        if name.startswith('pickle'):
+            cache = PickleCache(os.path.join(tmp_dir, 'bench.pkl'))
+        else:
+            cache = ShardedCache(os.path.join(tmp_dir, 'bench.shards'))
+            cache.load()
+        for code, df in frames.items():
+            cache.set(code, df)
+        cache.save(force=True)
+        if name.endswith('_save'):
+            return lambda: cache.save(force=True), rows, 'rows'
+
+        def load():
+            cache.load(force=True)
+            # 分片缓存只加载索引，读出全部分片才和整体文件可比
+            if hasattr(cache, 'preload'):
+                cache.preload()
+        return load, rows, 'rows'
+    raise ValueError(f'unknown kernel {name}')
+
+
+def _bench_kernel(case, data, start, end):
+    with tempfile.TemporaryDirectory(prefix='bench_') as tmp_dir:
+        func, items, unit = _kernel(case['name'], data, start, end, case['n_codes'], tmp_dir)
+        func()  # 预热，填充缓存
+        times = []
+        for i in range(case['repeat']):
+            t0 = time.perf_counter()
+            for j in range(case['number']):
+                func()
+            times.append((time.perf_counter() - t0) / case['number'])
+    per_call = min(times)
+    return {'wall': sum(times) * case['number'], 'per_call': per_call, 'items': int(items), 'unit': unit,
+            'throughput': items / per_call}
+
+
+def _run_case(case):
+    # 在独立的子进程里运行，内存峰值和缓存互不影响
+    data_start, start, end = _periods(case['years'])
+    t0 = time.perf_counter()
+    data = backtest.set_datasource('synthetic', n_stocks=case['n_stocks'], start=data_start, end=end,
+                                   seed=case['seed'])
+    result = dict(case)
+    result['setup'] = time.perf_counter() - t0
+    result['setup_rss'] = _peak_rss()
+    try:
+        if case['kind'] == 'strategy':
+            result.update(_bench_strategy(case, data, start, end))
+        else:
+            result.update(_bench_kernel(case, data, start, end))
+        result['error'] = None
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['peak_rss'] = _peak_rss()
+    return result
+
+
+def run(cases=None, n_stocks=(50,), years=(1,), n_codes=50, seed=0, repeat=2, number=3, output=None,
+        quiet=True):
+    '''
+    运行基准测试，每个用例在新的子进程里用合成数据跑
+
+    :param cases: 用例名列表，策略名或内核名，默认全部
+    :param n_stocks: 合成市场的股票数量，可以给多个
+    :param years: 回测年数，可以给多个
+    :param n_codes: 按代码列表交易的策略和内核使用的股票数
+    :param repeat: 策略第一次冷缓存运行，其余热缓存运行；内核取repeat轮里最快的一轮
+    :param number: 内核每轮调用的次数
+    :param output: 结果追加写入的jsonl文件，一行一条，便于对比不同时间的结果
+    :param quiet: 不显示回测过程中的打印
+    :return: 结果表
+    '''
+    if cases is None:
+        cases = STRATEGIES + KERNELS
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context('spawn')
+
+    meta = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': _commit(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.machine()}
+    results = []
+    for n in n_stocks:
+        for y in years:
+            for name in cases:
+                case = {'kind': 'strategy' if name in STRATEGIES else 'kernel', 'name': name, 'n_stocks': n,
+                        'years': y, 'n_codes': min(n_codes, n), 'seed': seed, 'repeat': repeat, 'number': number}
+                with context.Pool(processes=1, initializer=_silence if quiet else None) as pool:
+                    result = pool.apply(_run_case, (case,))
+                result.update(meta)
+                results.append(result)
+                print(_format(result))
+                if output is not None:
+                    with open(output, mode='a', encoding='utf-8') as fp:
+                        fp.write(json.dumps(result, ensure_ascii=False) + '\n')
+    return pd.DataFrame(results)
+
+
+def _silence():
+    sys.stdout = open(os.devnull, 'w')
+
+
+def _format(result):
+    rss = result['peak_rss']
+    rss = f'{rss / 2 ** 20:.0f}MB' if rss is not None else '-'
+    head = f'{result["name"]:<20} stocks={result["n_stocks"]:<5} years={result["years"]:<2}'
+    if result['error'] is not None:
+        return f'{head} error: {result["error"]}'
+    if result['kind'] == 'strategy':
+        return f'{head} wall={result["wall"]:.2f}s {result["days_per_sec"]:.1f}days/s rss={rss}'
+    return f'{head} per_call={result["per_call"] * 1000:.3f}ms {result["throughput"]:.0f}{result["unit"]}/s rss={rss}'
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as fp:
+        return pd.DataFrame([json.loads(line) for line in fp if line.strip()])
+
+
+def compare(path, base_commit, new_commit=None):
+    '''
+    对比同一个结果文件里两次提交的结果，比值小于1表示变快
+
+    :param new_commit: 默认最新一次运行的提交
+    '''
+    df = load_results(path)
+    if new_commit is None:
+        new_commit = df['commit'].values[-1]
+    df['time'] = df['per_call'].where(df['kind'] == 'kernel', df['wall'])
+    keys = ['kind', 'name', 'n_stocks', 'years']
+    base = df[df['commit'] == base_commit].groupby(keys)[['time', 'peak_rss']].last()
+    new = df[df['commit'] == new_commit].groupby(keys)[['time', 'peak_rss']].last()
+    result = base.join(new, lsuffix='_base', rsuffix='_new', how='inner')
+    result['time_ratio'] = result['time_new'] / result['time_base']
+    result['rss_ratio'] = result['peak_rss_new'] / result['peak_rss_base']
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='backtest benchmarks on synthetic data')
+    parser.add_argument('cases', nargs='*', help=f'策略或内核名，默认全部: {" ".join(STRATEGIES + KERNELS)}')
+    parser.add_argument('--stocks', type=int, nargs='+', default=[50])
+    parser.add_argument('--years', type=int, nargs='+', default=[1])
+    parser.add_argument('--codes', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--number', type=int, default=3)
+    parser.add_argument('--output', default='benchmarks.jsonl')
+    args = parser.parse_args()
+
+    run(args.cases or None, n_stocks=args.stocks, years=args.years, n_codes=args.codes, seed=args.seed,
+        repeat=args.repeat, number=args.number, output=args.output)
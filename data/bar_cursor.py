@@ -0,0 +1,98 @@
+import numpy as np
+
+from data.dates import to_int
+
+
+class _Bars(object):
+    # 单个代码的完整行情，和游标在该代码上的当前位置
+    def __init__(self, frame):
+        self.frame = frame
+        self.dates = frame.index.values if frame is not None else np.array([])
+        self.arrays = {}  # 字段到numpy数组的缓存，按需取出
+        self.pos = -1  # 最后一根不晚于当前日期的K线位置，-1表示还没有行情
+        self.date = None  # 位置对应的游标日期
+
+    def array(self, field):
+        if field not in self.arrays:
+            self.arrays[field] = self.frame[field].values
+        return self.arrays[field]
+
+    def seek(self, date):
+        if self.date == date:
+            return self.pos
+
+        n = len(self.dates)
+        if self.date is not None and date < self.date:
+            # 日期回退时重新二分定位
+            self.pos = int(np.searchsorted(self.dates, date, side='right')) - 1
+        elif self.pos + 1 < n and self.dates[self.pos + 1] <= date:
+            # 逐日推进通常只前进一格，跨度大时再二分
+            self.pos += 1
+            if self.pos + 1 < n and self.dates[self.pos + 1] <= date:
+                self.pos = int(np.searchsorted(self.dates, date, side='right')) - 1
+        self.date = date
+        return self.pos
+
+
+class BarView(object):
+    # 某个代码截至当前交易日的行情视图，字段都是numpy数组的切片，不复制数据
+    def __init__(self, bars, pos):
+        self._bars = bars
+        self.pos = pos
+
+    def __len__(self):
+        return self.pos + 1
+
+    def __getitem__(self, field):
+        return self._bars.array(field)[:self.pos + 1]
+
+    def __getattr__(self, field):
+        if field.startswith('_'):
+            raise AttributeError(field)
+        return self[field]
+
+    @property
+    def dates(self):
+        return self._bars.dates[:self.pos + 1]
+
+    def last(self, field='close'):
+        if self.pos < 0:
+            return None
+        return self._bars.array(field)[self.pos]
+
+    def to_frame(self):
+        return self._bars.frame.iloc[:self.pos + 1]
+
+
+class BarCursor(object):
+    # 回测循环每天推进一次日期，各代码记住上次的位置，按位置切片代替按日期标签查找
+    def __init__(self, loader):
+        self._loader = loader  # 按代码获取完整行情的函数
+        self._date = None
+        self._bars = {}
+
+    def advance(self, date):
+        self._date = to_int(date)
+
+    def reset(self):
+        self._date = None
+        self._bars = {}
+
+    def _get(self, code):
+        if code not in self._bars:
+            self._bars[code] = _Bars(self._loader(code))
+        return self._bars[code]
+
+    def position(self, code):
+        return self._get(code).seek(self._date)
+
+    def view(self, code):
+        bars = self._get(code)
+        return BarView(bars, bars.seek(self._date))
+
+    def frame(self, code):
+        bars = self._get(code)
+        return bars.frame.iloc[:bars.seek(self._date) + 1]
+
+    def price(self, code, field='close'):
+        return self.view(code).last(field)
@@ -1,12 +1,65 @@
-from data.pickle_cache import PickleCache, CacheManager
+import pandas as pd
+
+from data.compact import DROP_COLUMNS, FIELD_DTYPES, compact
+from data.dates import DATE_COLUMNS, normalize, to_int
+from data.fins_store import FinsTable
+from data.index_members import IndexMembers
+from data.panel import Panel
+from data.pickle_cache import PickleCache, CacheManager, sizeof
+from data.trade_calendar import TradeCalendar
 from data.ts_db import TsDatabase
 
+# 面板字段默认的数据来源
+_PANEL_SOURCES = {
+    'open': 'adj_daily',
+    'high': 'adj_daily',
+    'low': 'adj_daily',
+    'close': 'adj_daily',
+    'vol': 'adj_daily',
+    'amount': 'adj_daily',
+    'adj_factor': 'adj_daily',
+    'total_mv': 'daily_basic',
+    'circ_mv': 'daily_basic',
+    'pb': 'daily_basic',
+    'pe': 'daily_basic',
+    'pe_ttm': 'daily_basic',
+    'ps': 'daily_basic',
+    'turnover_rate': 'daily_basic',
+    'volume_ratio': 'daily_basic',
+}
+# 写入前压缩字段类型的行情缓存
+_COMPACT_CACHES = ('daily', 'adj_factor', 'adj_daily', 'daily_basic', 'index_daily', 'index_dailybasic')
+
+
+def _adjust(daily, adj_factor):
+    # 用复权因子计算前复权行情
+    df = daily.copy()
+    df['adj_factor'] = adj_factor['adj_factor'] / adj_factor['adj_factor'].values[-1]
+    df['adj_factor'] = df['adj_factor'].fillna(method='ffill')
+    for col in ['open', 'close', 'high', 'low']:
+        df[col] = df[col] * df['adj_factor']
+    return df
 
-class CacheData(object):
-    _cache_manager = CacheManager(root_dir='d:/ts_data_caches')
 
-    def __init__(self):
-        self.database = TsDatabase()
+class CacheData(object):
+    _cache_manager = CacheManager(root_dir='d:/ts_data_caches', sharded=True)
+
+    def __init__(self, database=None, cache_manager=None, field_dtypes=None):
+        '''
+        :param database: 数据库对象，默认TsDatabase
+        :param cache_manager: 缓存管理器，默认所有实例共用一个
+        :param dict field_dtypes: 行情字段压缩后的类型，覆盖FIELD_DTYPES里的设置，为None的字段不压缩，已经缓存的表不再转换
+        '''
+        if database is None:
+            database = TsDatabase()
+        self.database = database
+        # 传入单独的缓存管理器时不和其他实例共用缓存
+        if cache_manager is not None:
+            self._cache_manager = cache_manager
+        self._calendar = None  # 交易日历，第一次使用时从trade_cal缓存建立
+        self.field_dtypes = dict(FIELD_DTYPES, **(field_dtypes or {}))
+        self._compaction = {}  # 每个缓存压缩的表数、压缩前后的字节数
+        self._members_checked = set()  # 已经和数据库对照过的指数成份
 
     def save_cache(self):
         self._cache_manager.save_all()
@@ -15,23 +68,74 @@ class CacheData(object):
         cache = self._cache_manager.get(key, init_load=True)  # type:PickleCache
         return cache
 
-    def get_trade_dates(self, start=None, end=None):
-        # 获取交易日
-        key = 'trade_cal'
+    def _prepare(self, key, df):
+        # 写入缓存前把日期转成整数，行情表再去掉重复的列、压缩字段类型
+        result = normalize(df)
+        if key in _COMPACT_CACHES:
+            result = compact(result, self.field_dtypes)
+            if result is not df:
+                stats = self._compaction.setdefault(key, [0, 0, 0])
+                stats[0] += 1
+                stats[1] += sizeof(df)
+                stats[2] += sizeof(result)
+        return result
+
+    def compaction_stats(self):
+        # 本次运行各缓存压缩前后的内存占用
+        df = pd.DataFrame(self._compaction, index=['frames', 'before', 'after']).T
+        df['saved'] = 1 - df['after'] / df['before']
+        return df
+
+    def _legacy(self, key, df):
+        # 旧版本写入的表：日期还是字符串，或者行情表还没有压缩。只看索引和列名，不检查数据
+        if df is None:
+            return False
+        if key in _COMPACT_CACHES and any(name in df.columns for name in DROP_COLUMNS):
+            return True
+        if df.index.name in DATE_COLUMNS:
+            return df.index.dtype.kind not in 'iu'
+        for name in DATE_COLUMNS:
+            if name in df.columns:
+                return df[name].dtype.kind not in 'iu'
+        return False
+
+    def _frame(self, key, code, load):
+        # 按代码缓存的表，写入缓存前统一日期并压缩
         cache = self.get_cache(key)
 
-        # 做缓存
-        if not cache.has(key):
-            df = self.database.get_trade_cal()
-            cache.set(key, df)
+        # 先get再看has，分片丢失或损坏时get会把key从索引去掉，当作没有缓存重新读取
+        df = cache.get(code)
+        if df is None and not cache.has(code):
+            df = self._prepare(key, load(code))
+            cache.set(code, df)
+        elif self._legacy(key, df):
+            # 旧版本写入的表，用到时转换后写回
+            df = self._prepare(key, df)
+            cache.set(code, df)
+        return df
+
+    def _peek(self, key, code, load):
+        # 只在计算时用一次的表，缓存里有就用缓存，没有时从数据库读取，不写入缓存
+        cache = self.get_cache(key)
+        df = cache.get(code)
+        if df is None and not cache.has(code):
+            return normalize(load(code))
+        if self._legacy(key, df):
+            df = self._prepare(key, df)
+            cache.set(code, df)
+        return df
 
-        result = cache.get(key)
+    def get_calendar(self):
+        # 只包含开市日的交易日历，账户、回测循环和模型共用
+        if self._calendar is None:
+            key = 'trade_cal'
+            df = self._frame(key, key, lambda _: self.database.get_trade_cal())
+            self._calendar = TradeCalendar(df['cal_date'].values[df['is_open'].astype(str).values == '1'])
+        return self._calendar
 
-        if start is not None:
-            result = result[result['cal_date'] >= start]
-        if end is not None:
-            result = result[result['cal_date'] <= end]
-        return result['cal_date'].values.tolist()
+    def get_trade_dates(self, start=None, end=None):
+        # 获取交易日，整数日期
+        return self.get_calendar().range(start, end).tolist()
 
     def get_price(self, code, date):
         # 获取某个交易日价格
@@ -43,21 +147,21 @@ class CacheData(object):
     def get_bars(self, code, date):
         # 获取某个交易日的前复权行情
         df = self.get_daily_adj(code)
-        return df.loc[:date]
+        return df.iloc[:df.index.searchsorted(to_int(date), side='right')]
 
     def get_fins(self, code, api_name, trade_date, limit_time=60 / 80):
         key = 'fins'
         cache = self.get_cache(key)
 
-        if not cache.has(code):
+        fins = cache.get(code)
+        if fins is None:
             fins = {}
             cache.set(code, fins)
 
-        fins = cache.get(code)
         if api_name not in fins:
             df = self.database.query_by_api(api_name, query={'ts_code': code}, limit_time=limit_time)
             if df is not None:
-                df = df.set_index('ann_date', drop=False).sort_index()
+                df = normalize(df.set_index('ann_date', drop=False).sort_index())
             fins[api_name] = df
             cache.set(code, fins)
 
@@ -65,98 +169,139 @@ class CacheData(object):
 
         if df is None:
             return None
+        if df.index.dtype.kind not in 'iu':
+            df = normalize(df).sort_index()
+            fins[api_name] = df
+            cache.set(code, fins)
 
-        return df[df['ann_date'] <= trade_date]
+        # 索引是排好序的公告日，已经公告的部分是前缀
+        return df.iloc[:df.index.searchsorted(to_int(trade_date), side='right')]
 
-    def get_daily(self, code):
-        # 获取个股行情
-        key = 'daily'
+    def get_fins_table(self, api_name):
+        # 全市场一种报表的时点表，整张表一次读出后按代码和公告日排序
+        key = 'fins_store'
         cache = self.get_cache(key)
 
-        if not cache.has(code):
-            df = self.database.get_daily(code)
-            cache.set(code, df)
+        table = cache.get(api_name)
+        if table is None and not cache.has(api_name):
+            df = self.database.query_by_api(api_name)
+            table = FinsTable(df) if df is not None else None
+            cache.set(api_name, table)
 
-        return cache.get(code)
+        return table
 
-    def get_adj_factor(self, code):
-        key = 'adj_factor'
-        cache = self.get_cache(key)
+    def get_daily(self, code):
+        # 获取个股行情
+        return self._frame('daily', code, self.database.get_daily)
 
-        if not cache.has(code):
-            df = self.database.get_adj_factor(code)
-            cache.set(code, df)
+    def get_adj_factor(self, code):
+        return self._frame('adj_factor', code, self.database.get_adj_factor)
 
-        return cache.get(code)
+    def _load_daily_adj(self, code):
+        # 原始行情和复权因子只用来计算前复权行情，不再各自保留一份缓存
+        daily = self._peek('daily', code, self.database.get_daily)
+        adj_factor = self._peek('adj_factor', code, self.database.get_adj_factor)
+        return _adjust(daily, adj_factor)
 
     def get_daily_adj(self, code):
-        key = 'adj_daily'
-        cache = self.get_cache(key)
-
-        if not cache.has(code):
-            df = self.get_daily(code).copy()
-            adj_factor = self.get_adj_factor(code)
-            df['adj_factor'] = adj_factor['adj_factor'] / adj_factor['adj_factor'].values[-1]
-            df['adj_factor'] = df['adj_factor'].fillna(method='ffill')
-            for col in ['open', 'close', 'high', 'low']:
-                df[col] = df[col] * df['adj_factor']
-            cache.set(code, df)
-
-        return cache.get(code)
+        return self._frame('adj_daily', code, self._load_daily_adj)
 
     def get_daily_basic(self, code):
-        key = 'daily_basic'
-        cache = self.get_cache(key)
-
-        if not cache.has(code):
-            df = self.database.get_daily_basic(code)
-            cache.set(code, df)
-
-        return cache.get(code)
+        return self._frame('daily_basic', code, self.database.get_daily_basic)
 
     def get_index_daily(self, index_code):
-        key = 'index_daily'
-        cache = self.get_cache(key)
-
-        if not cache.has(index_code):
-            df = self.database.get_index_daily(index_code)
-            cache.set(index_code, df)
-
-        return cache.get(index_code)
+        return self._frame('index_daily', index_code, self.database.get_index_daily)
 
     def get_index_dailybasic(self, index_code):
-        key = 'index_dailybasic'
+        return self._frame('index_dailybasic', index_code, self.database.get_index_dailybasic)
+
+    def get_index_members(self, index_code):
+        # 指数成份的区间表，全部历史只取一次，之后只检查数据库里有没有新的快照
+        key = 'index_members'
         cache = self.get_cache(key)
 
-        if not cache.has(index_code):
-            df = self.database.get_index_dailybasic(index_code)
-            cache.set(index_code, df)
+        members = cache.get(index_code)
+        rebuild = not cache.has(index_code) or (members is not None and members.dates.dtype.kind not in 'iu')
+        if not rebuild and index_code not in self._members_checked:
+            # 每个进程第一次使用时对照数据库，成份历史增量更新过就重新建立
+            latest = self.database.get_index_weight_latest(index_code)
+            rebuild = latest is not None and (members is None or to_int(latest) > members.dates[-1])
+        if rebuild:
+            # 旧版本的区间表是字符串日期，也重新建立
+            df = self.database.get_index_weight_history(index_code)
+            cache.set(index_code, IndexMembers(df, index_code) if df is not None else None)
+        self._members_checked.add(index_code)
 
         return cache.get(index_code)
 
     def get_index_weight(self, index_code, trade_date):
-        key = 'index_weight'
-        cache = self.get_cache(key)
-
-        if not cache.has(index_code):
-            cache.set(index_code, {})
-
-        index_weight = cache.get(index_code)
-
-        if trade_date not in index_weight:
-            index_weight[trade_date] = self.database.get_index_weight(index_code, trade_date)
+        # 某天的指数成份和权重，没有成份数据的指数返回None
+        members = self.get_index_members(index_code)
+        if members is None:
+            return None
+        return members.as_of(trade_date)
 
-        return index_weight[trade_date]
+    def preload(self, key, codes):
+        # 批量预热按代码缓存的行情，缺少的代码用一次查询取回，数据库里也没有的留给单个代码的接口去下载
+        cache = self.get_cache(key)
+        missing = [code for code in codes if not cache.has(code)]
+        if len(missing) <= 1:
+            return
+
+        if key == 'adj_daily':
+            daily = self.database.get_many('daily', missing)
+            adj_factors = self.database.get_many('adj_factor', missing)
+            for code, df in daily.items():
+                if code in adj_factors:
+                    adj_daily = _adjust(normalize(df), normalize(adj_factors[code]))
+                    cache.set(code, self._prepare(key, adj_daily))
+            return
+
+        frames = self.database.get_many(key, missing)
+        for code, df in frames.items():
+            cache.set(code, self._prepare(key, df))
+
+    def load_panel(self, field, codes, source=None):
+        # 获取字段的面板对象，缺少的代码一次性补齐后写回缓存
+        if source is None:
+            source = _PANEL_SOURCES[field]
+        key = 'panel'
+        cache = self.get_cache(key)
+        panel_key = f'{source}.{field}'
+
+        dates = self.get_trade_dates()
+        panel = cache.get(panel_key)  # type:Panel
+        # 交易日历有变化时重建面板
+        if panel is None or len(panel.dates) != len(dates) or panel.dates[-1] != dates[-1]:
+            panel = Panel(dates)
+
+        missing = [code for code in codes if not panel.has(code)]
+        if len(missing) > 0:
+            self.preload(source, missing)
+            loader = {
+                'adj_daily': self.get_daily_adj,
+                'daily': self.get_daily,
+                'daily_basic': self.get_daily_basic,
+                'index_daily': self.get_index_daily,
+                'index_dailybasic': self.get_index_dailybasic,
+            }[source]
+            items = {}
+            for code in missing:
+                df = loader(code)
+                items[code] = df[field] if df is not None and field in df.columns else None
+            panel.add(items)
+            cache.set(panel_key, panel)
+
+        return panel
+
+    def get_panel(self, field, codes, start=None, end=None, source=None):
+        # 获取按交易日对齐的面板数据，行是日期，列是代码，缺失值为NaN
+        panel = self.load_panel(field, codes, source)
+        return panel.to_frame(codes, start, end)
 
     def get_stock_basic(self):
         key = 'stock_basic'
-        cache = self.get_cache(key)
-
-        if not cache.has(key):
-            df = self.database.get_stock_basic()
-            cache.set(key, df)
-
-        return cache.get(key)
+        return self._frame(key, key, lambda _: self.database.get_stock_basic())
 
 
 if __name__ == '__main__':
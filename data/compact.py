@@ -0,0 +1,61 @@
+'''
+按代码缓存的行情表在写入缓存前压缩
+
+接口返回的表每行都带着ts_code，按日期设索引时又保留了trade_date列，数值全是float64。
+缓存里代码就是key，日期在索引上，这两列直接去掉；价格和比率只有两三位有效小数，float32足够；
+股本、市值、成交量和成交额数值大，默认保留float64，需要时可以按字段改
+'''
+import numpy as np
+
+_PRICES = ('open', 'high', 'low', 'close', 'pre_close', 'change', 'pct_chg', 'adj_factor')
+_RATIOS = ('turnover_rate', 'turnover_rate_f', 'volume_ratio', 'pe', 'pe_ttm', 'pb', 'ps', 'ps_ttm', 'dv_ratio',
+           'dv_ttm')
+
+# 字段压缩后的类型，没有列出的或者为None的字段保持原样
+FIELD_DTYPES = {name: np.float32 for name in _PRICES + _RATIOS}
+DROP_COLUMNS = ('ts_code',)  # 按代码缓存时和key重复的列
+
+
+def compact(df, dtypes=None, drop=DROP_COLUMNS):
+    '''
+    压缩一张行情表，已经压缩过的表原样返回
+
+    - 去掉drop里的列和与索引重复的列
+    - dtypes里列出的字段转换类型
+    - 剩下的字符串列转成category，多个代码的表保留ts_code时只存一份代码
+
+    :param DataFrame df: 日期已经转成整数的表
+    :param dict dtypes: 字段到类型，默认FIELD_DTYPES
+    :param drop: 要去掉的列
+    :return: 压缩后的表，没有需要压缩的地方时返回原对象
+    '''
+    if df is None:
+        return None
+    if dtypes is None:
+        dtypes = FIELD_DTYPES
+
+    columns = [name for name in df.columns if name in drop or name == df.index.name]
+    converts = {name: dtype for name, dtype in dtypes.items()
+                if dtype is not None and name in df.columns and df[name].dtype != dtype}
+    categories = [name for name in df.columns if df[name].dtype == object and name not in columns]
+    if len(columns) == 0 and len(converts) == 0 and len(categories) == 0:
+        return df
+
+    df = df.drop(columns=columns)
+    if len(converts) > 0:
+        df = df.astype(converts)
+    for name in categories:
+        df[name] = df[name].astype('category')
+    return df
+
+
+if __name__ == '__main__':
+    import backtest
+
+    # 全部代码的行情读进缓存后，各缓存压缩前后的内存
+    data = backtest.set_datasource('synthetic', n_stocks=500, start='20150101', end='20191231')
+    codes = data.get_stock_basic().index.tolist()
+    data.preload('adj_daily', codes)
+    data.preload('daily_basic', codes)
+    data.get_index_daily('000300.SH')
+    print(data.compaction_stats())
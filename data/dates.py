@@ -0,0 +1,63 @@
+'''
+数据层统一使用整数日期，20180615表示2018年6月15日
+
+接口和数据库里是'YYYYMMDD'字符串，写入缓存前转成int32，之后的切片、二分查找和掩码都是整数比较。
+对外的查询方法同时接受字符串和整数日期，进入数据层时用to_int转换
+'''
+import datetime
+
+import numpy as np
+import pandas as pd
+
+# 写入缓存前转换的日期字段
+DATE_COLUMNS = ('trade_date', 'cal_date', 'pretrade_date', 'ann_date', 'f_ann_date', 'end_date', 'list_date')
+MISSING = 99999999  # 缺失的日期比任何日期都晚，按时点查询时永远不可见
+
+
+def to_int(dates):
+    '''
+    日期转成整数
+
+    :param dates: 'YYYYMMDD'字符串、整数、datetime，或者它们的数组
+    :return: 单个日期返回int，数组返回int32数组，None原样返回
+    '''
+    if dates is None:
+        return None
+    if isinstance(dates, (str, np.str_, int, np.integer)):
+        return int(dates)
+    if isinstance(dates, (datetime.date, np.datetime64)):
+        return int(pd.Timestamp(dates).strftime('%Y%m%d'))
+
+    values = np.asarray(dates)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int32)
+    if values.dtype.kind == 'M':
+        index = pd.DatetimeIndex(values)
+        return (index.year * 10000 + index.month * 100 + index.day).values.astype(np.int32)
+    if values.dtype.kind == 'O':
+        missing = pd.isna(values)
+        if missing.any():
+            values = np.where(missing, str(MISSING), values)
+    return values.astype(str).astype(np.int32)
+
+
+def normalize(df):
+    '''
+    把表里的日期字段和日期索引转成int32，已经是整数的不再转换
+
+    :param DataFrame df: 接口或数据库读出的表
+    :return: 转换后的表，没有需要转换的字段时返回原对象
+    '''
+    if df is None:
+        return None
+    columns = [name for name in DATE_COLUMNS if name in df.columns and df[name].dtype.kind not in 'iu']
+    convert_index = df.index.name in DATE_COLUMNS and df.index.dtype.kind not in 'iu'
+    if len(columns) == 0 and not convert_index:
+        return df
+
+    df = df.copy()
+    for name in columns:
+        df[name] = to_int(df[name].values)
+    if convert_index:
+        df.index = pd.Index(to_int(df.index.values), name=df.index.name)
+    return df
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# tushare各接口每分钟的调用上限
+API_LIMITS = {
+    'daily': 200,
+    'adj_factor': 200,
+    'daily_basic': 200,
+    'index_daily': 200,
+    'index_dailybasic': 200,
+    'income': 80,
+    'cashflow': 80,
+    'balancesheet': 80,
+    'fina_indicator': 80,
+    'dividend': 80,
+}
+DEFAULT_LIMIT = 80
+
+
+class TokenBucket(object):
+    # 令牌桶限速，rate_per_min是每分钟的调用数，capacity是允许的突发数
+    def __init__(self, rate_per_min, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate_per_min / 60
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # 先预定令牌，令牌不够时在锁外等待，多个线程按预定顺序依次放行
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            self._sleep(wait)
+
+
+class DownloadTask(object):
+    # 一次接口调用，where=(列名, '<'或'>', 值)用来去掉数据库里已经有的行
+    def __init__(self, api_name, params, where=None):
+        self.api_name = api_name
+        self.params = params
+        self.where = where
+
+    @property
+    def key(self):
+        return json.dumps([self.api_name, self.params, self.where], sort_keys=True)
+
+    def filter(self, df):
+        if self.where is None or len(df) == 0:
+            return df
+        column, op, value = self.where
+        if op == '<':
+            return df[df[column] < value]
+        return df[df[column] > value]
+
+    def __repr__(self):
+        return f'{self.api_name} {self.params}'
+
+
+class Downloader(object):
+    '''
+    并发下载调度，每个接口一个令牌桶限速，线程池让网络等待和数据库写入重叠
+
+    :param pro: 提供query(api_name, **params)的接口对象，tushare的pro_api或本地替身
+    :param writer: writer(task, df)把过滤后的数据写入数据库，返回写入数
+    :param str progress_path: 进度文件，每完成一个任务追加一行，中断或有失败时重跑会跳过已完成的任务；
+        全部任务成功后删除，下一次运行重新开始，增量任务的参数即使没变也会再执行
+    '''
+
+    def __init__(self, pro, writer, limits=None, workers=4, retries=3, backoff=1.0, progress_path=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.pro = pro
+        self.writer = writer
+        self.limits = dict(API_LIMITS)
+        if limits is not None:
+            self.limits.update(limits)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff  # 第n次重试前等待backoff * 2^n秒
+        self.progress_path = progress_path
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, api_name):
+        with self._lock:
+            if api_name not in self._buckets:
+                rate = self.limits.get(api_name, DEFAULT_LIMIT)
+                self._buckets[api_name] = TokenBucket(rate, clock=self._clock, sleep=self._sleep)
+            return self._buckets[api_name]
+
+    def load_progress(self):
+        if self.progress_path is None or not os.path.exists(self.progress_path):
+            return set()
+        with open(self.progress_path, encoding='utf-8') as fp:
+            return set(line.rstrip('\n') for line in fp if line.strip())
+
+    def clear_progress(self):
+        if self.progress_path is not None and os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+    def _mark_done(self, task):
+        if self.progress_path is None:
+            return
+        with self._lock:
+            with open(self.progress_path, mode='a', encoding='utf-8') as fp:
+                fp.write(task.key + '\n')
+
+    def fetch(self, task):
+        # 调用接口，失败时指数退避重试，每次尝试都要重新拿令牌
+        bucket = self._bucket(task.api_name)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            try:
+                return self.pro.query(api_name=task.api_name, **task.params)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print(f'下载失败，重试{attempt + 1}: {task} {e}')
+                self._sleep(self.backoff * 2 ** attempt)
+
+    def _run_task(self, task):
+        # 没有数据也交给writer，便于记录确认过的空缺
+        df = task.filter(self.fetch(task))
+        count = self.writer(task, df)
+        self._mark_done(task)
+        return count
+
+    def run(self, tasks):
+        # 执行任务列表，返回完成数、写入数和失败的任务
+        done = self.load_progress()
+        pending = [task for task in tasks if task.key not in done]
+        skipped = len(tasks) - len(pending)
+        if skipped > 0:
+            print(f'跳过已完成的{skipped}个任务')
+
+        result = {'done': 0, 'written': 0, 'failed': []}
+        if len(pending) == 0:
+            self.clear_progress()
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self._run_task, task): task for task in pending}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    result['written'] += future.result()
+                    result['done'] += 1
+                except Exception as e:
+                    result['failed'].append((task, f'{type(e).__name__}: {e}'))
+        print(f'完成{result["done"]}个任务，写入{result["written"]}行，失败{len(result["failed"])}个')
+        if len(result['failed']) == 0:
+            # 这一轮已经完整跑完，进度只用于续跑这一轮
+            self.clear_progress()
+        return result
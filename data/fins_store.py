@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+from data.dates import DATE_COLUMNS, to_int
+
+KEY_COLUMNS = ('ts_code', 'ann_date', 'end_date')
+# 接口用'1'、'0'这类字符串表示的类型和标志字段，内容是数字也不转换，where按字符串比较
+STRING_COLUMNS = ('report_type', 'comp_type', 'end_type', 'update_flag')
+_CODE_BASE = 10 ** 8  # 代码编号*_CODE_BASE+公告日组成有序的查找键
+
+
+class FinsTable(object):
+    '''
+    一种报表全市场的时点表，按(代码, 公告日, 报告期)排序的列数组
+
+    同一报告期多次披露（更正）时，查询日之前最后公告的那一版生效。
+    每个代码在某天已经公告的行是它区段的前缀，一次searchsorted就能得到全部代码的已知范围
+
+    :param DataFrame df: 报表数据，至少包含ts_code、ann_date、end_date，没有公告日的行无法按时点使用，直接丢弃
+    '''
+
+    def __init__(self, df):
+        df = df.dropna(subset=list(KEY_COLUMNS))
+        self.codes, code_ids = np.unique(df['ts_code'].values.astype(str), return_inverse=True)
+        ann = to_int(df['ann_date'].values).astype(np.int64)
+        end = to_int(df['end_date'].values)
+        order = np.lexsort((end, ann, code_ids))
+
+        self.code_ids = code_ids[order]
+        self.ann = ann[order]
+        self.end = end[order]
+        self.columns = {}
+        for name in df.columns:
+            if name in KEY_COLUMNS or name == '_id':
+                continue
+            values = df[name].values[order]
+            if name in DATE_COLUMNS:
+                values = to_int(values)
+            elif values.dtype == object and name not in STRING_COLUMNS:
+                # 数值列里的None转成NaN，其余保持原样
+                converted = pd.to_numeric(values, errors='coerce')
+                if np.isnan(converted).sum() == pd.isna(values).sum():
+                    values = converted.astype(np.float64)
+            self.columns[name] = values
+        self._keys = self.code_ids * _CODE_BASE + self.ann
+        self._starts = np.searchsorted(self.code_ids, np.arange(len(self.codes) + 1))  # 每个代码区段的起点
+        self._by_end = np.lexsort((self.ann, self.end, self.code_ids))  # 按(代码, 报告期, 公告日)的顺序
+
+    def __len__(self):
+        return len(self.ann)
+
+    def code_ids_of(self, codes):
+        # 代码到编号，表里没有的为-1
+        codes = np.asarray(codes, dtype=str)
+        pos = np.searchsorted(self.codes, codes)
+        pos = np.minimum(pos, len(self.codes) - 1)
+        return np.where(self.codes[pos] == codes, pos, -1) if len(self.codes) > 0 else np.full(len(codes), -1)
+
+    def known(self, codes, date):
+        # 每一行在date当天是否已经公告，codes之外的代码都为False
+        ids = self.code_ids_of(codes)
+        ids = ids[ids >= 0]
+        cut = self._starts[:-1].copy()  # 没有查询的代码已知范围为空
+        cut[ids] = np.searchsorted(self._keys, ids * _CODE_BASE + to_int(date), side='right')
+        return np.arange(len(self.ann)) < cut[self.code_ids]
+
+    def latest(self, codes, date, n=1, fields=None, period=None, where=None):
+        '''
+        date当天已知的每个代码最近n个报告期，同一报告期取最后公告的一版
+
+        :param codes: 代码列表
+        :param date: 查询日，公告日不晚于这一天的才算已知
+        :param n: 每个代码保留的报告期数
+        :param fields: 返回的字段，默认全部
+        :param period: 只看某种报告期，比如'1231'表示年报
+        :param dict where: 字段等于某个值的行，比如{'div_proc': '实施'}
+        :return: 长表，按代码和报告期升序，包含ts_code、ann_date、end_date和字段
+        '''
+        mask = self.known(codes, date)
+        if period is not None:
+            mask &= self.end % 10000 == int(period)
+        if where is not None:
+            for name, value in where.items():
+                mask &= self.columns[name] == value
+
+        rows = self._by_end[mask[self._by_end]]
+        ids = self.code_ids[rows]
+        end = self.end[rows]
+        # 同一代码同一报告期只保留最后公告的一行
+        last = np.append((ids[1:] != ids[:-1]) | (end[1:] != end[:-1]), True)
+        rows = rows[last]
+        ids = ids[last]
+        # 每个代码从最新的报告期往前数，保留n个
+        group_last = np.flatnonzero(np.append(ids[1:] != ids[:-1], True))
+        rank = group_last[np.searchsorted(group_last, np.arange(len(rows)))] - np.arange(len(rows))
+        rows = rows[rank < n]
+
+        result = {'ts_code': self.codes[self.code_ids[rows]], 'ann_date': self.ann[rows].astype(np.int32),
+                  'end_date': self.end[rows]}
+        for name in self.columns.keys() if fields is None else fields:
+            result[name] = self.columns[name][rows]
+        return pd.DataFrame(result)
+
+
+if __name__ == '__main__':
+    import backtest
+
+    # 和逐个代码按公告日筛选、同一报告期取最后公告的结果对照
+    data = backtest.set_datasource('synthetic', n_stocks=200, start='20150101', end='20191231')
+    table = data.get_fins_table('income')
+    codes = sorted(data.get_stock_basic().index)
+    date = '20180615'
+    result = table.latest(codes, date, n=5, fields=['revenue'], period='1231')
+    expected = []
+    for code in codes:
+        df = data.get_fins(code, 'income', date)
+        if df is None or len(df) == 0:
+            continue
+        df = df[df['end_date'] % 10000 == 1231].reset_index(drop=True)
+        df = df.sort_values(['end_date', 'ann_date'], kind='mergesort')
+        expected.append(df.groupby('end_date').tail(1).tail(5)[['ts_code', 'end_date', 'revenue']])
+    expected = pd.concat(expected).reset_index(drop=True)
+    print(len(result), len(expected), np.abs(result['revenue'].values - expected['revenue'].values).max())
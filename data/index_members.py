@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+from data.dates import to_int
+
+OPEN_END = 99991231  # 最后一期成份的结束日
+
+
+class IndexMembers(object):
+    '''
+    指数成份的区间表，每行是(代码, 起始日, 结束日, 权重)，成份在[起始日, 结束日)内有效
+
+    接口给的是月末快照，每期成份一直有效到下一期快照；相邻几期权重不变的合并成一个区间，
+    重复保存的同一份快照也会合并掉。某天的成份先二分查找当天生效的快照日，再取覆盖这一天的区间
+
+    :param DataFrame df: index_weight接口的数据，包含con_code、trade_date、weight
+    '''
+
+    def __init__(self, df, index_code=None):
+        self.index_code = index_code
+        trade_dates = to_int(df['trade_date'].values)
+        self.dates = np.unique(trade_dates)  # 快照日
+        codes = df['con_code'].values.astype(str)
+        snap = np.searchsorted(self.dates, trade_dates)
+        weight = df['weight'].values.astype(np.float64)
+        order = np.lexsort((snap, codes))
+        codes, snap, weight = codes[order], snap[order], weight[order]
+
+        # 代码变化、中间缺了一期或者权重变化的地方开始新区间
+        first = np.ones(len(codes), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | (snap[1:] != snap[:-1] + 1) | (weight[1:] != weight[:-1])
+        starts = np.flatnonzero(first)
+        ends = np.append(starts[1:], len(codes)) - 1
+        next_dates = np.append(self.dates[1:], OPEN_END)
+
+        self.codes = codes[starts]
+        self.start = self.dates[snap[starts]]
+        self.end = next_dates[snap[ends]]
+        self.weight = weight[starts]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def snapshot_date(self, date):
+        # date当天生效的快照日，之前没有快照时为None
+        i = np.searchsorted(self.dates, to_int(date), side='right') - 1
+        return self.dates[i] if i >= 0 else None
+
+    def as_of(self, date):
+        # date当天的成份和权重，格式和index_weight接口一致，trade_date是查询日
+        # 按权重从大到小排列，和接口返回的顺序一致
+        snap = self.snapshot_date(date)
+        if snap is None:
+            rows = np.array([], dtype=np.int64)
+        else:
+            rows = np.flatnonzero((self.start <= snap) & (self.end > snap))
+        rows = rows[np.argsort(-self.weight[rows], kind='stable')]
+        return pd.DataFrame({'index_code': self.index_code, 'con_code': self.codes[rows], 'trade_date': to_int(date),
+                             'weight': self.weight[rows]}, columns=['index_code', 'con_code', 'trade_date', 'weight'])
+
+    def _effective(self, dates):
+        # 每个日期生效的快照日，之前没有快照的为0
+        i = np.searchsorted(self.dates, to_int(dates), side='right') - 1
+        return np.where(i >= 0, self.dates[np.maximum(i, 0)], 0)
+
+    def codes_between(self, start, end):
+        # 区间内任何一天是成份的代码
+        eff = self._effective([start, end])
+        first = eff[0] if eff[0] != 0 else (self.dates[0] if len(self.dates) > 0 else OPEN_END)
+        mask = (self.start <= eff[1]) & (self.end > first)
+        return np.unique(self.codes[mask]).tolist()
+
+    def mask(self, dates, codes):
+        '''
+        日期×代码的成份矩阵，用区间的起止位置做差分再累加，不逐日比较
+
+        :return: 布尔数组，行是dates，列是codes
+        '''
+        eff = self._effective(dates)
+        columns = {code: i for i, code in enumerate(codes)}
+        col = np.array([columns.get(code, -1) for code in self.codes], dtype=np.int64)
+        keep = col >= 0
+        # 日期有序，生效快照日也有序，覆盖的行是[lo, hi)
+        lo = np.searchsorted(eff, self.start[keep], side='left')
+        hi = np.searchsorted(eff, self.end[keep], side='left')
+        diff = np.zeros((len(eff) + 1, len(codes)), dtype=np.int64)
+        np.add.at(diff, (lo, col[keep]), 1)
+        np.add.at(diff, (hi, col[keep]), -1)
+        return np.cumsum(diff, axis=0)[:-1] > 0
+
+
+if __name__ == '__main__':
+    import backtest
+
+    # 和按快照逐日取成份的结果对照
+    data = backtest.set_datasource('synthetic', n_stocks=400, start='20150101', end='20181231')
+    weights = data.database.db['index_weight'].select({'index_code': '000300.SH'}, {'_id': 0})
+    weights['trade_date'] = to_int(weights['trade_date'].values)
+    members = data.get_index_members('000300.SH')
+    print(f'{len(weights)}行快照，{len(members)}个区间')
+    dates = data.get_trade_dates('20150101', '20181231')
+    codes = sorted(weights['con_code'].unique())
+    mask = members.mask(dates, codes)
+    errors = 0
+    for i, date in enumerate(dates):
+        snap = weights[weights['trade_date'] <= date]
+        snap = snap[snap['trade_date'] == snap['trade_date'].max()] if len(snap) > 0 else snap
+        expected = set(snap['con_code'])
+        errors += expected != set(members.as_of(date)['con_code'])
+        errors += expected != set(np.asarray(codes)[mask[i]])
+    print('不一致的天数', errors)
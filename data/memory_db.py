@@ -0,0 +1,394 @@
+import numpy as np
+import pandas as pd
+
+
+class InsertManyResult(object):
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+
+class UpdateResult(object):
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class BulkWriteResult(object):
+    def __init__(self, matched_count, modified_count, upserted_count):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_count = upserted_count
+
+
+def _match_value(value, cond):
+    if isinstance(cond, dict):
+        for op, arg in cond.items():
+            if op == '$in':
+                if value not in arg:
+                    return False
+            elif op == '$nin':
+                if value in arg:
+                    return False
+            elif op == '$ne':
+                if value == arg:
+                    return False
+            elif value is None:
+                return False
+            elif op == '$gt' and not value > arg:
+                return False
+            elif op == '$gte' and not value >= arg:
+                return False
+            elif op == '$lt' and not value < arg:
+                return False
+            elif op == '$lte' and not value <= arg:
+                return False
+        return True
+    return value == cond
+
+
+def _match(doc, query):
+    return all(_match_value(doc.get(key), cond) for key, cond in query.items())
+
+
+def _frame_mask(columns, n, query, rows=None):
+    # 向量化的查询条件，columns是字段到数组的字典，rows给出时只判断这些行，返回行的布尔数组
+    if rows is not None:
+        n = len(rows)
+    mask = np.ones(n, dtype=bool)
+    for key, cond in query.items():
+        if key not in columns:
+            # 没有这个字段相当于值为None
+            if not _match_value(None, cond):
+                return np.zeros(n, dtype=bool)
+            continue
+        values = columns[key] if rows is None else columns[key][rows]
+        if not isinstance(cond, dict):
+            mask &= values == cond
+            continue
+        for op, arg in cond.items():
+            if op == '$in':
+                mask &= np.isin(values, list(arg))
+            elif op == '$nin':
+                mask &= ~np.isin(values, list(arg))
+            elif op == '$ne':
+                mask &= values != arg
+            elif op == '$gt':
+                mask &= values > arg
+            elif op == '$gte':
+                mask &= values >= arg
+            elif op == '$lt':
+                mask &= values < arg
+            elif op == '$lte':
+                mask &= values <= arg
+            else:
+                raise NotImplementedError(f'unsupported operator {op}')
+    return mask
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    include = [key for key, flag in projection.items() if flag and key != '_id']
+    if len(include) > 0:
+        result = {key: doc[key] for key in include if key in doc}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    return {key: value for key, value in doc.items() if projection.get(key, 1)}
+
+
+def _project_columns(columns, projection):
+    if not projection:
+        return list(columns)
+    include = [key for key, flag in projection.items() if flag and key != '_id']
+    if len(include) > 0:
+        if projection.get('_id', 1):
+            include.append('_id')
+        return [key for key in columns if key in include]
+    return [key for key in columns if projection.get(key, 1)]
+
+
+class Cursor(object):
+    # 模拟pymongo的游标，只支持遍历和batch_size
+    def __init__(self, docs):
+        self._docs = docs
+
+    def batch_size(self, n):
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+class _Block(object):
+    # 整表导入的列式数据，按ts_code建位置索引，被更新的行标记为失效后转成普通文档
+    def __init__(self, df, first_id):
+        if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+            df = df.reset_index(drop=True)
+        self.df = df  # 不复制，导入以后调用方不能再修改这个DataFrame
+        self.first_id = first_id  # 第i行的_id是first_id + i
+        self.columns = {key: df[key].values for key in df.columns}
+        self.alive = np.ones(len(self.df), dtype=bool)
+        self._keyed = {}  # 等值条件字段到哈希索引
+        self.by_code = {}
+        if 'ts_code' in self.df.columns:
+            self.by_code = {code: np.asarray(rows) for code, rows in self.df.groupby('ts_code').indices.items()}
+
+    def frame(self, rows, columns=None):
+        df = self.df.iloc[rows]
+        if columns is None:
+            columns = list(df.columns) + ['_id']
+        df = df[[key for key in columns if key != '_id']]
+        if '_id' in columns:
+            df = df.assign(_id=self.first_id + rows)
+        return df
+
+    def rows(self, query):
+        if '_id' in query:
+            query = dict(query)
+            cond = query.pop('_id')
+            ids = np.asarray(cond['$in'] if isinstance(cond, dict) else [cond], dtype=np.int64) - self.first_id
+            rows = ids[(ids >= 0) & (ids < len(self.df))]
+            rows = rows[self.alive[rows]]
+            return rows[_frame_mask(self.columns, len(self.df), query, rows)]
+        cond = query.get('ts_code')
+        if cond is None or (isinstance(cond, dict) and '$in' not in cond) or len(self.by_code) == 0:
+            if self.alive.all():
+                return np.flatnonzero(_frame_mask(self.columns, len(self.df), query))
+            rows = np.flatnonzero(self.alive)
+        else:
+            codes = cond['$in'] if isinstance(cond, dict) else [cond]
+            rows = [self.by_code[code] for code in codes if code in self.by_code]
+            rows = np.sort(np.concatenate(rows)) if len(rows) > 0 else np.array([], dtype=int)
+            rows = rows[self.alive[rows]]
+        return rows[_frame_mask(self.columns, len(self.df), query, rows)]
+
+    def lookup(self, query):
+        # 所有条件都是等值时，用按条件字段建的哈希索引找到第一行，找不到返回None
+        keys = tuple(sorted(query.keys()))
+        if keys not in self._keyed:
+            if any(key not in self.columns for key in keys):
+                return None
+            index = {}
+            columns = [self.columns[key] for key in keys]
+            for row in range(len(self.df) - 1, -1, -1):
+                index[tuple(values[row] for values in columns)] = row
+            self._keyed[keys] = index
+        row = self._keyed[keys].get(tuple(query[key] for key in keys))
+        if row is None or not self.alive[row]:
+            return None
+        return row
+
+    def same(self, row, values):
+        # 这一行是否已经和要写入的值一致
+        for key, value in values.items():
+            if key not in self.columns:
+                return False
+            old = self.columns[key][row]
+            if old != value and not (old != old and value != value):
+                return False
+        return True
+
+
+class MemoryCollection(object):
+    '''
+    进程内的文档集合，实现TsDatabase、TsUpdate和RepairPlanner用到的pymongo接口
+
+    普通写入的文档逐条保存，load_frame整表导入的数据按列保存，查询和聚合都向量化执行，
+    几千只股票的行情也能放在内存里
+    '''
+    _next_id = 1
+
+    def __init__(self, name):
+        self.name = name
+        self._docs = []
+        self._by_code = {}
+        self._blocks = []
+        self.indexes = []
+
+    def _candidates(self, query):
+        # ts_code条件可以直接走内存索引
+        cond = query.get('ts_code')
+        if cond is None:
+            return self._docs
+        if isinstance(cond, dict):
+            if '$in' not in cond:
+                return self._docs
+            codes = cond['$in']
+        else:
+            codes = [cond]
+        return [doc for code in codes for doc in self._by_code.get(code, [])]
+
+    def _add(self, doc):
+        doc = dict(doc)
+        if '_id' not in doc:
+            doc['_id'] = self._new_ids(1)
+        self._docs.append(doc)
+        self._by_code.setdefault(doc.get('ts_code'), []).append(doc)
+        return doc['_id']
+
+    @staticmethod
+    def _new_ids(n):
+        # 预留n个连续的_id，返回第一个
+        first = MemoryCollection._next_id
+        MemoryCollection._next_id += n
+        return first
+
+    def load_frame(self, df):
+        # 整表导入，不逐条生成文档
+        self._blocks.append(_Block(df, self._new_ids(len(df))))
+
+    def _block_frames(self, query, projection):
+        frames = []
+        for block in self._blocks:
+            rows = block.rows(query)
+            if len(rows) > 0:
+                frames.append(block.frame(rows, _project_columns(list(block.df.columns) + ['_id'], projection)))
+        return frames
+
+    def select(self, query=None, projection=None):
+        # 以DataFrame返回查询结果，聚合基于它
+        query = query or {}
+        frames = self._block_frames(query, projection)
+        docs = [_project(doc, projection) for doc in self._candidates(query) if _match(doc, query)]
+        if len(docs) > 0:
+            frames.append(pd.DataFrame(docs))
+        if len(frames) == 0:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True, sort=False) if len(frames) > 1 else frames[0]
+
+    def create_index(self, keys, **kwargs):
+        self.indexes.append(keys)
+
+    def find(self, query=None, projection=None, batch_size=None):
+        query = query or {}
+        docs = []
+        for df in self._block_frames(query, projection):
+            docs.extend(df.to_dict(orient='records'))
+        docs.extend(_project(doc, projection) for doc in self._candidates(query) if _match(doc, query))
+        return Cursor(docs)
+
+    def find_one(self, query=None, projection=None):
+        for doc in self.find(query, projection):
+            return doc
+        return None
+
+    def count_documents(self, query):
+        count = sum(len(block.rows(query)) for block in self._blocks)
+        return count + sum(1 for doc in self._candidates(query) if _match(doc, query))
+
+    def insert_many(self, records, ordered=True):
+        return InsertManyResult([self._add(doc) for doc in records])
+
+    def insert_one(self, doc):
+        return InsertManyResult([self._add(doc)])
+
+    def _take(self, filter, values):
+        # 找到第一个匹配的文档，如果在导入的表里并且要修改，转成普通文档，值没有变化时返回(None, True)
+        for doc in self._candidates(filter):
+            if _match(doc, filter):
+                return doc, True
+        equal = all(not isinstance(cond, dict) for cond in filter.values())
+        for block in self._blocks:
+            row = block.lookup(filter) if equal else None
+            if row is None:
+                rows = block.rows(filter)
+                if len(rows) == 0:
+                    continue
+                row = rows[0]
+            if block.same(row, values):
+                return None, True
+            block.alive[row] = False
+            self._add(block.frame(np.array([row])).to_dict(orient='records')[0])
+            return self._docs[-1], True
+        return None, False
+
+    def update_one(self, filter, update, upsert=False):
+        values = update['$set'] if '$set' in update else update
+        doc, matched = self._take(filter, values)
+        if matched and doc is None:
+            return UpdateResult(1, 0)
+        if doc is not None:
+            modified = any(doc.get(key) != value for key, value in values.items())
+            doc.update(values)
+            return UpdateResult(1, int(modified))
+        if upsert:
+            doc = dict(filter)
+            doc.update(values)
+            return UpdateResult(0, 0, self._add(doc))
+        return UpdateResult(0, 0)
+
+    def bulk_write(self, requests, ordered=True):
+        # 只支持UpdateOne
+        matched = modified = upserted = 0
+        for request in requests:
+            result = self.update_one(request._filter, request._doc, upsert=request._upsert)
+            matched += result.matched_count
+            modified += result.modified_count
+            upserted += result.upserted_id is not None
+        return BulkWriteResult(matched, modified, upserted)
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        # 支持$match和$group，$group只支持按单个字段分组
+        query = {}
+        df = None
+        for stage in pipeline:
+            if '$match' in stage:
+                if df is None:
+                    query.update(stage['$match'])
+                else:
+                    columns = {key: df[key].values for key in df.columns}
+                    df = df[_frame_mask(columns, len(df), stage['$match'])]
+            elif '$group' in stage:
+                if df is None:
+                    df = self.select(query)
+                df = _group(df, stage['$group'])
+            else:
+                raise NotImplementedError(f'unsupported stage {list(stage.keys())}')
+        if df is None:
+            df = self.select(query)
+        return Cursor(df.to_dict(orient='records'))
+
+
+def _group(df, spec):
+    key_field = spec['_id'].lstrip('$')
+    names = [name for name in spec.keys() if name != '_id']
+    if len(df) == 0 or key_field not in df.columns:
+        return pd.DataFrame(columns=['_id'] + names)
+
+    groups = df.groupby(key_field, sort=False)
+    result = pd.DataFrame({'_id': list(groups.groups.keys())})
+    for name in names:
+        op, arg = list(spec[name].items())[0]
+        if op == '$sum':
+            if isinstance(arg, str):
+                values = groups[arg.lstrip('$')].sum()
+            else:
+                values = groups.size() * arg
+        elif op == '$push':
+            values = groups[arg.lstrip('$')].agg(list)
+        elif op == '$min':
+            values = groups[arg.lstrip('$')].min()
+        elif op == '$max':
+            values = groups[arg.lstrip('$')].max()
+        elif op == '$first':
+            values = groups[arg.lstrip('$')].first()
+        else:
+            raise NotImplementedError(f'unsupported accumulator {op}')
+        result[name] = values.loc[result['_id']].values
+    return result
+
+
+class MemoryDatabase(object):
+    # 进程内的数据库，按名字取集合，不存在时自动创建，用来替代本地MongoDB做离线测试和性能测试
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name)
+        return self._collections[name]
+
+    def list_collection_names(self):
+        return list(self._collections.keys())
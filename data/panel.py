@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+from data.dates import to_int
+
+
+def compact_valid(values, valid=None):
+    # 把每列的有效值按时间顺序挤到前面，返回挤压后的数组和还原用的排列
+    values = np.asarray(values, dtype=np.float64)
+    if valid is None:
+        valid = ~np.isnan(values)
+    order = np.argsort(~valid, axis=0, kind='stable')
+    return np.take_along_axis(values, order, axis=0), order
+
+
+def expand_valid(compact, order, valid):
+    # compact_valid的逆操作，按日历还原，无效位置填NaN
+    result = np.full(compact.shape, np.nan)
+    np.put_along_axis(result, order, compact, axis=0)
+    result[~valid] = np.nan
+    return result
+
+
+def shift_valid(values, n):
+    # 对每列的有效值（非NaN）按自身序列平移n位
+    # 等价于逐个代码去掉缺失日期后shift，再对齐回日历，停牌日不会被当成一根K线
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    compact, order = compact_valid(values, valid)
+    shifted = np.full_like(compact, np.nan)
+    if 0 < n < len(compact):
+        shifted[n:] = compact[:-n]
+    elif -len(compact) < n < 0:
+        shifted[:n] = compact[-n:]
+    elif n == 0:
+        shifted = compact
+    return expand_valid(shifted, order, valid)
+
+
+class Panel(object):
+    # 按交易日历对齐的二维数组，行是日期，列是代码
+    def __init__(self, dates, dtype=np.float64):
+        self.dates = to_int(dates)
+        self.codes = []
+        self._columns = {}  # 代码到列号的映射
+        self.values = np.empty((len(self.dates), 0), dtype=dtype)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def has(self, code):
+        return code in self._columns
+
+    def add(self, items):
+        # items是代码到序列的字典，序列的索引是日期，一次性拼接成新的列块
+        codes = [code for code in items.keys() if code not in self._columns]
+        if len(codes) == 0:
+            return
+
+        n = len(self.dates)
+        block = np.full((n, len(codes)), np.nan, dtype=self.values.dtype)
+        for i, code in enumerate(codes):
+            series = items[code]
+            if series is None or len(series) == 0:
+                continue
+            index = np.asarray(series.index)
+            rows = np.searchsorted(self.dates, index)
+            # 只保留能在日历上找到的日期
+            valid = rows < n
+            valid[valid] = self.dates[rows[valid]] == index[valid]
+            block[rows[valid], i] = np.asarray(series.values, dtype=self.values.dtype)[valid]
+
+        self.values = np.hstack([self.values, block])
+        for code in codes:
+            self._columns[code] = len(self.codes)
+            self.codes.append(code)
+
+    def columns(self, codes):
+        return np.array([self._columns[code] for code in codes], dtype=np.int64)
+
+    def rows(self, start=None, end=None):
+        # 日期是有序的，二分查找得到行切片
+        i = 0 if start is None else np.searchsorted(self.dates, to_int(start), side='left')
+        j = len(self.dates) if end is None else np.searchsorted(self.dates, to_int(end), side='right')
+        return slice(i, j)
+
+    def get(self, codes=None, start=None, end=None):
+        rows = self.rows(start, end)
+        if codes is None:
+            return self.values[rows]
+        return self.values[rows][:, self.columns(codes)]
+
+    def to_frame(self, codes=None, start=None, end=None):
+        rows = self.rows(start, end)
+        if codes is None:
+            codes = self.codes
+        return pd.DataFrame(self.get(codes, start, end), index=self.dates[rows], columns=list(codes))
@@ -1,20 +1,72 @@
 import os
 import pickle
+import shutil
+import sys
+from collections import OrderedDict
+
+
+def sizeof(obj):
+    # 估算缓存对象占用的内存字节数
+    if hasattr(obj, 'memory_usage'):  # DataFrame/Series
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    if hasattr(obj, 'nbytes'):  # numpy数组
+        return int(obj.nbytes)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(sizeof(item) for item in obj)
+    if hasattr(obj, '__dict__'):  # 普通对象，比如面板
+        return sys.getsizeof(obj) + sizeof(vars(obj))
+    return sys.getsizeof(obj)
 
 
 class CacheManager(object):
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, sharded=False, max_bytes=None):
         # self._CHECK = False
         self.root_dir = root_dir
-        if not os.path.exists(self.root_dir) or not os.path.isdir(self.root_dir):
-            os.mkdir(self.root_dir)
+        self.sharded = sharded  # 是否按key分片存储
+        self.max_bytes = max_bytes  # 所有缓存常驻内存的上限，只对分片缓存生效
+        self._budgets = {}  # 每个缓存单独的内存上限
+        # 目录在第一次保存时才创建，只读取缓存时不需要
 
         self._caches = {}
 
+    def set_budget(self, cache_name, max_bytes):
+        # 设置单个缓存的内存上限，None表示不限制
+        self._budgets[cache_name] = max_bytes
+        if cache_name in self._caches and hasattr(self._caches[cache_name], 'max_bytes'):
+            self._caches[cache_name].max_bytes = max_bytes
+            self._caches[cache_name].evict()
+
+    def resident_sizes(self):
+        # 每个缓存当前常驻内存的字节数
+        return {key: item.resident_size() for key, item in self._caches.items()}
+
+    def _enforce(self, protect=None):
+        # 超过总上限时，从常驻最多的缓存开始按最近最少使用淘汰，降到上限的九成
+        if self.max_bytes is None:
+            return
+        caches = [item for item in self._caches.values() if isinstance(item, ShardedCache)]
+        total = sum(item.resident_size() for item in caches)
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        for item in sorted(caches, key=lambda c: c.resident_size(), reverse=True):
+            if total <= target:
+                break
+            before = item.resident_size()
+            item.evict(max(before - (total - target), 0), protect=protect)
+            total -= before - item.resident_size()
+
     def get(self, cache_name, init_load=True):
         if cache_name not in self._caches:
             path = os.path.join(self.root_dir, cache_name)
-            cache = PickleCache(path)
+            if self.sharded:
+                cache = ShardedCache(path + '.shards', legacy_file_path=path,
+                                     max_bytes=self._budgets.get(cache_name), on_grow=self._enforce)
+            else:
+                cache = PickleCache(path)
             if init_load:
                 cache.load()
             self._caches[cache_name] = cache
@@ -63,6 +115,9 @@ class PickleCache(object):
 
     def save(self, force=False):
         if self.changed or force:
+            cache_dir = os.path.dirname(self.cache_file_path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
             with open(self.cache_file_path, mode='wb') as fp:
                 pickle.dump(self.cache_dict, fp)
                 self.changed = False
@@ -114,3 +169,221 @@ class PickleCache(object):
 
     def has(self, key):
         return key in self.cache_dict
+
+    def resident_size(self):
+        # 整体文件无法单独重新加载某个key，只统计不淘汰
+        return sum(sizeof(item) for item in self.cache_dict.values())
+
+
+class ShardedCache(object):
+    # 按key分片的缓存，目录下一个小的索引文件，每个key单独一个分片文件
+    # load只读索引，key在第一次get时才加载；save只写有改动的key
+    # 设置max_bytes后按最近最少使用淘汰常驻的key，有改动的先写盘再淘汰
+    def __init__(self, cache_dir_path, legacy_file_path=None, max_bytes=None, on_grow=None):
+        self.cache_dict = OrderedDict()
+        self.cache_dir_path = cache_dir_path
+        self.index_file_path = os.path.join(cache_dir_path, 'index.pkl')
+        self.legacy_file_path = legacy_file_path  # 旧的整体pickle文件，存在时迁移过来
+        self._files = {}  # key到分片文件名的索引
+        self._next_id = 0
+        self._dirty = set()  # 有改动还没写盘的key
+        self._removed = []  # 清空后待删除的分片文件
+        self._loaded = False
+        self.changed = False  # 索引是否有改动
+        self.max_bytes = max_bytes
+        self._on_grow = on_grow  # 常驻内存增加后的回调，用于管理器检查总上限
+        self._sizes = {}  # 常驻key的字节数
+        self._items = {}  # 字典值每一项的(对象, 字节数)，再次set同一个字典时只计算新增或替换的项
+        self._resident = 0
+
+    def resident_size(self):
+        return self._resident
+
+    def _track(self, key):
+        # 记录key的大小并标记为最近使用，然后检查上限
+        self._resident -= self._sizes.get(key, 0)
+        self._sizes[key] = self._measure(key, self.cache_dict[key])
+        self._resident += self._sizes[key]
+        self.cache_dict.move_to_end(key)
+        self.evict(protect=(self, key))
+        if self._on_grow is not None:
+            self._on_grow(protect=(self, key))
+
+    def _measure(self, key, value):
+        # 字典值按项累计大小，和上次是同一个对象的项沿用上次的结果，避免每次set都遍历整个字典
+        # 原地修改了内容的项不会重新计算，这里只是估算
+        if not isinstance(value, dict):
+            self._items.pop(key, None)
+            return sizeof(value)
+        known = self._items.get(key, {})
+        items = {}
+        for name, item in value.items():
+            last = known.get(name)
+            items[name] = last if last is not None and last[0] is item else (item, sizeof(name) + sizeof(item))
+        self._items[key] = items
+        return sys.getsizeof(value) + sum(size for _, size in items.values())
+
+    def _untrack(self, key):
+        self._resident -= self._sizes.pop(key, 0)
+        self._items.pop(key, None)
+        del self.cache_dict[key]
+
+    def evict(self, target=None, protect=None):
+        # 淘汰最久没有使用的key，直到常驻内存不超过target，刚访问的key不淘汰
+        if target is None:
+            if self.max_bytes is None:
+                return
+            target = self.max_bytes
+        for key in list(self.cache_dict.keys()):
+            if self._resident <= target:
+                break
+            if protect == (self, key):
+                continue
+            if key in self._dirty:
+                self._write_shard(key)
+                self._dirty.discard(key)
+            self._untrack(key)
+
+    def _write_shard(self, key):
+        if not os.path.exists(self.cache_dir_path):
+            os.makedirs(self.cache_dir_path)
+        if key not in self._files:
+            self._files[key] = f'{self._next_id}.pkl'
+            self._next_id += 1
+            self.changed = True
+        # 先写临时文件再替换，中断时不会留下半个分片
+        path = self._shard_path(self._files[key])
+        with open(path + '.tmp', mode='wb') as fp:
+            pickle.dump(self.cache_dict[key], fp)
+        os.replace(path + '.tmp', path)
+
+    def _shard_path(self, file_name):
+        return os.path.join(self.cache_dir_path, file_name)
+
+    def save(self, force=False):
+        keys = set(self.cache_dict.keys()) if force else self._dirty
+        if len(keys) == 0 and not self.changed and len(self._removed) == 0:
+            return
+
+        if not os.path.exists(self.cache_dir_path):
+            os.makedirs(self.cache_dir_path)
+
+        for key in keys:
+            self._write_shard(key)
+
+        for file_name in self._removed:
+            if os.path.exists(self._shard_path(file_name)):
+                os.remove(self._shard_path(file_name))
+
+        if self.changed:
+            with open(self.index_file_path + '.tmp', mode='wb') as fp:
+                pickle.dump({'files': self._files, 'next_id': self._next_id}, fp)
+            os.replace(self.index_file_path + '.tmp', self.index_file_path)
+
+        print('cache saved.{} {} keys'.format(self.cache_dir_path, len(keys)))
+        self._dirty = set()
+        self._removed = []
+        self.changed = False
+
+    def clear_cache(self):
+        self._removed.extend(self._files.values())
+        self.cache_dict = OrderedDict()
+        self._sizes = {}
+        self._items = {}
+        self._resident = 0
+        self._files = {}
+        self._dirty = set()
+        self.changed = True
+
+    def delete_file(self):
+        shutil.rmtree(self.cache_dir_path)
+
+    def load(self, force=False):
+        if force:
+            print(f'强制加载{self.cache_dir_path}')
+        elif self._loaded:
+            return
+
+        # 只加载索引，分片等到get时再读
+        self.cache_dict = OrderedDict()
+        self._sizes = {}
+        self._items = {}
+        self._resident = 0
+        self._dirty = set()
+        self._loaded = True
+        try:
+            with open(self.index_file_path, mode='rb') as fp:
+                index = pickle.load(fp)
+                self._files = index['files']
+                self._next_id = index['next_id']
+                self.changed = False
+                print('cache index loaded.{} {} keys'.format(self.cache_dir_path, len(self._files)))
+        except FileNotFoundError:
+            self._files = {}
+            self._next_id = 0
+            self._migrate_legacy()
+        except:
+            self.clear_cache()
+            print('cache loading error. clear and re-build.')
+
+    def _migrate_legacy(self):
+        # 旧格式的整体文件一次性读入，全部标记为改动，下次保存时拆成分片
+        if self.legacy_file_path is None or not os.path.exists(self.legacy_file_path):
+            print('cache file not exists.save to get a new one.{}'.format(self.cache_dir_path))
+            return
+
+        with open(self.legacy_file_path, mode='rb') as fp:
+            self.cache_dict = OrderedDict(pickle.load(fp))
+        self._sizes = {key: self._measure(key, value) for key, value in self.cache_dict.items()}
+        self._resident = sum(self._sizes.values())
+        self._dirty = set(self.cache_dict.keys())
+        self.changed = True
+        print('cache migrated from {}'.format(self.legacy_file_path))
+
+    def preload(self, keys=None):
+        # 一次性把分片读进内存，比如在fork子进程之前
+        if keys is None:
+            keys = list(self._files.keys())
+        for key in keys:
+            self.get(key)
+
+    def keys(self):
+        return set(self.cache_dict.keys()) | set(self._files.keys())
+
+    def get(self, key):
+        if key in self.cache_dict:
+            self.cache_dict.move_to_end(key)
+            return self.cache_dict[key]
+
+        if key not in self._files:
+            return None
+
+        try:
+            with open(self._shard_path(self._files[key]), mode='rb') as fp:
+                self.cache_dict[key] = pickle.load(fp)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            # 分片丢失或损坏，从索引里去掉，当作没有缓存
+            print('cache shard missing. {} {}'.format(self.cache_dir_path, key))
+            del self._files[key]
+            self.changed = True
+            return None
+        value = self.cache_dict[key]
+        self._track(key)
+        return value
+
+    def get_default_cache(self, key, default_func, *args, **kwargs):
+        # 分片丢失或损坏时get返回None并从索引去掉key，这时has为False，重新计算
+        value = self.get(key)
+        if value is None and not self.has(key):
+            value = default_func(*args, **kwargs)
+            self.set(key, value)
+        return value
+
+    def set(self, key, data):
+        self.cache_dict[key] = data
+        self._dirty.add(key)
+        self._track(key)
+
+    def has(self, key):
+        # 只查索引不读分片，分片丢失或损坏要到get时才发现，调用方先get，返回None时再用has区分
+        return key in self.cache_dict or key in self._files
@@ -0,0 +1,167 @@
+import datetime
+from collections import Counter
+
+import numpy as np
+import pymongo
+
+from data.downloader import DownloadTask
+
+GAPS_COLL = 'repair_gaps'  # 已经确认接口没有数据的(代码, 日期)，比如停牌日，下次不再请求
+CROSS_SECTION_APIS = ('daily', 'adj_factor', 'daily_basic')  # 可以只传trade_date按横截面查询的股票接口
+
+
+class RepairTask(DownloadTask):
+    # 补数据任务，missing记录这次请求要补的(代码, 日期)
+    def __init__(self, api_name, params, missing):
+        super().__init__(api_name, params)
+        self.missing = missing
+
+
+class RepairPlanner(object):
+    '''
+    按交易日历找出每个代码缺少的交易日，只请求缺少的部分
+
+    股票接口多个代码缺同一天时（cross_threshold个以上）用trade_date横截面请求一次补齐，
+    其余按代码把缺口合并成不超过max_rows个交易日的区间请求。
+    请求过但接口没有返回的日期，早于最近gap_days个交易日的才记为空缺，最近几天可能只是还没有发布
+    '''
+
+    def __init__(self, database, cross_threshold=50, max_rows=4000, gap_days=5, today=None):
+        self.database = database
+        self.cross_threshold = cross_threshold
+        self.max_rows = max_rows  # 接口单次返回的最大行数
+        self.gap_days = gap_days
+        self.today = today  # 'YYYYMMDD'，默认当天
+        self._gap_before = None  # 早于这一天的空缺才记录
+
+    @property
+    def db(self):
+        return self.database.db
+
+    def open_dates(self):
+        cal = self.database.get_trade_cal()
+        cal = cal[cal['is_open'].astype(str) == '1']
+        return np.unique(cal['cal_date'].values.astype(str))
+
+    def last_open_date(self, cal=None):
+        # 不晚于今天的最后一个交易日，交易日历里有未来的日期
+        if cal is None:
+            cal = self.open_dates()
+        today = self.today or datetime.date.today().strftime('%Y%m%d')
+        cal = cal[cal <= today]
+        return cal[-1] if len(cal) > 0 else None
+
+    def gap_before(self):
+        # 最近gap_days个交易日之前的日期，没有返回的才确认为空缺
+        if self._gap_before is None:
+            cal = self.open_dates()
+            end = self.last_open_date(cal)
+            pos = np.searchsorted(cal, end) - self.gap_days + 1 if end is not None else 0
+            self._gap_before = cal[pos] if pos > 0 else ''
+        return self._gap_before
+
+    def stored_dates(self, api_name):
+        # 一次聚合取回每个代码已经存储的全部交易日
+        pipeline = [{'$group': {'_id': '$ts_code', 'dates': {'$push': '$trade_date'}}}]
+        records = self.db[api_name].aggregate(pipeline, allowDiskUse=True)
+        return {item['_id']: np.asarray(item['dates'], dtype=str) for item in records}
+
+    def known_gaps(self, api_name):
+        gaps = {}
+        for item in self.db[GAPS_COLL].find({'api_name': api_name}, {'_id': 0, 'ts_code': 1, 'trade_date': 1}):
+            gaps.setdefault(item['ts_code'], []).append(item['trade_date'])
+        return gaps
+
+    def listed_ranges(self):
+        # 股票的上市和退市日期，没有退市的退市日期为None
+        stocks = self.database.get_stock_basic()
+        if stocks is None:
+            return {}
+        delist = stocks['delist_date'] if 'delist_date' in stocks.columns else None
+        return {code: (stocks.at[code, 'list_date'], None if delist is None else delist[code])
+                for code in stocks.index}
+
+    def missing_dates(self, api_name, end_date=None, codes=None):
+        # 返回代码到缺少交易日的字典
+        cal = self.open_dates()
+        stored = self.stored_dates(api_name)
+        gaps = self.known_gaps(api_name)
+        if end_date is None:
+            # 检查到最近的交易日，数据库里最后一天之后新增的交易日也要补
+            end_date = self.last_open_date(cal)
+            if end_date is None:
+                return {}
+
+        # 股票按上市退市区间检查，指数等不在股票列表里的从已有最早日期开始检查
+        ranges = self.listed_ranges() if api_name in CROSS_SECTION_APIS else {}
+        for code, dates in stored.items():
+            if code not in ranges:
+                ranges[code] = (min(dates), None)
+
+        result = {}
+        for code, (start, end) in ranges.items():
+            if codes is not None and code not in codes:
+                continue
+            if start is None or start != start:
+                continue
+            if end is None or end != end or end > end_date:
+                expected = cal[(cal >= start) & (cal <= end_date)]
+            else:
+                expected = cal[(cal >= start) & (cal < end)]  # 退市日当天已经没有行情
+            have = np.concatenate([stored.get(code, np.array([], dtype=str)),
+                                   np.asarray(gaps.get(code, []), dtype=str)])
+            missing = np.setdiff1d(expected, have)
+            if len(missing) > 0:
+                result[code] = missing
+        return result
+
+    def plan(self, api_name, end_date=None, codes=None):
+        missing = self.missing_dates(api_name, end_date, codes)
+        cal = self.open_dates()
+        tasks = []
+
+        # 股票接口缺的代码足够多的日期，用横截面请求；指数接口必须传ts_code
+        cross_dates = []
+        if api_name in CROSS_SECTION_APIS:
+            counter = Counter(date for dates in missing.values() for date in dates)
+            cross_dates = sorted(date for date, n in counter.items() if n >= self.cross_threshold)
+        cross_missing = {date: [] for date in cross_dates}
+        for code, dates in missing.items():
+            for date in np.intersect1d(dates, cross_dates):
+                cross_missing[date].append((code, str(date)))
+        for date in cross_dates:
+            tasks.append(RepairTask(api_name, {'trade_date': str(date)}, cross_missing[date]))
+
+        # 剩下的按代码合并成区间请求
+        for code, dates in missing.items():
+            dates = np.setdiff1d(dates, cross_dates)
+            if len(dates) == 0:
+                continue
+            pos = np.searchsorted(cal, dates)
+            first = 0
+            for i in range(1, len(dates) + 1):
+                if i == len(dates) or pos[i] - pos[first] >= self.max_rows:
+                    params = {'ts_code': code, 'start_date': str(dates[first]), 'end_date': str(dates[i - 1])}
+                    tasks.append(RepairTask(api_name, params, [(code, str(date)) for date in dates[first:i]]))
+                    first = i
+        return tasks
+
+    def write(self, task, df):
+        # 补回的数据按(代码, 日期)upsert，请求过但接口没有返回的记为已确认空缺
+        # 最近几天的数据可能还没发布，返回行数到了上限的可能被截断，这两种情况不记录，下次重新请求
+        records = df.to_dict(orient='records')
+        count = 0
+        if len(records) > 0:
+            requests = [pymongo.UpdateOne({'ts_code': item['ts_code'], 'trade_date': item['trade_date']},
+                                          {'$set': item}, upsert=True) for item in records]
+            count = self.db[task.api_name].bulk_write(requests, ordered=False).upserted_count
+
+        if len(df) >= self.max_rows:
+            return count
+        returned = set(zip(df['ts_code'], df['trade_date'])) if len(df) > 0 else set()
+        before = self.gap_before()
+        gaps = [{'api_name': task.api_name, 'ts_code': code, 'trade_date': date}
+                for code, date in task.missing if (code, date) not in returned and date < before]
+        if len(gaps) > 0:
+            self.db[GAPS_COLL].insert_many(gaps, ordered=False)
+        return count
@@ -0,0 +1,469 @@
+import functools
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from data.cache_data import CacheData
+from data.memory_db import MemoryDatabase
+from data.pickle_cache import CacheManager
+from data.ts_db import TsDatabase
+
+INDUSTRIES = ['银行', '证券', '保险', '房地产', '建筑', '建材', '钢铁', '有色', '煤炭', '石油', '化工', '电力',
+              '汽车', '家电', '食品饮料', '医药', '电子', '计算机', '通信', '传媒', '机械', '军工', '农业', '交运']
+
+# 指数按月末总市值排名取成份，(起始名次, 结束名次)，None表示全部上交所股票
+INDEX_RANKS = {
+    '000001.SH': None,
+    '000016.SH': (0, 50),
+    '000300.SH': (0, 300),
+    '399300.SZ': (0, 300),
+    '000905.SH': (300, 800),
+}
+INDEX_BASE = {'000001.SH': 100.0, '000016.SH': 1000.0, '000300.SH': 1000.0, '399300.SZ': 1000.0,
+              '000905.SH': 1000.0}
+
+FINANCIAL_APIS = ('income', 'cashflow', 'balancesheet', 'fina_indicator', 'dividend')
+ROUTINE_APIS = ('daily', 'adj_factor', 'daily_basic', 'index_daily', 'index_dailybasic')
+ROW_LIMIT = 4000  # 行情类接口单次返回的最大行数，和tushare一致
+
+
+def _dates(values):
+    return pd.DatetimeIndex(values).strftime('%Y%m%d').values.astype(object)
+
+
+def _make_calendar(start, end, rng):
+    # 自然日历，周末和每年随机几天节假日休市
+    days = pd.date_range(start, end, freq='D')
+    is_open = (days.weekday < 5).astype(int)
+    weekdays = np.flatnonzero(is_open)
+    holidays = rng.choice(weekdays, size=min(len(weekdays), len(days) // 365 * 10 + 2), replace=False)
+    is_open[holidays] = 0
+    cal_date = _dates(days)
+    open_pos = np.flatnonzero(is_open)
+    prev = np.searchsorted(open_pos, np.arange(len(days))) - 1
+    pretrade = np.where(prev >= 0, cal_date[open_pos[np.maximum(prev, 0)]], None)
+    df = pd.DataFrame({'exchange': 'SSE', 'cal_date': cal_date, 'is_open': is_open, 'pretrade_date': pretrade})
+    return df, cal_date[open_pos]
+
+
+def _make_stocks(n_stocks, open_dates, start, rng):
+    n_sh = (n_stocks + 1) // 2
+    codes = np.array([f'{600000 + i}.SH' for i in range(n_sh)] +
+                     [f'{i + 1:06d}.SZ' for i in range(n_stocks - n_sh)], dtype=object)
+    T = len(open_dates)
+
+    # 七成在开始日期之前上市，其余在区间内上市，少数退市
+    first = np.where(rng.random(n_stocks) < 0.7, 0, rng.integers(0, max(T - 1, 1), n_stocks))
+    old_list = pd.Timestamp(start) - pd.to_timedelta(rng.integers(1, 3650, n_stocks), unit='D')
+    list_date = np.where(first == 0, _dates(old_list), open_dates[first])
+    delisted = (rng.random(n_stocks) < 0.03) & (first + 120 < T - 1)
+    last = np.where(delisted, rng.integers(np.minimum(first + 120, T - 2), T - 1), T - 1)
+    delist_date = np.where(delisted, open_dates[np.minimum(last + 1, T - 1)], None)
+
+    stocks = pd.DataFrame({
+        'ts_code': codes,
+        'symbol': [code[:6] for code in codes],
+        'name': [f'合成{i:04d}' for i in range(n_stocks)],
+        'area': rng.choice(['北京', '上海', '深圳', '浙江', '江苏', '广东'], n_stocks),
+        'industry': rng.choice(INDUSTRIES, n_stocks),
+        'market': '主板',
+        'exchange': ['SSE' if code.endswith('.SH') else 'SZSE' for code in codes],
+        'list_status': np.where(delisted, 'D', 'L'),
+        'list_date': list_date,
+        'delist_date': delist_date,
+    })
+    return stocks, first, last
+
+
+def _suspensions(listed, rng, p_start=0.002, p_end=0.2):
+    # 随机停牌区间，停牌天数服从几何分布
+    T, N = listed.shape
+    suspended = np.zeros((T, N), dtype=bool)
+    for t, i in zip(*np.nonzero(rng.random((T, N)) < p_start)):
+        suspended[t:t + rng.geometric(p_end), i] = True
+    return suspended & listed
+
+
+def _long(mask, open_dates, codes):
+    # T×N矩阵里有效的格子展开成长表的行列位置和键
+    t, i = np.nonzero(mask)
+    return t, i, {'ts_code': codes[i], 'trade_date': open_dates[t]}
+
+
+def _quarter_ends(start, end):
+    years = range(pd.Timestamp(start).year - 2, pd.Timestamp(end).year + 1)
+    return [f'{year}{md}' for year in years for md in ('0331', '0630', '0930', '1231')]
+
+
+def _make_financials(codes, open_dates, end, mv0, shares, rng):
+    # 按季度生成累计口径的三张报表、财务指标和分红，部分报告期会在之后重新披露
+    N = len(codes)
+    periods = _quarter_ends(open_dates[0], end)
+    lag = {'0331': (21, 30), '0630': (40, 60), '0930': (21, 30), '1231': (60, 110)}
+
+    turnover = rng.uniform(0.3, 1.5, N)
+    margin = rng.uniform(0.03, 0.3, N)
+    leverage = rng.uniform(1.5, 5.0, N)
+    payout = np.where(rng.random(N) < 0.7, rng.uniform(0.1, 0.5, N), 0.0)
+    book = mv0 * np.exp(rng.normal(np.log(0.5), 0.5, N))  # 元
+
+    rows = {name: [] for name in FINANCIAL_APIS}
+    ytd = {'revenue': np.zeros(N), 'n_income': np.zeros(N), 'ocf': np.zeros(N)}
+    for period in periods:
+        if period[4:] == '0331':
+            for value in ytd.values():
+                value[:] = 0
+        revenue = book * turnover / 4 * np.exp(rng.normal(0, 0.1, N))
+        n_income = revenue * margin + book * rng.normal(0, 0.01, N)
+        ytd['revenue'] += revenue
+        ytd['n_income'] += n_income
+        ytd['ocf'] += n_income * rng.uniform(0.5, 1.5, N)
+        book = np.maximum(book + n_income, book * 0.2)
+
+        low, high = lag[period[4:]]
+        ann = pd.Timestamp(period) + pd.to_timedelta(rng.integers(low, high, N), unit='D')
+        ann_date = _dates(ann)
+        keep = ann_date <= end
+        restate = rng.random(N) < 0.05
+        restate_date = _dates(ann + pd.to_timedelta(rng.integers(30, 200, N), unit='D'))
+
+        total_share = shares * 1e4  # 股
+        base = {
+            'income': {'revenue': ytd['revenue'], 'total_revenue': ytd['revenue'] * 1.01,
+                       'total_profit': ytd['n_income'] * 1.25, 'n_income': ytd['n_income'],
+                       'n_income_attr_p': ytd['n_income'] * 0.95, 'basic_eps': ytd['n_income'] / total_share},
+            'cashflow': {'n_cashflow_act': ytd['ocf'], 'free_cashflow': ytd['ocf'] - book * 0.02},
+            'balancesheet': {'total_share': total_share, 'total_hldr_eqy_exc_min_int': book,
+                             'total_assets': book * leverage, 'total_liab': book * (leverage - 1)},
+        }
+        for api_name, values in base.items():
+            frame = {'ts_code': codes, 'ann_date': ann_date, 'f_ann_date': ann_date, 'end_date': period,
+                     'report_type': '1', 'comp_type': '1', 'update_flag': np.where(restate, '0', '1')}
+            frame.update(values)
+            rows[api_name].append(pd.DataFrame(frame)[keep])
+            # 更正后的报告，数值略有变化
+            fixed = pd.DataFrame(frame)[keep & restate & (restate_date <= end)]
+            if len(fixed) > 0:
+                fixed['ann_date'] = restate_date[keep & restate & (restate_date <= end)]
+                fixed['f_ann_date'] = fixed['ann_date']
+                fixed['update_flag'] = '1'
+                for col in values.keys():
+                    if col != 'total_share':
+                        fixed[col] = fixed[col] * (1 + rng.normal(0, 0.02, len(fixed)))
+                rows[api_name].append(fixed)
+
+        rows['fina_indicator'].append(pd.DataFrame({
+            'ts_code': codes, 'ann_date': ann_date, 'end_date': period, 'eps': ytd['n_income'] / total_share,
+            'bps': book / total_share, 'roe': ytd['n_income'] / book * 100,
+            'netprofit_margin': ytd['n_income'] / ytd['revenue'] * 100,
+            'debt_to_assets': (1 - 1 / leverage) * 100})[keep])
+
+        # 年报披露时公布分红预案，之后实施
+        if period[4:] == '1231':
+            pay = keep & (ytd['n_income'] > 0) & (payout > 0)
+            cash_div = np.round(ytd['n_income'] * payout / total_share, 3)
+            impl = ann + pd.to_timedelta(rng.integers(40, 90, N), unit='D')
+            for proc, dates in (('预案', ann), ('实施', impl)):
+                dates = _dates(dates)
+                sel = pay & (dates <= end)
+                rows['dividend'].append(pd.DataFrame({
+                    'ts_code': codes, 'end_date': period, 'ann_date': dates, 'div_proc': proc,
+                    'stk_div': 0.0, 'cash_div': cash_div, 'cash_div_tax': cash_div,
+                    'record_date': np.where(proc == '实施', dates, None),
+                    'ex_date': np.where(proc == '实施', _dates(impl + pd.Timedelta(days=1)), None)})[sel])
+            book = book - np.where(pay, ytd['n_income'] * payout, 0)
+
+    tables = {}
+    for name, frames in rows.items():
+        df = pd.concat(frames, ignore_index=True)
+        tables[name] = df.sort_values(['ts_code', 'end_date', 'ann_date'], kind='mergesort').reset_index(drop=True)
+    return tables
+
+
+def _pit_matrix(table, field, codes, open_dates):
+    # 按公告日取每个交易日已经披露的最新值，T×N，没有披露过的为NaN
+    result = np.full((len(open_dates), len(codes)), np.nan)
+    pos = {code: i for i, code in enumerate(codes)}
+    dates = open_dates.astype(str)
+    df = table.sort_values(['ts_code', 'ann_date', 'end_date'], kind='mergesort')
+    for code, group in df.groupby('ts_code', sort=False):
+        idx = np.searchsorted(group['ann_date'].values.astype(str), dates, side='right') - 1
+        values = group[field].values
+        result[:, pos[code]] = np.where(idx >= 0, values[np.maximum(idx, 0)], np.nan)
+    return result
+
+
+def _ttm(income, field):
+    # 滚动四个季度的合计，单季值由累计值相减得到，每条公告都附上对应报告期的值
+    latest = income.drop_duplicates(['ts_code', 'end_date'], keep='last').sort_values(['ts_code', 'end_date'])
+    prev = latest.groupby('ts_code')[field].shift(1)
+    single = latest[field] - prev.where(latest['end_date'].str[4:] != '0331', 0)
+    ttm = single.groupby(latest['ts_code']).rolling(4).sum().reset_index(level=0, drop=True)
+    ttm.index = pd.MultiIndex.from_arrays([latest['ts_code'], latest['end_date']])
+    df = income[['ts_code', 'ann_date', 'end_date']].copy()
+    df['ttm'] = ttm.reindex(pd.MultiIndex.from_arrays([df['ts_code'], df['end_date']])).values
+    return df.dropna(subset=['ttm'])
+
+
+def make_market(n_stocks=300, start='20150101', end='20191231', seed=0):
+    '''
+    生成确定性的合成行情，字段和tushare对应接口一致
+
+    :param n_stocks: 股票数量
+    :param start: 开始日期
+    :param end: 结束日期
+    :param seed: 随机种子，参数相同时生成的数据完全一样
+    :return: 接口名到DataFrame的字典
+    '''
+    rng = np.random.default_rng(seed)
+    trade_cal, open_dates = _make_calendar(start, end, rng)
+    stocks, first, last = _make_stocks(n_stocks, open_dates, start, rng)
+    codes = stocks['ts_code'].values
+    T, N = len(open_dates), n_stocks
+
+    rows = np.arange(T)[:, None]
+    listed = (rows >= first) & (rows <= last)
+    suspended = _suspensions(listed, rng)
+    trading = listed & ~suspended
+
+    # 收益率=beta*市场+行业+个股
+    industry = pd.factorize(stocks['industry'])[0]
+    market = rng.normal(0.0003, 0.013, T)
+    sector = rng.normal(0, 0.008, (T, industry.max() + 1))
+    beta = rng.uniform(0.6, 1.4, N)
+    ret = market[:, None] * beta + sector[:, industry] + rng.normal(0, 1, (T, N)) * rng.uniform(0.01, 0.03, N)
+    ret = np.clip(ret, -0.095, 0.095)
+    total = np.exp(np.cumsum(np.log1p(ret), axis=0)) * np.exp(rng.normal(np.log(10), 0.6, N))
+
+    # 复权因子随机除权，不复权价格=全收益价格/复权因子
+    events = (rng.random((T, N)) < 1 / 250) & listed
+    adj = np.cumprod(np.where(events, 1 / (1 - rng.uniform(0.005, 0.03, (T, N))), 1.0), axis=0)
+    close = np.round(total / adj, 2)
+    pre_close = np.round(np.vstack([close[:1], close[:-1]]) * np.vstack([adj[:1], adj[:-1]]) / adj, 2)
+    open_ = np.round(pre_close * np.exp(rng.normal(0, 0.006, (T, N))), 2)
+    high = np.round(np.maximum(open_, close) * (1 + rng.uniform(0, 0.02, (T, N))), 2)
+    low = np.round(np.minimum(open_, close) * (1 - rng.uniform(0, 0.02, (T, N))), 2)
+
+    shares = np.round(np.exp(rng.normal(11, 1, N)), 2)  # 万股
+    float_share = np.round(shares * rng.uniform(0.4, 1.0, N), 2)
+    turnover = np.exp(rng.normal(np.log(1.5), 0.6, (T, N)))  # %
+    vol = np.round(turnover / 100 * float_share * 100, 2)  # 手
+    amount = np.round(vol * (open_ + close) / 2 / 10, 3)  # 千元
+
+    t, i, keys = _long(trading, open_dates, codes)
+    daily = pd.DataFrame(dict(keys, open=open_[t, i], high=high[t, i], low=low[t, i], close=close[t, i],
+                              pre_close=pre_close[t, i], change=np.round(close - pre_close, 2)[t, i],
+                              pct_chg=np.round((close / pre_close - 1) * 100, 4)[t, i], vol=vol[t, i],
+                              amount=amount[t, i]))
+    ta, ia, adj_keys = _long(listed, open_dates, codes)
+    adj_factor = pd.DataFrame(dict(adj_keys, adj_factor=np.round(adj[ta, ia], 4)))
+
+    # 估值指标按公告日使用已经披露的财务数据
+    mv0 = total[np.minimum(first, T - 1), np.arange(N)] * shares * 1e4
+    tables = _make_financials(codes, open_dates, end, mv0, shares, rng)
+    total_mv = close * shares  # 万元
+    book = _pit_matrix(tables['balancesheet'], 'total_hldr_eqy_exc_min_int', codes, open_dates)
+    income = tables['income']
+    ttm = _pit_matrix(_ttm(income, 'n_income'), 'ttm', codes, open_dates)
+    revenue = _pit_matrix(_ttm(income, 'revenue'), 'ttm', codes, open_dates)
+    annual = _pit_matrix(income[income['end_date'].str[4:] == '1231'], 'n_income', codes, open_dates)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pe = np.where(annual > 0, total_mv * 1e4 / annual, np.nan)
+        pe_ttm = np.where(ttm > 0, total_mv * 1e4 / ttm, np.nan)
+        pb = np.where(book > 0, total_mv * 1e4 / book, np.nan)
+        ps = np.where(revenue > 0, total_mv * 1e4 / revenue, np.nan)
+    daily_basic = pd.DataFrame(dict(keys, close=close[t, i],
+                                    turnover_rate=np.round(turnover[t, i], 4),
+                                    volume_ratio=np.round(np.exp(rng.normal(0, 0.3, len(t))), 2),
+                                    pe=np.round(pe[t, i], 4), pe_ttm=np.round(pe_ttm[t, i], 4),
+                                    pb=np.round(pb[t, i], 4), ps=np.round(ps[t, i], 4),
+                                    total_share=shares[i], float_share=float_share[i],
+                                    total_mv=np.round(total_mv[t, i], 4),
+                                    circ_mv=np.round((close * float_share)[t, i], 4)))
+
+    # 月末按总市值取指数成份，之后一个月按月末市值加权
+    month = pd.Series(open_dates.astype(str)).str[:6].values
+    month_ends = np.flatnonzero(np.append(month[1:] != month[:-1], True))
+    cap = np.where(trading, total_mv, np.nan)
+    is_sh = np.array([code.endswith('.SH') for code in codes])
+    weight_rows, index_rows, basic_rows = [], [], []
+    for index_code, ranks in INDEX_RANKS.items():
+        weights = np.zeros((T, N))
+        for k, pos in enumerate(month_ends):
+            mv = np.where(np.isnan(cap[pos]), -1, cap[pos])
+            if ranks is None:
+                members = np.flatnonzero(is_sh & (mv > 0))
+            else:
+                members = np.argsort(-mv, kind='mergesort')[ranks[0]:ranks[1]]
+                members = members[mv[members] > 0]
+            w = mv[members] / mv[members].sum()
+            weight_rows.append(pd.DataFrame({'index_code': index_code, 'con_code': codes[members],
+                                             'trade_date': open_dates[pos], 'weight': np.round(w * 100, 4)}))
+            until = month_ends[k + 1] + 1 if k + 1 < len(month_ends) else T
+            weights[pos + 1:until, members] = w
+            if k == 0:
+                weights[:pos + 1, members] = w
+
+        live = np.where(trading, weights, 0)
+        index_ret = np.nansum(live * np.where(trading, ret, 0), axis=1) / np.maximum(live.sum(axis=1), 1e-12)
+        level = INDEX_BASE[index_code] * np.cumprod(1 + index_ret)
+        pre = np.append(INDEX_BASE[index_code], level[:-1])
+        in_index = weights > 0
+        index_rows.append(pd.DataFrame({
+            'ts_code': index_code, 'trade_date': open_dates, 'close': np.round(level, 4),
+            'open': np.round(pre * np.exp(rng.normal(0, 0.003, T)), 4),
+            'high': np.round(np.maximum(level, pre) * (1 + rng.uniform(0, 0.01, T)), 4),
+            'low': np.round(np.minimum(level, pre) * (1 - rng.uniform(0, 0.01, T)), 4),
+            'pre_close': np.round(pre, 4), 'change': np.round(level - pre, 4),
+            'pct_chg': np.round(index_ret * 100, 4),
+            'vol': np.round(np.where(in_index & trading, vol, 0).sum(axis=1), 2),
+            'amount': np.round(np.where(in_index & trading, amount, 0).sum(axis=1), 3)}))
+        mv = np.where(in_index, np.nan_to_num(cap), 0).sum(axis=1) * 1e4
+        with np.errstate(divide='ignore', invalid='ignore'):
+            basic_rows.append(pd.DataFrame({
+                'ts_code': index_code, 'trade_date': open_dates, 'total_mv': np.round(mv, 2),
+                'float_mv': np.round(np.where(in_index, np.nan_to_num(close * float_share), 0).sum(axis=1) * 1e4, 2),
+                'turnover_rate': np.round(np.nansum(np.where(in_index, turnover * cap, 0), axis=1) * 1e4 / mv, 4),
+                'pe_ttm': np.round(mv / np.where(in_index, np.nan_to_num(ttm), 0).sum(axis=1), 4),
+                'pb': np.round(mv / np.where(in_index, np.nan_to_num(book), 0).sum(axis=1), 4)}))
+
+    tables.update({
+        'trade_cal': trade_cal,
+        'stock_basic': stocks,
+        'daily': daily,
+        'adj_factor': adj_factor,
+        'daily_basic': daily_basic,
+        'index_daily': pd.concat(index_rows, ignore_index=True),
+        'index_dailybasic': pd.concat(basic_rows, ignore_index=True),
+        'index_weight': pd.concat(weight_rows, ignore_index=True),
+    })
+    return tables
+
+
+class FakePro(object):
+    '''
+    本地替身，实现tushare pro_api的query接口，数据来自make_market
+
+    :param market: make_market生成的表
+    :param latency: 每次调用的延迟秒数，模拟网络
+    :param fail_rate: 随机失败的比例，用来测试重试
+    '''
+
+    def __init__(self, market, latency=0.0, fail_rate=0.0, seed=0):
+        self._db = MemoryDatabase()
+        self._columns = {}
+        for api_name, df in market.items():
+            self._db[api_name].load_frame(df)
+            self._columns[api_name] = list(df.columns)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self._rng = np.random.default_rng(seed)
+        self.calls = 0
+
+    @staticmethod
+    def _date_field(api_name):
+        if api_name == 'trade_cal':
+            return 'cal_date'
+        if api_name in FINANCIAL_APIS:
+            return 'ann_date'
+        return 'trade_date'
+
+    def query(self, api_name, fields='', **params):
+        self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.fail_rate > 0 and self._rng.random() < self.fail_rate:
+            raise IOError(f'synthetic failure {api_name}')
+        if api_name not in self._db.list_collection_names():
+            raise Exception(f'请指定正确的接口名 {api_name}')
+
+        date_field = self._date_field(api_name)
+        query = {}
+        for key in ('ts_code', 'index_code', 'exchange', 'is_open'):
+            value = params.get(key)
+            if value is None or value == '':
+                continue
+            values = str(value).split(',')
+            query[key] = values[0] if len(values) == 1 else {'$in': values}
+        if 'is_open' in query:
+            query['is_open'] = int(query['is_open'])
+        if api_name == 'stock_basic':
+            query['list_status'] = params.get('list_status') or 'L'
+        if params.get('trade_date'):
+            query[date_field] = params['trade_date']
+        if params.get('period'):
+            query['end_date'] = params['period']
+        span = {}
+        if params.get('start_date'):
+            span['$gte'] = params['start_date']
+        if params.get('end_date'):
+            span['$lte'] = params['end_date']
+        if len(span) > 0:
+            query[date_field] = span
+
+        df = self._db[api_name].select(query, {'_id': 0})
+        if len(df) == 0:
+            # 和tushare一样，没有数据时返回带列名的空表
+            df = pd.DataFrame(columns=self._columns[api_name])
+        if fields:
+            df = df[[field for field in fields.split(',') if field in df.columns]]
+        # 行情类接口按日期倒序返回，超过单次上限的部分截掉
+        if api_name in ROUTINE_APIS or api_name == 'index_weight':
+            df = df.sort_values(date_field, ascending=False, kind='mergesort').head(ROW_LIMIT)
+        return df.reset_index(drop=True)
+
+    def __getattr__(self, api_name):
+        if api_name.startswith('_'):
+            raise AttributeError(api_name)
+        return functools.partial(self.query, api_name)
+
+
+def make_database(market, tables=None, drop=0.0, seed=0, token='synthetic'):
+    '''
+    把合成行情导入进程内数据库，相当于已经下载好的本地MongoDB
+
+    :param tables: 导入的接口名，默认全部，没有导入的会在使用时通过FakePro下载
+    :param drop: 行情表随机去掉的行比例，用来测试补数据
+    '''
+    rng = np.random.default_rng(seed)
+    db = MemoryDatabase()
+    db['configs'].insert_one({'key': 'token', 'value': token})
+    if tables is None:
+        tables = list(market.keys())
+    for api_name in tables:
+        df = market[api_name]
+        if drop > 0 and api_name in ROUTINE_APIS:
+            df = df[rng.random(len(df)) >= drop].reset_index(drop=True)
+        db[api_name].load_frame(df)
+    return db
+
+
+def make_datasource(n_stocks=300, start='20150101', end='20191231', seed=0, tables=None, drop=0.0,
+                    cache_dir=None, latency=0.0, market=None):
+    '''
+    生成合成行情并返回使用它的CacheData，缓存放在临时目录，不依赖MongoDB和tushare
+
+    :param market: 已经生成的行情，不传时按n_stocks等参数生成
+    '''
+    if market is None:
+        market = make_market(n_stocks, start, end, seed)
+    pro = FakePro(market, latency=latency, seed=seed)
+    database = TsDatabase(db=make_database(market, tables, drop, seed), pro=pro)
+    if cache_dir is None:
+        cache_dir = tempfile.mkdtemp(prefix='synthetic_cache_')
+    data = CacheData(database=database, cache_manager=CacheManager(root_dir=cache_dir, sharded=True))
+    data.market = market
+    return data
+
+
+if __name__ == '__main__':
+    t0 = time.time()
+    market = make_market(n_stocks=50, start='20180101', end='20191231')
+    print(f'生成用时{time.time() - t0:.2f}s')
+    for name, df in market.items():
+        print(name, df.shape)
+    pro = FakePro(market)
+    print(pro.daily(ts_code='600000.SH', start_date='20190101').head())
+    print(pro.query('income', ts_code='600000.SH').tail())
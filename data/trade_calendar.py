@@ -0,0 +1,63 @@
+import numpy as np
+
+from data.dates import to_int
+
+
+class TradeCalendar(object):
+    '''
+    交易日历，只包含开市日，日期和整数位置互相转换
+
+    日期是int32的有序数组，查询都是二分查找，返回的日期序列是数组的切片视图，不复制。
+    查询参数可以是字符串或整数日期
+
+    :param dates: 开市日，可以无序
+    '''
+
+    def __init__(self, dates):
+        self.dates = np.unique(to_int(dates))
+        self._positions = None  # 日期到位置的字典，第一次精确查找时建立
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, pos):
+        return self.dates[pos]
+
+    def __contains__(self, date):
+        date = to_int(date)
+        i = np.searchsorted(self.dates, date)
+        return i < len(self.dates) and self.dates[i] == date
+
+    def index(self, date):
+        # 开市日的位置，不是开市日时抛出KeyError
+        if self._positions is None:
+            self._positions = {date: i for i, date in enumerate(self.dates.tolist())}
+        return self._positions[to_int(date)]
+
+    def position(self, date):
+        # 不晚于date的最后一个开市日的位置，date之前没有开市日时为-1
+        return int(np.searchsorted(self.dates, to_int(date), side='right')) - 1
+
+    def slice(self, start=None, end=None):
+        # [start, end]内开市日的位置切片
+        i = 0 if start is None else int(np.searchsorted(self.dates, to_int(start), side='left'))
+        j = len(self.dates) if end is None else int(np.searchsorted(self.dates, to_int(end), side='right'))
+        return slice(i, max(i, j))
+
+    def range(self, start=None, end=None):
+        return self.dates[self.slice(start, end)]
+
+    def window(self, end, n):
+        # 截止到end（含）的最后n个开市日，不足n个时有多少返回多少
+        j = self.position(end) + 1
+        return self.dates[max(j - n, 0):j]
+
+    def prev(self, date, n=1):
+        # date之前第n个开市日，超出日历时为None
+        i = int(np.searchsorted(self.dates, to_int(date), side='left')) - n
+        return self.dates[i] if 0 <= i < len(self.dates) else None
+
+    def next(self, date, n=1):
+        # date之后第n个开市日，超出日历时为None
+        i = int(np.searchsorted(self.dates, to_int(date), side='right')) + n - 1
+        return self.dates[i] if 0 <= i < len(self.dates) else None
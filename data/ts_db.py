@@ -4,12 +4,16 @@ import pandas as pd
 import pymongo
 import tushare as ts
 
+from data.downloader import Downloader, DownloadTask
+from data.repair import RepairPlanner
+
 
 class TsUpdate(object):
-    def __init__(self, database=None):
+    def __init__(self, database=None, batch_size=1000):
         if database is None:
             database = TsDatabase()
         self.database = database
+        self.batch_size = batch_size  # 批量写入每批的文档数
 
     @property
     def db(self):
@@ -19,40 +23,68 @@ class TsUpdate(object):
     def pro(self):
         return self.database.pro
 
+    # 分批无序upsert，按keys匹配文档，返回每批的新增和修改数
+    def bulk_upsert(self, api_name, records, keys, batch_size=None):
+        if batch_size is None:
+            batch_size = self.batch_size
+        roll = self.db[api_name]
+        results = []
+        for i in range(0, len(records), batch_size):
+            requests = [pymongo.UpdateOne({key: item[key] for key in keys}, {'$set': item}, upsert=True)
+                        for item in records[i:i + batch_size]]
+            result = roll.bulk_write(requests, ordered=False)
+            results.append({'inserted': result.upserted_count, 'modified': result.modified_count})
+        return results
+
+    # 分批无序插入，返回每批的新增数
+    def bulk_insert(self, api_name, records, batch_size=None):
+        if batch_size is None:
+            batch_size = self.batch_size
+        roll = self.db[api_name]
+        results = []
+        for i in range(0, len(records), batch_size):
+            ids = roll.insert_many(records[i:i + batch_size], ordered=False).inserted_ids
+            results.append({'inserted': len(ids), 'modified': 0})
+        return results
+
     # 更新股票基本信息
-    def update_stock_basic(self):
+    def update_stock_basic(self, batch_size=None):
         key = 'stock_basic'
-        roll = self.db[key]
         df = self.pro.stock_basic()
-        count = 0
-        for item in df.to_dict(orient='records'):
-            result = roll.update_one({'ts_code': item['ts_code']}, update=item, upsert=True)
-            count += result.modified_count
-        print(f'{count} modified.')
+        results = self.bulk_upsert(key, df.to_dict(orient='records'), keys=['ts_code'], batch_size=batch_size)
+        print(f'{sum(item["inserted"] for item in results)} upserted. '
+              f'{sum(item["modified"] for item in results)} modified.')
+        return results
 
     # 向前更新ts_code+trade_date类的通用接口
-    def update_previous_tradedates(self, api_name, ts_code, min_date):
+    def update_previous_tradedates(self, api_name, ts_code, min_date, batch_size=None):
         df = self.pro.query(api_name=api_name, ts_code=ts_code, end_date=min_date)
         df = df[df['trade_date'] < min_date]
+        results = []
         if len(df) > 0:
-            ids = self.db[api_name].insert_many(df.to_dict(orient='records')).inserted_ids
-            print(f'{len(ids)} inserted. {ts_code}')
+            results = self.bulk_insert(api_name, df.to_dict(orient='records'), batch_size=batch_size)
+            print(f'{sum(item["inserted"] for item in results)} inserted. {ts_code}')
+        return results
 
     # 向后更新ts_code+trade_date类的通用接口
-    def update_next_tradedates(self, api_name, ts_code, max_date):
+    def update_next_tradedates(self, api_name, ts_code, max_date, batch_size=None):
         df = self.pro.query(api_name=api_name, ts_code=ts_code, start_date=max_date)
         df = df[df['trade_date'] > max_date]
+        results = []
         if len(df) > 0:
-            ids = self.db[api_name].insert_many(df.to_dict(orient='records')).inserted_ids
-            print(f'{len(ids)} inserted. {ts_code}')
+            results = self.bulk_insert(api_name, df.to_dict(orient='records'), batch_size=batch_size)
+            print(f'{sum(item["inserted"] for item in results)} inserted. {ts_code}')
+        return results
 
     # 向后更新ts_code+end_date类的通用接口
-    def update_next_reports(self, api_name, ts_code, max_date):
+    def update_next_reports(self, api_name, ts_code, max_date, batch_size=None):
         df = self.pro.query(api_name=api_name, ts_code=ts_code, start_date=max_date)
         df = df[df['end_date'] > max_date]
+        results = []
         if len(df) > 0:
-            ids = self.db[api_name].insert_many(df.to_dict(orient='records')).inserted_ids
-            print(f'{len(ids)} inserted. {ts_code} {api_name}')
+            results = self.bulk_insert(api_name, df.to_dict(orient='records'), batch_size=batch_size)
+            print(f'{sum(item["inserted"] for item in results)} inserted. {ts_code} {api_name}')
+        return results
 
     # 聚合ts_code+trade_date类的日期信息
     def get_aggregate_tradedates(self, api_name):
@@ -87,73 +119,115 @@ class TsUpdate(object):
         agg_fins = pd.DataFrame(records).set_index('_id')
         return agg_fins
 
+    # 聚合已保存的指数成份的最后快照日
+    def get_aggregate_index_weight(self):
+        coll = self.db['index_weight_history']
+        pipeline = [
+            {'$group': {
+                '_id': '$index_code',
+                'max_date': {'$max': '$trade_date'},
+                'count': {'$sum': 1}
+            }},
+        ]
+        records = list(coll.aggregate(pipeline))
+        if len(records) == 0:
+            return pd.DataFrame(columns=['max_date', 'count'])
+        return pd.DataFrame(records).set_index('_id')
+
+    # 已保存的指数成份往后增量，只下载最后快照日之后的数据
+    def update_index_weight_history(self, index_codes=None, limit_time=60 / 200, batch_size=None):
+        agg_weight = self.get_aggregate_index_weight()
+        if index_codes is None:
+            index_codes = agg_weight.index.tolist()
+
+        results = {}
+        for index_code in index_codes:
+            if index_code not in agg_weight.index:
+                # 还没有保存过的指数下载全部历史
+                df = self.database.get_index_weight_history(index_code, limit_time=limit_time)
+                results[index_code] = 0 if df is None else len(df)
+                continue
+            df = self.database.download_index_weight(index_code, after=agg_weight.loc[index_code, 'max_date'],
+                                                     limit_time=limit_time)
+            count = 0
+            if df is not None:
+                inserted = self.bulk_insert('index_weight_history', df.to_dict(orient='records'), batch_size)
+                count = sum(item['inserted'] for item in inserted)
+            print(f'{count} inserted. {index_code} index_weight_history')
+            results[index_code] = count
+        return results
+
     # 批量更新可以按trade_date横截面查询的接口
-    def update_routine_single(self, api_name, trade_date):
+    def update_routine_single(self, api_name, trade_date, batch_size=None):
         df = self.pro.query(api_name=api_name, trade_date=trade_date)
+        results = []
         if len(df) > 0:
             records = df.to_dict(orient='records')
-            roll = self.db[api_name]
-            count = 0
-            for item in records:
-                filter = {'ts_code': item['ts_code'], 'trade_date': item['trade_date']}
-                upserted_id = roll.update_one(filter=filter, update={'$set': item}, upsert=True).upserted_id
-                if upserted_id:
-                    count += 1
+            results = self.bulk_upsert(api_name, records, keys=['ts_code', 'trade_date'], batch_size=batch_size)
+            count = sum(item['inserted'] for item in results)
             print(f'{count} upserted. {api_name} {trade_date}')
+        return results
 
     # 更新所有trade_date截面的日常行情数据
     def update_all_routine(self, trade_date, update_colls=None):
         if not update_colls:
             update_colls = ['daily', 'adj_factor', 'daily_basic']
 
+        results = {}
         for name in update_colls:
-            self.update_routine_single(name, trade_date)
-
-    def fix_routine_single(self, api_name, limit_time):
-        agg_dates = self.get_aggregate_tradedates(api_name)
-
-        # 前补，接口限制一次只能获取4000行数据，可能前面有遗漏的补上
-        filter_dates = agg_dates[agg_dates['count'] == 4000]
-        for i, row in filter_dates.iterrows():
-            time.sleep(limit_time)
-            ts_code = row.name
-            self.update_previous_tradedates(api_name, ts_code, row['min_date'])
-
-        # 后补
-        for i, row in agg_dates.iterrows():
-            time.sleep(limit_time)
-            ts_code = row.name
-            self.update_next_tradedates(api_name, ts_code, row['max_date'])
+            results[name] = self.update_routine_single(name, trade_date)
+        return results
+
+    # 下载后写入数据库，给并发下载器使用
+    def _write_task(self, task, df):
+        results = self.bulk_insert(task.api_name, df.to_dict(orient='records'))
+        return sum(item['inserted'] for item in results)
+
+    def download(self, tasks, limits=None, workers=4, progress_path=None, writer=None):
+        if writer is None:
+            writer = self._write_task
+        downloader = Downloader(self.pro, writer, limits=limits, workers=workers, progress_path=progress_path)
+        return downloader.run(tasks)
+
+    # 生成ts_code+end_date类财务接口的增量任务
+    def financial_tasks(self, api_name, max_report_date=None):
+        agg_fins = self.get_aggregate_financial(api_name)
+        if max_report_date is not None:
+            agg_fins = agg_fins[agg_fins['max_date'] < max_report_date]
+        return [DownloadTask(api_name, {'ts_code': ts_code, 'start_date': row['max_date']},
+                             where=('end_date', '>', row['max_date']))
+                for ts_code, row in agg_fins.iterrows()]
+
+    def fix_routine_single(self, api_name, limit_time, workers=4, progress_path=None, end_date=None):
+        # 对照交易日历找出缺口，只请求缺少的日期
+        planner = RepairPlanner(self.database)
+        tasks = planner.plan(api_name, end_date=end_date)
+        print(f'{api_name} 需要{len(tasks)}次请求')
+        # limit_time是两次调用的最小间隔，换算成每分钟的调用数
+        limits = {api_name: 60 / limit_time}
+        return self.download(tasks, limits=limits, workers=workers, progress_path=progress_path,
+                             writer=planner.write)
 
     # 补全部日常行情数据
-    def fix_all_routine(self, update_colls=None):
+    def fix_all_routine(self, update_colls=None, workers=4, progress_path=None):
         if not update_colls:
             update_colls = ['daily', 'adj_factor', 'daily_basic', 'index_daily', 'index_dailybasic']
         limit_time = 60 / 200
         for name in update_colls:
             print(f'更新{name}')
-            self.fix_routine_single(api_name=name, limit_time=limit_time)
+            self.fix_routine_single(api_name=name, limit_time=limit_time, workers=workers,
+                                    progress_path=progress_path)
 
     # 自动往后增量全部财务报表数据
-    def fix_all_financial(self, max_report_date):
+    def fix_all_financial(self, max_report_date, workers=4, progress_path=None):
         financial_colls = ['fina_indicator', 'income', 'cashflow', 'balancesheet']
 
-        t1 = time.time()
-        limit_time = 60 / 80
-
+        # 所有报表的任务一起调度，每个接口按自己的额度限速
+        tasks = []
         for name in financial_colls:
             print(f'更新 {name}')
-            agg_fins = self.get_aggregate_financial(name)
-            if max_report_date is not None:
-                agg_fins = agg_fins[agg_fins['max_date'] < max_report_date]
-            for i, row in agg_fins.iterrows():
-                t2 = time.time()
-                if t2 - t1 < limit_time:
-                    time.sleep(limit_time)
-
-                ts_code = row.name
-                self.update_next_reports(api_name=name, ts_code=ts_code, max_date=row['max_date'])
-                t1 = time.time()
+            tasks.extend(self.financial_tasks(name, max_report_date))
+        return self.download(tasks, workers=workers, progress_path=progress_path)
 
     def run_daily_update(self):
         # 更新指数
@@ -166,19 +240,29 @@ class TsUpdate(object):
         print(f'更新股票行情{date}')
         self.update_all_routine(date)
 
+        # 更新已保存的指数成份
+        print('更新指数成份')
+        self.update_index_weight_history()
+
 
 class TsDatabase(object):
     client = None
     db = None
+    _indexed = set()  # 已经确认建过索引的集合
 
-    def __init__(self):
+    def __init__(self, db=None, pro=None):
+        # db和pro可以传入替身，比如data.synthetic生成的离线数据，不传时连接本地MongoDB和tushare
+        if db is not None:
+            self.db = db
         if self.db is None:
             self.client = pymongo.MongoClient(host='localhost', port=27017)
             self.db = self.client['tushare_pro']
 
-        # 获取数据库中存储的token , 初始化pro_api
-        token = self.get_token()
-        self.pro = ts.pro_api(token)
+        if pro is None:
+            # 获取数据库中存储的token , 初始化pro_api
+            token = self.get_token()
+            pro = ts.pro_api(token)
+        self.pro = pro
 
     def set_token(self, token):
         configs = self.db['configs']
@@ -318,13 +402,107 @@ class TsDatabase(object):
             del df['_id']
         return df
 
+    def get_index_weight_history(self, index_code, limit_time=60 / 200):
+        # 指数全部历史成份，数据库里没有时从最近往前分页下载一次，存入单独的集合
+        key = 'index_weight_history'
+        coll = self.db[key]
+        records = list(coll.find({'index_code': index_code}, {'_id': 0}))
+        if len(records) > 0:
+            return pd.DataFrame(records)
+
+        df = self.download_index_weight(index_code, limit_time=limit_time)
+        if df is None:
+            return None
+        ids = coll.insert_many(df.to_dict(orient='records')).inserted_ids
+        print(f'{len(ids)} inserted. {index_code} {key}')
+        return df
+
+    def download_index_weight(self, index_code, after=None, limit_time=60 / 200):
+        # 从最近往前分页下载指数成份，after不为空时只取这一天之后的快照，没有数据时返回None
+        # 接口按日期倒序返回且有行数上限，最早的一天可能不完整，下一页从这一天重新取
+        frames = []
+        oldest = None
+        while True:
+            params = {'index_code': index_code}
+            if after is not None:
+                params['start_date'] = after
+            if oldest is not None:
+                params['end_date'] = oldest
+            df = self.pro.index_weight(**params)
+            time.sleep(limit_time)
+            if after is not None:
+                df = df[df['trade_date'] > after]
+            if len(df) == 0:
+                break
+            frames.append(df)
+            page_oldest = df['trade_date'].min()
+            if page_oldest == oldest:
+                break
+            oldest = page_oldest
+
+        if len(frames) == 0:
+            return None
+        df = pd.concat(frames, ignore_index=True).drop_duplicates(['con_code', 'trade_date'], keep='first')
+        return df.reset_index(drop=True)
+
+    def get_index_weight_latest(self, index_code):
+        # 数据库里指数成份的最后一个快照日，没有数据时为None
+        pipeline = [
+            {'$match': {'index_code': index_code}},
+            {'$group': {'_id': '$index_code', 'max_date': {'$max': '$trade_date'}}},
+        ]
+        records = list(self.db['index_weight_history'].aggregate(pipeline))
+        return records[0]['max_date'] if len(records) > 0 else None
+
+    def ensure_indexes(self, api_name, date_field='trade_date'):
+        # 确保集合有(ts_code, 日期)的复合索引，每个进程每个集合只检查一次
+        key = (api_name, date_field)
+        if key not in self._indexed:
+            self.db[api_name].create_index([('ts_code', pymongo.ASCENDING), (date_field, pymongo.ASCENDING)])
+            self._indexed.add(key)
+
+    def query_by_codes(self, api_name, codes, fields=None, date_field='trade_date', batch_size=5000):
+        # 一次$in查询取回多个代码，只取需要的字段，按批流式写入列数组，返回代码到DataFrame的字典
+        coll = self.db[api_name]
+        self.ensure_indexes(api_name, date_field)
+
+        projection = {'_id': 0}
+        if fields is not None:
+            projection.update({field: 1 for field in ['ts_code', date_field] + list(fields)})
+
+        columns = {}
+        n = 0
+        cursor = coll.find({'ts_code': {'$in': list(codes)}}, projection, batch_size=batch_size)
+        for doc in cursor:
+            # 字段不一致时补齐缺失值
+            if doc.keys() != columns.keys():
+                for key in doc.keys() - columns.keys():
+                    columns[key] = [None] * n
+                for key in columns.keys() - doc.keys():
+                    columns[key].append(None)
+            for key, value in doc.items():
+                columns[key].append(value)
+            n += 1
+
+        if n == 0:
+            return {}
+        df = pd.DataFrame(columns)
+        return {code: group.reset_index(drop=True) for code, group in df.groupby('ts_code', sort=False)}
+
+    def get_many(self, api_name, codes, index_field='trade_date', fields=None):
+        # 批量获取多个代码的序列，和get_daily等单个代码的接口一样按日期索引排序，数据库里没有的代码不返回
+        frames = self.query_by_codes(api_name, codes, fields=fields, date_field=index_field)
+        return {code: df.set_index(index_field, drop=False).sort_index() for code, df in frames.items()}
+
     def query_by_api(self, api_name, query=None, limit_time=1.0, try_download=False):
         coll = self.db[api_name]
 
         if query is None:
             query = {}
 
-        if coll.count_documents(query) == 0:
+        # 直接查询，没有数据时再尝试下载，不再先count一遍
+        records = list(coll.find(query, {'_id': 0}))
+        if len(records) == 0:
             if try_download:
                 df = self.pro.query(api_name=api_name, **query)
                 time.sleep(limit_time)
@@ -335,10 +513,7 @@ class TsDatabase(object):
             else:
                 df = None
         else:
-            records = list(coll.find(query))
             df = pd.DataFrame(records)
-            if '_id' in df.columns:
-                del df['_id']
         return df
 
     def get_stock_basic(self):
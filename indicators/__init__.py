@@ -182,6 +182,34 @@ def calc_fma(series, window=20, top_distance=2):
     return value
 
 
+def calc_fma_pit(series, window=20, top_distance=2):
+    '''
+    calc_fma的逐日无未来版本，第t根的值等于calc_fma(series[:t+1])的最后一个值
+
+    fx要用后面top_distance根K线确认高低点，截断到t时只有t-top_distance及之前的高低点能确认，
+    所以窗口里t-top_distance之后的位置都取t-top_distance时最近高低点的价格
+    '''
+    if top_distance < 1 or type(top_distance) is not int:
+        raise TypeError('top_distance must be int and larger than zero.')
+
+    n = len(series)
+    t = np.arange(n)
+    lo = np.maximum(t - window + 1, 0)  # 均线窗口的起点，和ma的min_periods=1一致
+    last = t - top_distance  # 截断到t时最后一个能确认高低点的位置
+    known = np.clip(last - lo + 1, 0, None)  # 窗口里位置不超过last的个数
+
+    def pit_ma(con):
+        values = at_last_condition(series, con).values.astype(np.float64)
+        cum = np.concatenate([[0], np.cumsum(values)])
+        # last<0时还没有确认的高低点，at_last_condition用第一个值填充
+        tail = np.where(last >= 0, values[np.maximum(last, 0)], series.values[0])
+        total = cum[lo + known] - cum[lo] + (t - lo + 1 - known) * tail
+        return total / (t - lo + 1)
+
+    value = (pit_ma(fx(series, hhv, top_distance)) + pit_ma(fx(series, llv, top_distance))) / 2
+    return pd.Series(value, index=series.index)
+
+
 def big_period_into_small_index(small, big):
     union = small.append(big).sort_index()
     union = union.groupby(union.index).first()
@@ -0,0 +1,255 @@
+'''
+逐根K线增量更新的指标，和indicators里整段序列计算的同名函数逐根一致
+
+每个对象保存计算到当前K线需要的状态，update传入一根新K线，常数时间返回当前值，适合实盘和很长的逐日循环。
+hhv/llv用单调队列，ma/zscore用滑动的和与离差平方和，ema/sma/rsi用递推
+'''
+from collections import deque
+import math
+
+import numpy as np
+
+
+def _isnan(value):
+    return value is None or value != value
+
+
+class MA(object):
+    # 对应ma(series, n)，窗口内不足n个值时按已有的值平均
+    def __init__(self, n):
+        self.n = n
+        self._window = deque()
+        self._sum = 0.0
+        self._count = 0
+        self.value = np.nan
+
+    def update(self, value):
+        self._window.append(value)
+        if not _isnan(value):
+            self._sum += value
+            self._count += 1
+        if len(self._window) > self.n:
+            old = self._window.popleft()
+            if not _isnan(old):
+                self._sum -= old
+                self._count -= 1
+        self.value = self._sum / self._count if self._count > 0 else np.nan
+        return self.value
+
+
+class EWM(object):
+    # 对应pandas的ewm(alpha=alpha).mean()，adjust=True，缺失值不更新但权重照常衰减
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self._num = 0.0  # 加权和
+        self._den = 0.0  # 权重和
+        self.value = np.nan
+
+    def update(self, value):
+        decay = 1 - self.alpha
+        self._num *= decay
+        self._den *= decay
+        if not _isnan(value):
+            self._num += value
+            self._den += 1
+        self.value = self._num / self._den if self._den > 0 else np.nan
+        return self.value
+
+
+class EMA(EWM):
+    # 对应ema(series, n)
+    def __init__(self, n):
+        super().__init__(2 / (n + 1))
+
+
+class SMA(EWM):
+    # 对应sma(series, n, m)
+    def __init__(self, n, m):
+        super().__init__(m / n)
+
+
+class _Extreme(object):
+    # 单调队列维护窗口最值，队列里保存(位置, 值)，队首就是当前最值
+    def __init__(self, n, better):
+        self.n = n
+        self._better = better
+        self._queue = deque()
+        self._i = -1
+        self.value = np.nan
+
+    def update(self, value):
+        self._i += 1
+        queue = self._queue
+        if not _isnan(value):
+            while queue and not self._better(queue[-1][1], value):
+                queue.pop()
+            queue.append((self._i, value))
+        while queue and queue[0][0] <= self._i - self.n:
+            queue.popleft()
+        self.value = queue[0][1] if queue else np.nan
+        return self.value
+
+
+class HHV(_Extreme):
+    # 对应hhv(series, n)
+    def __init__(self, n):
+        super().__init__(n, lambda kept, new: kept > new)
+
+
+class LLV(_Extreme):
+    # 对应llv(series, n)
+    def __init__(self, n):
+        super().__init__(n, lambda kept, new: kept < new)
+
+
+class ATR(object):
+    # 对应calc_atr(kline, n)，update传入当根的最高、最低和收盘价
+    def __init__(self, n):
+        self._ma = MA(n)
+        self._close = np.nan
+        self.value = np.nan
+
+    def update(self, high, low, close):
+        ranges = [high - low, abs(self._close - high), abs(self._close - low)]
+        ranges = [item for item in ranges if not _isnan(item)]
+        self._close = close
+        self.value = self._ma.update(max(ranges) if ranges else np.nan)
+        return self.value
+
+
+class RSI(object):
+    # 对应calc_rsi(series, n)
+    def __init__(self, n):
+        self._up = SMA(n, 1)
+        self._abs = SMA(n, 1)
+        self._last = np.nan
+        self.value = np.nan
+
+    def update(self, value):
+        change = value - self._last
+        self._last = value
+        # 批量版本里上涨部分缺失时补0，绝对值保留缺失
+        up = self._up.update(change if not _isnan(change) and change > 0 else 0)
+        total = self._abs.update(abs(change))
+        self.value = up / total * 100 if total else np.nan
+        return self.value
+
+
+class _Moments(object):
+    # Welford算法维护均值和离差平方和，支持移出最早的值
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        if self.count == 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        delta = value - self.mean
+        self.count -= 1
+        self.mean -= delta / self.count
+        self.m2 -= delta * (value - self.mean)
+
+    def std(self):
+        # 样本标准差，和pandas的ddof=1一致
+        if self.count < 2:
+            return np.nan
+        return math.sqrt(max(self.m2, 0) / (self.count - 1))
+
+
+class RollingZScore(object):
+    # 对应rolling_zscore(series, n)
+    def __init__(self, n):
+        self.n = n
+        self._window = deque()
+        self._moments = _Moments()
+        self.value = np.nan
+
+    def update(self, value):
+        self._window.append(value)
+        if not _isnan(value):
+            self._moments.add(value)
+        if len(self._window) > self.n:
+            old = self._window.popleft()
+            if not _isnan(old):
+                self._moments.remove(old)
+        std = self._moments.std()
+        self.value = (value - self._moments.mean) / std if std == std and std > 0 else np.nan
+        return self.value
+
+
+class ExpandingZScore(object):
+    # 对应expanding_zscore(series)
+    def __init__(self):
+        self._moments = _Moments()
+        self.value = np.nan
+
+    def update(self, value):
+        if not _isnan(value):
+            self._moments.add(value)
+        std = self._moments.std()
+        self.value = (value - self._moments.mean) / std if std == std and std > 0 else np.nan
+        return self.value
+
+
+class WeightMA(object):
+    # 对应weight_ma(weight_series, data_series, n)，n为0时是累计加权平均
+    def __init__(self, n=0):
+        self.n = n
+        self._window = deque()
+        self._wsum = 0.0
+        self._sum = 0.0
+        self.value = np.nan
+
+    def update(self, weight, value):
+        item = (weight * value, weight)
+        if self.n > 0:
+            self._window.append(item)
+        if not _isnan(item[0]):
+            self._wsum += item[0]
+        if not _isnan(item[1]):
+            self._sum += item[1]
+        if len(self._window) > self.n > 0:
+            old_wdata, old_weight = self._window.popleft()
+            if not _isnan(old_wdata):
+                self._wsum -= old_wdata
+            if not _isnan(old_weight):
+                self._sum -= old_weight
+        self.value = self._wsum / self._sum if self._sum else np.nan
+        return self.value
+
+
+class Valuation(object):
+    '''
+    对应calc_valuation(pcore, min_periods)，update返回(mid, top, bot)
+
+    批量版本在前min_periods根之前用之后的第一个有效值向后填充，逐根计算时拿不到未来的值，
+    这段预热期返回NaN，之后和批量版本一致
+    '''
+
+    def __init__(self, min_periods=240):
+        self.min_periods = min_periods
+        self._moments = _Moments()
+        self._min = np.nan
+        self.value = (np.nan, np.nan, np.nan)
+
+    def update(self, pcore):
+        if not _isnan(pcore):
+            self._moments.add(pcore)
+            self._min = pcore if _isnan(self._min) else min(self._min, pcore)
+        if self._moments.count < self.min_periods:
+            self.value = (np.nan, np.nan, np.nan)
+            return self.value
+        mid = np.round(self._moments.mean, 2)
+        std = np.round(self._moments.std(), 2)
+        bot = mid - std
+        self.value = (mid, mid + std, bot if bot > self._min else self._min)
+        return self.value
+
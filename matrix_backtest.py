@@ -0,0 +1,264 @@
+import numpy as np
+import pandas as pd
+
+import backtest
+from account import Account
+from data.dates import to_int
+from data.panel import compact_valid, expand_valid
+
+RECORD_COLUMNS = ('日期', '净值', '现金', '成交额', '手续费', '持仓数', '盈利卖出笔数', '亏损卖出笔数', '卖出盈利额', '卖出亏损额')
+
+
+def event_signals(buy, sell):
+    '''
+    把买入、卖出信号矩阵合成下单矩阵，和MOM先卖后买的顺序一致：
+    同一天两个信号都有时记为2，持仓的先卖出再重新买入，未持仓的直接买入
+
+    :param buy: 布尔矩阵，行是日期，列是代码
+    :param sell: 布尔矩阵
+    :return: 1表示未持仓时买入，-1表示持仓时卖出，2表示两个信号都有，0不操作
+    '''
+    buy = buy.fillna(False).astype(bool)
+    sell = sell.reindex_like(buy).fillna(False).astype(bool)
+    return pd.DataFrame(np.where(buy & sell, 2, np.where(buy, 1, np.where(sell, -1, 0))), index=buy.index,
+                        columns=buy.columns)
+
+
+def mom_signals(close, args=(20, 10)):
+    '''
+    MOM策略的下单矩阵，收盘价创N天新高买入，创M天新低卖出
+
+    信号在每个代码自己的K线序列上计算，停牌日沿用最后一根K线的信号，和账户行情视图的取法一致
+
+    :param close: 收盘价面板，行是交易日，列是代码，没有行情的为NaN，需要包含回测开始前的预热数据
+    :param args: (买入的N天, 卖出的M天)
+    '''
+    values = close.values.astype(np.float64)
+    valid = ~np.isnan(values)
+    compact, order = compact_valid(values, valid)
+    compact = pd.DataFrame(compact)
+    n_max = compact.rolling(args[0], min_periods=args[0]).max().values
+    n_min = compact.rolling(args[1], min_periods=args[1]).min().values
+
+    def expand(signal):
+        # 还原到日历上，停牌日向前填充
+        signal = expand_valid(signal.astype(np.float64), order, valid)
+        return pd.DataFrame(signal, index=close.index, columns=close.columns).ffill().fillna(0).astype(bool)
+
+    with np.errstate(invalid='ignore'):
+        buy = expand(n_max <= compact.values)
+        sell = expand(n_min >= compact.values)
+    return event_signals(buy, sell)
+
+
+def _prices(account, codes, start, end):
+    # 回测区间的盯市价格矩阵，停牌日沿用上一个收盘价，和账户的取价一致
+    panel = account.data.load_panel('close', codes, source=account._price_source)
+    rows = panel.rows(start, end)
+    prices = pd.DataFrame(panel.get(codes)).ffill().values[rows]
+    return panel.dates[rows], prices
+
+
+def _align(targets, dates, codes):
+    # 目标矩阵对齐到交易日，只在调仓日给出的矩阵向前填充，索引可以是字符串或整数日期
+    targets = targets.set_axis(to_int(targets.index.values), axis=0).sort_index().reindex(columns=codes)
+    targets = targets.reindex(targets.index.union(dates)).ffill().reindex(dates)
+    return targets.fillna(0).values.astype(np.float64)
+
+
+def _simulate(account, target, prices, mode, split, lot, freq):
+    # 逐日推进现金和持仓，每天对全部代码做数组运算
+    n_dates, n_codes = prices.shape
+    valid = ~np.isnan(prices)
+    px = np.where(valid, prices, 0)
+    get_commision = account.get_commision
+
+    cash = float(account._cash)
+    qty = np.zeros(n_codes)
+    cost = np.zeros(n_codes)  # 持仓成本总额，算法同HoldingsBook
+    stats = np.zeros(4)  # 盈利卖出笔数, 亏损卖出笔数, 卖出盈利额, 卖出亏损额
+    qtys = np.zeros((n_dates, n_codes))
+    cashes = np.empty(n_dates)
+    amounts = np.zeros(n_dates)
+    commisions = np.zeros(n_dates)
+    sell_stats = np.empty((n_dates, 4))
+    last = np.zeros(n_codes)
+
+    for t in range(n_dates):
+        p = px[t]
+        row = target[t]
+        sells = buys = None
+        if mode == 'signal':
+            held = qty != 0
+            sells = np.flatnonzero(((row < 0) | (row == 2)) & held)
+            sell_qty = -qty[sells]
+        elif (row != last).any() if freq is None else t % freq == 0:
+            value = cash + np.dot(qty, p)
+            amount = row * value
+            want = np.floor((amount - get_commision(amount)) / np.where(valid[t], p, np.inf) / lot) * lot
+            want = np.where(valid[t], want, qty)  # 没有价格的代码不调整
+            delta = want - qty
+            sells = np.flatnonzero(delta < 0)
+            sell_qty = delta[sells]
+            buys = np.flatnonzero(delta > 0)
+            buy_qty = delta[buys]
+        last = row
+
+        if sells is not None and len(sells) > 0:
+            order_value = p[sells] * sell_qty
+            commision = get_commision(order_value)
+            spend = order_value + commision
+            balance = cost[sells] / qty[sells] * sell_qty
+            gains = balance - spend
+            win = gains > 0
+            stats += [win.sum(), (~win).sum(), gains[win].sum(), gains[~win].sum()]
+            cost[sells] += balance
+            qty[sells] += sell_qty
+            cash -= spend.sum()
+            amounts[t] += np.abs(order_value).sum()
+            commisions[t] += commision.sum()
+
+        if mode == 'signal':
+            # 未持仓且有行情的代码里，信号为买入的平分现金，当天先卖出的代码也可以重新买入
+            free = (qty == 0) & valid[t]
+            wanted = np.flatnonzero(free & (row > 0))
+            if split == 'entries':
+                n = len(wanted)
+            elif split == 'candidates':
+                n = free.sum()
+            else:
+                n = split
+            if len(wanted) > 0:
+                amount = (cash - get_commision(cash)) / n
+                buy_qty = np.floor(amount / p[wanted] / lot) * lot
+                buys = wanted[buy_qty > 0]
+                buy_qty = buy_qty[buy_qty > 0]
+
+        if buys is not None and len(buys) > 0:
+            order_value = p[buys] * buy_qty
+            commision = get_commision(order_value)
+            spend = order_value + commision
+            if spend.sum() > cash:
+                # 现金不够时按比例缩减买入数量
+                buy_qty = np.floor(buy_qty * cash / spend.sum() / lot) * lot
+                order_value = p[buys] * buy_qty
+                commision = get_commision(order_value)
+                spend = order_value + commision
+            cost[buys] += spend
+            qty[buys] += buy_qty
+            cash -= spend.sum()
+            amounts[t] += np.abs(order_value).sum()
+            commisions[t] += commision.sum()
+
+        qtys[t] = qty
+        cashes[t] = cash
+        sell_stats[t] = stats
+
+    return {
+        '净值': cashes + (qtys * px).sum(axis=1),
+        '现金': cashes,
+        '成交额': amounts,
+        '手续费': commisions,
+        '持仓数': (qtys != 0).sum(axis=1),
+        '盈利卖出笔数': sell_stats[:, 0].astype(int),
+        '亏损卖出笔数': sell_stats[:, 1].astype(int),
+        '卖出盈利额': sell_stats[:, 2],
+        '卖出亏损额': sell_stats[:, 3],
+    }
+
+
+def _check(targets, mode, split):
+    if mode not in ('signal', 'weight'):
+        raise ValueError(f'unknown mode {mode}')
+    if mode == 'signal' and not (split in ('entries', 'candidates') or isinstance(split, int)):
+        raise ValueError(f'unknown split {split}')
+    if mode == 'signal' and targets.dtypes.eq(bool).all():
+        # 布尔矩阵表示是否持有
+        targets = targets.astype(int) * 2 - 1
+    if mode == 'weight' and (targets.values < 0).any():
+        raise ValueError('账户只能做多，权重不能为负')
+    return targets
+
+
+def _run(account, targets, prices, dates, codes, benchmark, mode, split, lot, freq):
+    values = _simulate(account, _align(targets, dates, codes), prices, mode, split, lot, freq)
+    records = pd.DataFrame(values)
+    records.insert(0, '日期', dates)
+    account._records = records[list(RECORD_COLUMNS)].to_dict(orient='records')
+    return account.create_report(benchmark)
+
+
+def matrix_backtest(targets, start=None, end=None, benchmark='399300.SZ', mode='signal', split='entries', lot=1,
+                    freq=None, account=None):
+    '''
+    不逐日调用策略的向量化回测，输入整个区间的信号或目标权重矩阵，返回和backtest相同字段的Report
+
+    手续费用账户的get_commision，数量按lot取整，盯市和成交价都是当天收盘价（停牌沿用上一个），
+    卖出盈亏按持仓平均成本统计，和事件驱动的回测一致。适合大批量筛选信号，入围的再用backtest回放
+
+    :param DataFrame targets: 行是日期，列是代码；只给出调仓日的行时向前填充
+    :param mode: signal时1表示未持仓时买入，-1表示持仓时卖出，2表示持仓时先卖出再买入、未持仓时买入，
+        0不操作，布尔矩阵表示是否持有；
+        weight时是占净值的目标权重，调仓日把全部代码调整到目标权重
+    :param split: signal模式买入时现金平分的份数，entries按当天要买入的代码数，和BuyAndHold一致；
+        candidates按未持仓且有行情的代码数，和MOM一致；也可以是固定的整数
+    :param lot: 每手股数，事件驱动的策略按1股取整
+    :param freq: weight模式每隔freq天调仓一次，默认在目标权重变化的日期调仓
+    :param Account account: 提供初始资金、数据、手续费和价格来源，默认新建一个Account
+    '''
+    if account is None:
+        account = Account(data=backtest.get_datasource())
+    targets = _check(targets, mode, split)
+    codes = list(targets.columns)
+    dates, prices = _prices(account, codes, start, end)
+    return _run(account, targets, prices, dates, codes, benchmark, mode, split, lot, freq)
+
+
+def screen(variants, start=None, end=None, benchmark='399300.SZ', mode='signal', split='entries', lot=1, freq=None,
+           account_cls=Account, init_cash=1000000):
+    '''
+    批量回测多个信号矩阵，价格矩阵只加载一次
+
+    :param dict variants: 名字到信号或权重矩阵
+    :return: (汇总表, 净值曲线表)，和sweep的返回一致
+    '''
+    data = backtest.get_datasource()
+    variants = {name: _check(targets, mode, split) for name, targets in variants.items()}
+    codes = sorted(set(code for targets in variants.values() for code in targets.columns))
+    dates, prices = _prices(account_cls(init_cash, data), codes, start, end)
+    columns = {code: i for i, code in enumerate(codes)}
+
+    summaries = {}
+    values = {}
+    for name, targets in variants.items():
+        names = list(targets.columns)
+        report = _run(account_cls(init_cash, data), targets, prices[:, [columns[code] for code in names]], dates,
+                      names, benchmark, mode, split, lot, freq)
+        summaries[name] = report._summary
+        values[name] = report._records['净值']
+    return pd.DataFrame(summaries).T, pd.DataFrame(values)
+
+
+if __name__ == '__main__':
+    from strategy.strategy import MOM, BuyAndHold
+
+    # 和事件驱动的回测对照，两种策略的记录应当一致
+    data = backtest.set_datasource('synthetic', n_stocks=100, start='20160101', end='20181231')
+    codes = data.get_stock_basic().index[:30].tolist()
+    close = data.get_panel('close', codes)
+    start, end = '20170101', '20181231'
+    cases = [
+        (BuyAndHold(codes), pd.DataFrame(1, index=close.index, columns=codes), 'entries'),
+        (MOM(codes), mom_signals(close), 'candidates'),
+        # 每天买卖信号都有，持仓先卖出再买回
+        (MOM(codes, args=(1, 1)), mom_signals(close, (1, 1)), 'candidates'),
+    ]
+    for strategy, targets, split in cases:
+        expected = backtest.backtest(strategy, start, end, benchmark='000300.SH', save_cache=False)._records
+        result = matrix_backtest(targets, start, end, benchmark='000300.SH', split=split)._records
+        diff = (result[list(RECORD_COLUMNS[1:])] - expected[list(RECORD_COLUMNS[1:])]).abs().max()
+        print(type(strategy).__name__, '最大差异:', diff.max())
+
+    variants = {f'MOM{n}_{m}': mom_signals(close, (n, m)) for n in (10, 20, 40) for m in (5, 10, 20)}
+    summary, values = screen(variants, start, end, benchmark='000300.SH', split='candidates')
+    print(summary)
@@ -1,48 +1,109 @@
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
 
 from backtest import get_datasource
-
-
-def _calc_ff_weights(rets, factors, cols, add_alpha=True):
+from data.panel import shift_valid
+
+
+def _solve_ols(Y, X):
+    # 所有代码共用设计矩阵X，Y的每列是一个代码的收益，一次最小二乘求出全部系数
+    # 有缺失值的列按缺失模式分组，同一模式的列掩码后一起求解
+    params = np.full((X.shape[1], Y.shape[1]), np.nan)
+    valid = ~np.isnan(Y) & ~np.isnan(X).any(axis=1)[:, None]
+    patterns, groups = np.unique(valid.T, axis=0, return_inverse=True)
+    for i, mask in enumerate(patterns):
+        # 样本数不足以拟合的列保持NaN
+        if mask.sum() < X.shape[1]:
+            continue
+        cols = np.flatnonzero(groups.ravel() == i)
+        params[:, cols] = np.linalg.lstsq(X[mask], Y[mask][:, cols], rcond=None)[0]
+    residuals = Y - X.dot(params)
+    return params, residuals
+
+
+def _calc_ff_regression(rets, factors, cols, add_alpha=True):
+    # 一次求出全部代码的因子暴露和残差
     X = factors.values
     if add_alpha:
-        X = sm.add_constant(X)
-    items = []
-    for code in rets.columns:
-        # 最小二乘法进行拟合
-        stock_rets = rets[code]
-        cls = sm.OLS(stock_rets.values, X).fit()
-        item = {'code': code}
-        for i in range(len(cols)):
-            item[cols[i]] = cls.params[i]
-        items.append(item)
-    result = pd.DataFrame(items).set_index('code')[cols]
-
-    return result
+        X = np.column_stack([np.ones(len(X)), X])
+    params, residuals = _solve_ols(rets.values, X)
+    weights = pd.DataFrame(params.T, index=pd.Index(rets.columns, name='code'), columns=cols)
+    residuals = pd.DataFrame(residuals, index=rets.index, columns=rets.columns)
+    return weights, residuals
 
 
-def _calc_residuals(actual_rets, factors, weights):
-    X = factors.copy()
-    residuals = {}
-    weights = weights[X.columns.tolist()].T
-    for code in weights.columns:
-        W = weights[code].values
-        predict_rets = (X * W).sum(axis=1)
-        residuals[code] = actual_rets[code] - predict_rets
-
-    return pd.DataFrame(residuals)
+def _calc_ff_weights(rets, factors, cols, add_alpha=True):
+    weights, _ = _calc_ff_regression(rets, factors, cols, add_alpha)
+    return weights
+
+
+def _group_mean(rets, cols, weights=None):
+    # 取出每行指定列的回报求平均，忽略缺失值，weights不为空时加权平均
+    rets = np.take_along_axis(rets, cols, axis=1)
+    valid = ~np.isnan(rets)
+    if weights is None:
+        w = valid.astype(np.float64)
+    else:
+        w = np.take_along_axis(weights, cols, axis=1)
+        valid &= ~np.isnan(w)
+        w = np.where(valid, w, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.where(valid, rets, 0) * w).sum(axis=1) / w.sum(axis=1)
+
+
+def _masked_mean(rets, mask, weights=None):
+    # 每行mask为True的回报求平均，忽略缺失值
+    valid = mask & ~np.isnan(rets)
+    if weights is None:
+        w = valid.astype(np.float64)
+    else:
+        valid &= ~np.isnan(weights)
+        w = np.where(valid, weights, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.where(valid, rets, 0) * w).sum(axis=1) / w.sum(axis=1)
+
+
+def _calc_long_short(values, rets, n_groups=3, weights=None, members=None):
+    # 每行按指标从小到大排序分成n_groups组，返回最小一组的平均回报 - 最大一组的平均回报
+    # 缺失值排在最后，不能整除时余下的代码归入最大一组
+    # members是日期×代码的成份矩阵，给出时每行只在当天的成份里分组
+    values = np.asarray(values, dtype=np.float64)
+    rets = np.asarray(rets, dtype=np.float64)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+    if members is not None:
+        # 非成份排到最后，每行按成份数分组
+        values = np.where(members, values, np.inf)
+        rank = np.argsort(np.argsort(values, axis=1, kind='stable'), axis=1)
+        n = (members.sum(axis=1) / n_groups).astype(np.int64)[:, None]
+        small = rank < n
+        big = (rank >= (n_groups - 1) * n) & members
+        return _masked_mean(rets, small, weights) - _masked_mean(rets, big, weights)
+    order = np.argsort(values, axis=1)
+    n = int(values.shape[1] / n_groups)
+    small = order[:, :n]
+    big = order[:, (n_groups - 1) * n:]
+    return _group_mean(rets, small, weights) - _group_mean(rets, big, weights)
 
 
 class FF(object):
-    def __init__(self, n_ret=1, data=None):
+    def __init__(self, n_ret=1, data=None, n_groups=3, cap_weighted=False, pit_members=False):
         if data is None:
             data = get_datasource()
 
         self.data = data
         self._codes = []
         self._n_ret = n_ret
+        self._n_groups = n_groups  # 规模和估值因子的分组数
+        self._cap_weighted = cap_weighted  # 组内是否按市值加权
+        self._pit_members = pit_members  # 因子是否按每天当时的指数成份计算
+
+    def _returns(self, codes, dates, trade_date):
+        # 从对齐好的面板一次性切出全部代码的收益，避免逐个代码reindex
+        close = self.data.load_panel('close', codes, source='daily_basic')
+        clog = np.log(close.get(codes, end=trade_date))
+        zf = clog - shift_valid(clog, self._n_ret)
+        return pd.DataFrame(zf[-len(dates):], index=dates, columns=codes)
 
     def get_factors(self, index_code, n_period, trade_date):
         codes = self.data.get_index_weight(index_code, trade_date=trade_date)['con_code'].values.tolist()
@@ -50,37 +111,35 @@ class FF(object):
             self._codes = codes
         else:
             # 某些日期获取成份股会为空，用前面有效值代替
-            self.codes = self._codes
-        dates = self.data.get_trade_dates(end=trade_date)[-n_period:]
-        rets = {}
-        total_mv = {}
-        pb = {}
-        for code in codes:
-            # print('debug',code)
-            basic = self.data.get_daily_basic(code)
-            clog = np.log(basic['close'])
-            zf = clog - clog.shift(self._n_ret)
-            rets[code] = zf.reindex(dates).fillna(0)
-            total_mv[code] = basic['total_mv'].reindex(dates)
-            pb[code] = basic['pb'].reindex(dates)
-        rets = pd.DataFrame(rets)
-        total_mv = pd.DataFrame(total_mv)
-        pb = pd.DataFrame(pb)
-
-        def smb(row):
-            # 将指标排序分成3组，返回前1/3的平均回报 - 后1/3的平均回报
-            row_rets = rets.loc[row.name]
-            row = row.sort_values()
-            n = int(len(row) / 3)
-            small = row.index[:n]
-            big = row.index[2 * n:]
-            return row_rets.reindex(small).mean() - row_rets.reindex(big).mean()
+            codes = self._codes
+        dates = self.data.get_calendar().window(trade_date, n_period)
+        members = None
+        factor_codes = codes
+        if self._pit_members:
+            # 回测区间内当过成份的代码都参与因子计算，每天只用当天的成份，避免用查询日的成份回看
+            index_members = self.data.get_index_members(index_code)
+            factor_codes = sorted(set(index_members.codes_between(dates[0], dates[-1])) | set(codes))
+            members = index_members.mask(dates, factor_codes)
+
+        factor_rets = self._returns(factor_codes, dates, trade_date)
+        rets = factor_rets[codes].fillna(0)
+        total_mv = self.data.get_panel('total_mv', factor_codes, start=dates[0], end=dates[-1])
+        pb = self.data.get_panel('pb', factor_codes, start=dates[0], end=dates[-1])
+        if members is None:
+            factor_rets = factor_rets.fillna(0)
+        else:
+            factor_rets = factor_rets.where(members)
+            total_mv = total_mv.where(members)
 
         factor_items = {}
         # 市值加权计算市场收益作为市场因子
-        factor_items['beta'] = (rets * total_mv).sum(axis=1) / total_mv.sum(axis=1)
-        factor_items['total_mv'] = total_mv.apply(smb, axis=1)
-        factor_items['pb'] = pb.apply(smb, axis=1)
+        factor_items['beta'] = (factor_rets * total_mv).sum(axis=1) / total_mv.sum(axis=1)
+        # 将指标排序分组，最小一组的平均回报 - 最大一组的平均回报
+        weights = total_mv.values if self._cap_weighted else None
+        factor_items['total_mv'] = pd.Series(_calc_long_short(total_mv.values, factor_rets.values, self._n_groups,
+                                                              weights, members), index=rets.index)
+        factor_items['pb'] = pd.Series(_calc_long_short(pb.values, factor_rets.values, self._n_groups, weights,
+                                                        members), index=rets.index)
 
         factors = pd.DataFrame(factor_items)
         cols = ['beta', 'total_mv', 'pb']
@@ -95,7 +154,6 @@ class FF(object):
     def get_residuals(self, index_code, n_period, trade_date):
         actual_rets, factors, cols = self.get_factors(index_code, n_period, trade_date)
         # cols = ['alpha'] + cols
-        weights = _calc_ff_weights(actual_rets, factors, cols, add_alpha=False)
         # factors['alpha'] = 1
-        residuals = _calc_residuals(actual_rets, factors, weights)
+        _, residuals = _calc_ff_regression(actual_rets, factors, cols, add_alpha=False)
         return residuals
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+from backtest import get_datasource
+from data.dates import to_int
+from indicators import calc_atr, calc_fma_pit
+
+CACHE_NAME = 'indicator_signals'  # 和rsrs_signals一样按代码持久化
+
+
+def _fma(klines, window=20, top_distance=2):
+    return calc_fma_pit(klines['close'], window, top_distance)
+
+
+def _atr(klines, n=20):
+    return calc_atr(klines, n)
+
+
+def _grid(klines, window=20, n=20):
+    # 收盘价偏离fma的atr倍数
+    return (klines['close'] - calc_fma_pit(klines['close'], window)) / calc_atr(klines, n)
+
+
+def _hhv(klines, n):
+    # 不足n根K线的为NaN
+    return klines['close'].rolling(window=n, min_periods=n).max()
+
+
+def _llv(klines, n):
+    return klines['close'].rolling(window=n, min_periods=n).min()
+
+
+# 登记的指标第t根的值只依赖前t根K线，和逐日截断行情重新计算的结果相同
+INDICATORS = {
+    'fma': _fma,
+    'atr': _atr,
+    'grid': _grid,
+    'hhv': _hhv,
+    'llv': _llv,
+}
+
+
+class IndicatorStore(object):
+    '''
+    全历史指标缓存，每个(指标, 参数, 代码)在完整行情上只算一次，回测中按K线位置取当天的值
+
+    只登记没有未来数据的指标，取第pos根的值等价于用截断到pos的行情计算，verify可以抽样核对。
+    行情长度有变化时重新计算
+
+    :param data: 数据对象，默认使用backtest设置的数据源
+    '''
+
+    def __init__(self, data=None):
+        if data is None:
+            data = get_datasource()
+        self.data = data
+        self._values = {}  # 本次运行已经取出的指标，键到(日期数组, 数值数组)
+
+    def _klines(self, code, source):
+        if source == 'index_daily':
+            return self.data.get_index_daily(code)
+        return self.data.get_daily_adj(code)
+
+    def get(self, name, code, params=(), source='adj_daily'):
+        # 完整的指标序列，索引是K线日期
+        key = f'{name}{tuple(params)}.{code}' if source == 'adj_daily' else f'{name}{tuple(params)}.{code}_index'
+        cache = self.data.get_cache(CACHE_NAME)
+        klines = self._klines(code, source)
+        if klines is None or len(klines) == 0:
+            return pd.Series(dtype=np.float64)
+
+        series = cache.get(key) if cache.has(key) else None
+        if series is None or len(series) != len(klines) or series.index[-1] != klines.index[-1]:
+            series = INDICATORS[name](klines, *params)
+            cache.set(key, series)
+        return series
+
+    def _arrays(self, name, code, params, source):
+        key = (name, tuple(params), code, source)
+        if key not in self._values:
+            series = self.get(name, code, params, source)
+            self._values[key] = (np.asarray(series.index), series.values)
+        return self._values[key]
+
+    def value(self, name, code, pos, params=(), source='adj_daily'):
+        # 第pos根K线的值，pos是账户行情视图的长度减1，没有行情时为NaN
+        if pos < 0:
+            return np.nan
+        return self._arrays(name, code, params, source)[1][pos]
+
+    def value_at(self, name, code, date, params=(), source='adj_daily'):
+        # 不晚于date的最后一根K线的值
+        dates, values = self._arrays(name, code, params, source)
+        return self.value(name, code, np.searchsorted(dates, to_int(date), side='right') - 1, params, source)
+
+    def verify(self, name, code, params=(), source='adj_daily', n=20):
+        '''
+        抽样核对没有未来数据：用截断到第pos根的行情重新计算，和缓存的第pos根比较
+
+        :param n: 抽样的位置数
+        :return: 最大绝对差
+        '''
+        klines = self._klines(code, source)
+        values = self.get(name, code, params, source).values
+        diff = 0.0
+        for pos in np.unique(np.linspace(0, len(klines) - 1, n).astype(int)):
+            value = INDICATORS[name](klines.iloc[:pos + 1], *params).values[-1]
+            if not (np.isnan(value) and np.isnan(values[pos])):
+                diff = max(diff, abs(value - values[pos]))
+        return diff
+
+
+if __name__ == '__main__':
+    import backtest
+
+    data = backtest.set_datasource('synthetic', n_stocks=20, start='20160101', end='20181231')
+    store = IndicatorStore(data)
+    code = data.get_stock_basic().index[0]
+    for name, params in [('fma', (20, 2)), ('atr', (20,)), ('grid', (20, 20)), ('hhv', (20,)), ('llv', (10,))]:
+        print(name, params, store.verify(name, code, params))
+    print(store.verify('grid', '000300.SH', (20, 20), source='index_daily'))
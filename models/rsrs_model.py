@@ -1,22 +1,59 @@
+import numpy as np
 import pandas as pd
-import statsmodels.api as sm
 
 from backtest import get_datasource
+from data.panel import compact_valid, expand_valid
+
+
+def _window_sum(values, n):
+    # 窗口[i-n, i)的累加和，用累计和相减得到，前n行为NaN
+    cum = np.zeros((len(values) + 1,) + values.shape[1:])
+    np.cumsum(values, axis=0, out=cum[1:])
+    result = np.full(values.shape, np.nan)
+    result[n:] = cum[n:-1] - cum[:-n - 1]
+    return result
+
+
+def rolling_ols(y, x, n):
+    # 滑动窗口一元线性回归 y = a + b * x，窗口为前n根K线（不含当根）
+    # 用滑动累加的一阶二阶矩直接求闭式解，支持一维序列或(日期×代码)二维数组
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    one_dim = y.ndim == 1
+    if one_dim:
+        y = y[:, None]
+        x = x[:, None]
+
+    valid = ~(np.isnan(x) | np.isnan(y))
+    # 先减去整列均值，降低累加和的量级，减少相减时的精度损失
+    with np.errstate(invalid='ignore'):
+        x_mean = np.nan_to_num(np.nanmean(np.where(valid, x, np.nan), axis=0))
+        y_mean = np.nan_to_num(np.nanmean(np.where(valid, y, np.nan), axis=0))
+    xc = np.where(valid, x - x_mean, 0)
+    yc = np.where(valid, y - y_mean, 0)
+
+    count = _window_sum(valid.astype(np.float64), n)
+    sx = _window_sum(xc, n)
+    sy = _window_sum(yc, n)
+    sxx = _window_sum(xc * xc, n) - sx * sx / n
+    sxy = _window_sum(xc * yc, n) - sx * sy / n
+    syy = _window_sum(yc * yc, n) - sy * sy / n
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = sxy / sxx
+        r2 = sxy * sxy / (sxx * syy)
+    # 窗口内有缺失值的不做回归
+    full = count == n
+    beta[~full] = np.nan
+    r2[~full] = np.nan
+
+    if one_dim:
+        return beta[:, 0], r2[:, 0]
+    return beta, r2
 
 
 def _calc_rsrs(highs, lows, sample_periods):
-    rsrs = [float('nan')] * sample_periods
-    r2 = list(rsrs)
-    lows = sm.add_constant(lows)
-    for i in range(sample_periods, len(highs)):
-        Y = highs[i - sample_periods:i]
-        X = lows[i - sample_periods:i]
-        cls = sm.OLS(Y, X).fit()
-        beta = cls.params[1]
-        rsrs.append(beta)
-        r2.append(cls.rsquared)
-    # assert (len(rsrs) == len(highs))
-    return rsrs, r2
+    return rolling_ols(highs, lows, sample_periods)
 
 
 class RSRS_Indicator(object):
@@ -31,7 +68,9 @@ class RSRS_Indicator(object):
         key = 'rsrs_signals'
         cache = self.data.get_cache(key)
         code_key = code if not index else f'{code}_index'
-        if not cache.has(code_key):
+        cached = cache.get(code_key)
+        # 旧版本缓存的是字符串日期索引，重新计算
+        if cached is None or cached.index.dtype.kind not in 'iu':
             if index:
                 klines = self.data.get_index_daily(code)
             else:
@@ -45,9 +84,32 @@ class RSRS_Indicator(object):
             fix_rsrs = normal_rsrs * r2
             cache.set(code_key, fix_rsrs)
         else:
-            normal_rsrs = cache.get(code_key)
+            normal_rsrs = cached
         return normal_rsrs
 
+    def get_panel_signals(self, codes, index=False):
+        # 整个面板一次算出修正后的rsrs，行是日期，列是代码
+        # 每个代码只在自己有行情的日期上滚动，和逐个代码计算的结果一致
+        source = 'index_daily' if index else 'adj_daily'
+        high_panel = self.data.load_panel('high', codes, source=source)
+        low_panel = self.data.load_panel('low', codes, source=source)
+        highs = high_panel.get(codes)
+        lows = low_panel.get(codes)
+
+        valid = ~(np.isnan(highs) | np.isnan(lows))
+        highs, order = compact_valid(highs, valid)
+        lows, _ = compact_valid(lows, valid)
+        rsrs, r2 = rolling_ols(highs, lows, self.sample_periods)
+        rsrs = expand_valid(rsrs, order, valid)
+        r2 = expand_valid(r2, order, valid)
+
+        # 标准化也只在有效日期上滚动
+        roll = pd.DataFrame(compact_valid(rsrs, valid)[0]).rolling(window=self.std_periods, min_periods=1)
+        mean = expand_valid(roll.mean().values, order, valid)
+        std = expand_valid(roll.std().values, order, valid)
+        fix_rsrs = (rsrs - mean) / std * r2
+        return pd.DataFrame(fix_rsrs, index=low_panel.dates, columns=list(codes))
+
 
 if __name__ == '__main__':
     import backtest
@@ -0,0 +1,232 @@
+import inspect
+import time
+
+import pandas as pd
+
+PHASES = ('update', 'run', 'write_record')  # 回测循环每天的三个阶段
+ACCOUNT_METHODS = ('get_bars', 'get_price', 'get_bar_view', 'order')  # 统计调用次数的账户方法
+
+
+class _Proxy(object):
+    # 包装数据库或接口对象，统计经过它的方法调用
+    def __init__(self, target, profiler, prefix):
+        self._target = target
+        self._profiler = profiler
+        self._prefix = prefix
+
+    def __getitem__(self, name):
+        # db['daily']返回集合的代理
+        return _Proxy(self._target[name], self._profiler, self._prefix)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+        profiler = self._profiler
+        prefix = self._prefix
+
+        def call(*args, **kwargs):
+            # tushare的query按接口名统计
+            key = kwargs.get('api_name', args[0] if len(args) > 0 else name) if name == 'query' else name
+            profiler.count(f'{prefix}.{key}')
+            return value(*args, **kwargs)
+
+        return call
+
+
+class Profiler(object):
+    '''
+    回测循环的分阶段计时，默认不启用，传给backtest(profiler=...)时才挂上钩子
+
+    启用时包装账户的取数和下单方法、策略和策略里模型对象的公开方法、缓存的has和get、数据库集合和tushare接口，
+    回测结束后全部还原，所以不启用时没有任何额外开销
+
+    :param trace_path: 每天一行的明细写入这个csv文件
+    '''
+
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self._days = []  # 每天的阶段耗时和计数
+        self._counts = {}  # 当天的计数
+        self._methods = {}  # 方法名到[调用次数, 累计耗时]
+        self._patched = []  # (对象, 属性名, 原来是否有实例属性, 原值)
+
+    def count(self, key, n=1):
+        self._counts[key] = self._counts.get(key, 0) + n
+
+    def _patch(self, obj, name, value):
+        had = name in vars(obj)
+        self._patched.append((obj, name, had, vars(obj).get(name)))
+        setattr(obj, name, value)
+
+    def _timed(self, key, func):
+        # 计时并计数，嵌套调用的时间是包含关系
+        methods = self._methods
+        counts = self._counts
+        methods.setdefault(key, [0, 0.0])
+
+        def call(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                item = methods[key]
+                item[0] += 1
+                item[1] += time.perf_counter() - t0
+                counts[key] = counts.get(key, 0) + 1
+
+        return call
+
+    def _wrap_methods(self, obj, prefix, names=None):
+        if names is None:
+            names = [name for name, _ in inspect.getmembers(type(obj), inspect.isfunction)
+                     if not name.startswith('_')]
+        for name in names:
+            if hasattr(obj, name):
+                self._patch(obj, name, self._timed(f'{prefix}.{name}', getattr(obj, name)))
+
+    def _wrap_cache(self, cache_name, cache):
+        if getattr(cache, '_profiled', False):
+            return
+        # 一次查找算一次：has之后紧接着get同一个key时只按has计数，直接get的按返回值是否为None计数
+        has = cache.has
+        get = cache.get
+        profiler = self
+        checked = [None]  # 最近一次has的key
+
+        def has_wrapped(key):
+            result = has(key)
+            checked[0] = key
+            profiler.count(f'cache.{cache_name}.{"hit" if result else "miss"}')
+            return result
+
+        def get_wrapped(key):
+            result = get(key)
+            if checked[0] == key:
+                checked[0] = None
+            else:
+                profiler.count(f'cache.{cache_name}.{"miss" if result is None else "hit"}')
+            return result
+
+        self._patch(cache, 'has', has_wrapped)
+        self._patch(cache, 'get', get_wrapped)
+        self._patch(cache, '_profiled', True)
+
+    def attach(self, account, strategy):
+        self._wrap_methods(account, 'account', ACCOUNT_METHODS)
+        self._wrap_methods(strategy, type(strategy).__name__)
+        # 策略里的模型对象，比如FFStrategy.ff、RSRS_Strategy._rsind
+        for name, value in list(vars(strategy).items()):
+            if type(value).__module__.startswith('models.'):
+                self._wrap_methods(value, f'{type(strategy).__name__}.{name.lstrip("_")}')
+
+        data = account.data
+        manager = getattr(data, '_cache_manager', None)
+        if manager is not None:
+            for cache_name, cache in manager._caches.items():
+                self._wrap_cache(cache_name, cache)
+            get = manager.get
+
+            def get_cache(cache_name, init_load=True):
+                cache = get(cache_name, init_load)
+                self._wrap_cache(cache_name, cache)
+                return cache
+
+            self._patch(manager, 'get', get_cache)
+
+        database = getattr(data, 'database', None)
+        if database is not None:
+            self._patch(database, 'db', _Proxy(database.db, self, 'mongo'))
+            self._patch(database, 'pro', _Proxy(database.pro, self, 'api'))
+
+    def detach(self):
+        # 倒序还原，同一个属性被包装多次时回到最初的状态
+        for obj, name, had, value in reversed(self._patched):
+            if had:
+                setattr(obj, name, value)
+            else:
+                delattr(obj, name)
+        self._patched = []
+
+    def run(self, account, strategy, dates):
+        # 带计时的回测循环，和backtest里的循环一致
+        self.attach(account, strategy)
+        try:
+            for date in dates:
+                self._counts.clear()
+                t0 = time.perf_counter()
+                account.update(date)
+                t1 = time.perf_counter()
+                strategy.run(date)
+                t2 = time.perf_counter()
+                account.write_record()
+                t3 = time.perf_counter()
+                item = {'date': date, 'update': t1 - t0, 'run': t2 - t1, 'write_record': t3 - t2, 'total': t3 - t0}
+                item.update(self._counts)
+                self._days.append(item)
+        finally:
+            self.detach()
+            if self.trace_path is not None:
+                self.days().to_csv(self.trace_path)
+
+    def days(self):
+        # 每天一行，阶段耗时和各项计数，没有发生的计数为0
+        df = pd.DataFrame(self._days)
+        if len(df) == 0:
+            return df
+        return df.set_index('date').fillna(0)
+
+    def summary(self, top=10):
+        '''
+        :param top: 最慢的天数
+        :return: 字典，phases各阶段耗时和占比，slowest最慢的几天，methods各方法的调用次数和耗时，counts各项计数合计
+        '''
+        days = self.days()
+        phases = days[list(PHASES)].sum()
+        phases = pd.DataFrame({'seconds': phases, 'share': phases / phases.sum()})
+        methods = pd.DataFrame([{'method': key, 'calls': calls, 'seconds': seconds, 'mean': seconds / max(calls, 1)}
+                                for key, (calls, seconds) in self._methods.items()])
+        if len(methods) > 0:
+            methods = methods.set_index('method').sort_values('seconds', ascending=False)
+        counts = days.drop(columns=list(PHASES) + ['total']).sum().astype(int)
+
+        # 缓存按名字汇总命中率
+        hits = {}
+        for key, n in counts.items():
+            if key.startswith('cache.'):
+                _, name, kind = key.rsplit('.', 2)
+                hits.setdefault(name, {'hit': 0, 'miss': 0})[kind] += n
+        cache = pd.DataFrame(hits).T
+        if len(cache) > 0:
+            cache['hit_rate'] = cache['hit'] / (cache['hit'] + cache['miss'])
+
+        return {
+            'days': len(days),
+            'total': days['total'].sum(),
+            'phases': phases,
+            'slowest': days.sort_values('total', ascending=False).head(top),
+            'methods': methods,
+            'cache': cache,
+            'counts': counts[[key for key in counts.index if not key.startswith('cache.')]],
+        }
+
+    def show(self, top=10):
+        result = self.summary(top)
+        print(f'{result["days"]}个交易日，循环用时{result["total"]:.3f}s')
+        for key in ('phases', 'methods', 'cache', 'counts'):
+            print(f'\n{key}:')
+            print(result[key])
+        print(f'\n最慢的{top}天:')
+        print(result['slowest'][['total'] + list(PHASES)])
+
+
+if __name__ == '__main__':
+    import backtest
+    from strategy.strategy import MOM
+
+    data = backtest.set_datasource('synthetic', n_stocks=100, start='20160101', end='20181231')
+    codes = data.get_stock_basic().index[:20].tolist()
+    profiler = Profiler()
+    backtest.backtest(MOM(codes), '20170101', '20181231', benchmark='000300.SH', save_cache=False,
+                      profiler=profiler)
+    profiler.show()
@@ -1,6 +1,7 @@
 import numpy as np
 
 from models import ff_model, rsrs_model, fv_model
+from models.indicator_store import IndicatorStore
 
 
 class StrategyBase(object):
@@ -79,7 +80,7 @@ class ResidualMomentum(FFStrategy):
         res_mean = residuals.mean(axis=1)
         res_std = residuals.std(axis=1)
         # 横截面归一化
-        residuals = (residuals - res_mean) / res_std
+        residuals = residuals.sub(res_mean, axis=0).div(res_std, axis=0)
         # 累计残差动量
         roll_sum = residuals.rolling(window=self.sum_periods, min_periods=1).sum()
         return roll_sum.iloc[-1].sort_values(ascending=self.ascending).index[:self.nums].tolist()
@@ -87,7 +88,7 @@ class ResidualMomentum(FFStrategy):
 
 def _to_buy_codes(codes_buy, account):
     codes = [code for code in codes_buy if code not in account._holdings]
-    codes = [code for code in codes if len(account.get_bars(code)) > 0]
+    codes = [code for code in codes if len(account.get_bar_view(code)) > 0]
 
     n = len(codes)
     result = []
@@ -131,27 +132,39 @@ class MOM(object):
         self._codes = codes
         self.account = account
         self.args = args
+        self._indicators = None  # 全历史指标缓存，第一次取值时按账户的数据对象创建
+
+    @property
+    def indicators(self):
+        if self._indicators is None:
+            self._indicators = IndicatorStore(self.account.data)
+        return self._indicators
+
+    def indicator(self, name, code, params=()):
+        # 当天的指标值，按行情视图的位置从全历史指标里取
+        pos = len(self.account.get_bar_view(code)) - 1
+        return self.indicators.value(name, code, pos, params, source=self.account._price_source)
 
     def buy_signal(self, code):
-        bars = self.account.get_bars(code)
+        bars = self.account.get_bar_view(code)
         n = self.args[0]
-        c = bars['close']
-        c_roll = c.rolling(window=n)
+        if len(bars) < n:
+            return False
         # 最近N天最高价
-        n_max = c_roll.max()
+        n_max = self.indicator('hhv', code, (n,))
         # 当前价格创N天新高，区间上移
-        zone = n_max.values[-1] <= c.values[-1]
+        zone = n_max <= bars.last()
         return zone
 
     def sell_signal(self, code):
-        bars = self.account.get_bars(code)
+        bars = self.account.get_bar_view(code)
         n = self.args[1]
-        c = bars['close']
-        c_roll = c.rolling(window=n)
+        if len(bars) < n:
+            return False
         # 最近N天最低价
-        n_min = c_roll.min()
+        n_min = self.indicator('llv', code, (n,))
         # 当前价格创N天新低，区间下移
-        zone = n_min.values[-1] >= c.values[-1]
+        zone = n_min >= bars.last()
         return zone
 
     def run(self, date):
@@ -163,7 +176,7 @@ class MOM(object):
 
     def do_buy(self):
         codes = [code for code in self._codes if code not in self.account._holdings]
-        codes = [code for code in codes if len(self.account.get_bars(code)) > 0]
+        codes = [code for code in codes if len(self.account.get_bar_view(code)) > 0]
 
         n = len(codes)
         if n > 0:
@@ -198,13 +211,8 @@ class RSRS_Strategy(MOM):
         return rsrs
 
     def get_grid(self, code):
-        from indicators import calc_fma, calc_atr
-        date = self.account._date
-        klines = self.account.get_bars(code)
-        fma = calc_fma(klines['close'], 20)
-        atr = calc_atr(klines, 20)
-        grid = (klines['close'] - fma) / atr
-        return grid
+        # 当天收盘价偏离fma的atr倍数
+        return self.indicator('grid', code, (20, 20))
 
     def buy_signal(self, code):
         rsrs = self.get_rsrs_value(code)
@@ -216,12 +224,10 @@ class RSRS_Strategy(MOM):
         return rsrs < -1 and self.sell_filter(code)
 
     def buy_filter(self, code):
-        grid = self.get_grid(code)
-        return grid.values[-1] > 1
+        return self.get_grid(code) > 1
 
     def sell_filter(self, code):
-        grid = self.get_grid(code)
-        return grid.values[-1] < -1
+        return self.get_grid(code) < -1
 
 
 class FVStrategy(StrategyBase):
@@ -234,10 +240,17 @@ class FVStrategy(StrategyBase):
         self.count = 0
         self.codes = []
         self._rsind = rsrs_model.RSRS_Indicator()
+        self._indicators = None  # 全历史指标缓存，第一次取值时按账户的数据对象创建
         self.benchmark = '399300.SZ'
         self.rsrs_signal = False
         self.empty = False
 
+    @property
+    def indicators(self):
+        if self._indicators is None:
+            self._indicators = IndicatorStore(self.account.data)
+        return self._indicators
+
     def run(self, date):
         if self.count % self.freq == 0:
             values = self.model.get_values(date)
@@ -282,13 +295,8 @@ class FVStrategy(StrategyBase):
         return rsrs
 
     def get_grid(self, index_code):
-        from indicators import calc_fma, calc_atr
-        date = self.account._date
-        klines = self.account.data.get_index_daily(index_code).loc[:date]
-        fma = calc_fma(klines['close'], 20)
-        atr = calc_atr(klines, 20)
-        grid = (klines['close'] - fma) / atr
-        return grid
+        # 指数当天收盘价偏离fma的atr倍数
+        return self.indicators.value_at('grid', index_code, self.account._date, (20, 20), source='index_daily')
 
     def buy_signal(self, index_code):
         rsrs = self.get_rsrs_value(index_code)
@@ -300,12 +308,10 @@ class FVStrategy(StrategyBase):
         return rsrs < -1 and self.sell_filter(index_code)
 
     def buy_filter(self, index_code):
-        grid = self.get_grid(index_code)
-        return grid.values[-1] > 1
+        return self.get_grid(index_code) > 1
 
     def sell_filter(self, index_code):
-        grid = self.get_grid(index_code)
-        return grid.values[-1] < -1
+        return self.get_grid(index_code) < -1
 
 
 
@@ -0,0 +1,117 @@
+import inspect
+import itertools
+import multiprocessing
+import os
+
+import pandas as pd
+
+import backtest
+
+# 默认在分发任务前加载的缓存，fork出来的子进程直接共享这些内存，不再各自反序列化
+# 只包含每个回测都用的小表，行情、财务等按代码的大缓存由调用方按需要传入
+DEFAULT_PRELOAD = ('trade_cal', 'stock_basic', 'index_members')
+
+_task = {}  # 子进程里的任务描述
+
+
+def param_grid(grid):
+    # {'nums': [10, 20], 'freq': [20, 60]} 展开成参数字典的列表
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def _split_params(strategy_cls, params):
+    # 构造函数接受的参数传给构造函数，其余的在构造之后设置为属性，比如FVStrategy.top_rank
+    names = inspect.signature(strategy_cls.__init__).parameters
+    init_params = {k: v for k, v in params.items() if k in names}
+    attrs = {k: v for k, v in params.items() if k not in names}
+    return init_params, attrs
+
+
+def _init_worker(task):
+    _task.update(task)
+
+
+def _run_one(i):
+    params = _task['combos'][i]
+    init_params, attrs = _split_params(_task['strategy_cls'], params)
+    kwargs = dict(_task['kwargs'])
+    kwargs.update(init_params)
+    try:
+        strategy = _task['strategy_cls'](*_task['args'], **kwargs)
+        for key, value in attrs.items():
+            setattr(strategy, key, value)
+        # 子进程不写缓存文件，避免多个进程同时覆盖
+        report = backtest.backtest(strategy, _task['start'], _task['end'], _task['benchmark'], save_cache=False)
+        return i, report._summary, report._records['净值'], None
+    except Exception as e:
+        return i, None, None, f'{type(e).__name__}: {e}'
+
+
+def sweep(strategy_cls, grid, start, end, benchmark='399300.SZ', args=(), kwargs=None, processes=None,
+          preload=DEFAULT_PRELOAD, verbose=False):
+    '''
+    用进程池并行跑参数网格的回测
+
+    :param type strategy_cls: 策略类
+    :param dict|list grid: 参数网格，字典会展开成笛卡尔积，也可以直接传参数字典的列表
+    :param tuple args: 每个策略共用的位置参数，比如MOM的codes
+    :param dict kwargs: 每个策略共用的关键字参数，比如FFStrategy的index_code
+    :param int processes: 进程数，默认使用全部核心
+    :param tuple|dict preload: 分发任务前在主进程读进内存的缓存。缓存名的元组读入整个缓存；
+        字典{缓存名: key列表}只读入列出的key，比如{'adj_daily': codes}，key列表为None时读入整个缓存
+    :param bool verbose: 是否打印每个参数组合的完成进度
+    :return: (汇总表, 净值曲线表)
+    '''
+    combos = param_grid(grid) if isinstance(grid, dict) else list(grid)
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    # 支持fork的平台上，子进程继承主进程已经加载的缓存；spawn平台上每个子进程会各自加载
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context('spawn')
+
+    data = backtest.get_datasource()
+    if not isinstance(preload, dict):
+        preload = dict.fromkeys(preload)
+    for name, keys in preload.items():
+        cache = data.get_cache(name)
+        # 分片缓存只加载了索引，这里把要用的分片读进来
+        if hasattr(cache, 'preload'):
+            cache.preload(keys)
+
+    task = {'strategy_cls': strategy_cls, 'args': tuple(args), 'kwargs': dict(kwargs or {}), 'start': start,
+            'end': end, 'benchmark': benchmark, 'combos': combos}
+    results = [None] * len(combos)
+    with context.Pool(processes=min(processes, max(len(combos), 1)), initializer=_init_worker,
+                      initargs=(task,)) as pool:
+        for i, summary, values, error in pool.imap_unordered(_run_one, range(len(combos))):
+            results[i] = (summary, values, error)
+            if verbose:
+                print(f'sweep {i + 1}/{len(combos)} {combos[i]} {"done" if error is None else error}')
+
+    items = []
+    curves = {}
+    for params, (summary, values, error) in zip(combos, results):
+        title = ','.join(f'{k}={v}' for k, v in params.items())
+        item = {'title': title}
+        item.update(params)
+        if summary is not None:
+            item.update(summary)
+            curves[title] = values
+        item['error'] = error
+        items.append(item)
+
+    summary = pd.DataFrame(items).set_index('title')
+    curves = pd.DataFrame(curves)
+    return summary, curves
+
+
+if __name__ == '__main__':
+    from strategy.strategy import FFStrategy
+
+    summary, curves = sweep(FFStrategy, {'nums': [5, 10, 20], 'freq': [20, 60]}, start='20160101', end='20181231',
+                            kwargs={'index_code': '399300.SZ'}, verbose=True)
+    print(summary)
@@ -0,0 +1,44 @@
+'''
+报表时点表：字段类型和按时点查询
+'''
+import numpy as np
+import pandas as pd
+
+from data.fins_store import FinsTable
+
+
+def _table():
+    return FinsTable(pd.DataFrame({
+        'ts_code': ['000001.SZ', '000001.SZ', '000001.SZ', '600000.SH'],
+        'ann_date': ['20180420', '20180820', '20180901', '20180425'],
+        'f_ann_date': ['20180420', '20180820', '20180901', '20180425'],
+        'end_date': ['20180331', '20180630', '20180630', '20180331'],
+        'report_type': ['1', '1', '1', '1'],
+        'update_flag': ['1', '0', '1', '0'],
+        'div_proc': ['实施', '预案', '实施', '预案'],
+        'revenue': ['100.5', None, '210', '80'],
+    }))
+
+
+def test_column_types():
+    table = _table()
+    assert table.columns['revenue'].dtype == np.float64
+    assert np.isnan(table.columns['revenue']).sum() == 1
+    # 标志字段保持字符串，日期字段转成整数
+    assert table.columns['update_flag'].dtype == object
+    assert table.columns['report_type'].dtype == object
+    assert table.columns['f_ann_date'].dtype.kind == 'i'
+
+
+def test_where_string_value():
+    table = _table()
+    codes = ['000001.SZ', '600000.SH']
+    df = table.latest(codes, '20181231', n=4, where={'update_flag': '1'})
+    assert df[['ts_code', 'ann_date']].values.tolist() == [['000001.SZ', 20180420], ['000001.SZ', 20180901]]
+
+    # 更正之前只有未更正的那一版
+    df = table.latest(codes, '20180825', where={'update_flag': '0'})
+    assert df[['ts_code', 'end_date']].values.tolist() == [['000001.SZ', 20180630], ['600000.SH', 20180331]]
+
+    df = table.latest(codes, '20181231', n=4, where={'div_proc': '实施'}, fields=['revenue'])
+    assert df['revenue'].tolist() == [100.5, 210.0]
@@ -0,0 +1,71 @@
+'''
+分片缓存：分片丢失或损坏时当作没有缓存，从数据库重新读取
+'''
+import os
+
+import pytest
+
+from data.cache_data import CacheData
+from data.pickle_cache import CacheManager, ShardedCache
+from data.synthetic import make_datasource
+
+
+@pytest.fixture()
+def data(tmp_path):
+    return make_datasource(n_stocks=10, start='20180101', end='20181231', cache_dir=str(tmp_path))
+
+
+def _damage(cache_dir, key, code, corrupt):
+    cache = ShardedCache(os.path.join(cache_dir, key + '.shards'))
+    cache.load()
+    path = cache._shard_path(cache._files[code])
+    if corrupt:
+        with open(path, mode='wb') as fp:
+            fp.write(b'not a pickle')
+    else:
+        os.remove(path)
+
+
+@pytest.mark.parametrize('corrupt', [False, True])
+def test_frame_reloads_bad_shard(data, tmp_path, corrupt):
+    code = data.get_stock_basic().index[0]
+    expected = data.get_daily_basic(code)
+    data.save_cache()
+    _damage(str(tmp_path), 'daily_basic', code, corrupt)
+
+    fresh = CacheData(database=data.database, cache_manager=CacheManager(str(tmp_path), sharded=True))
+    df = fresh.get_daily_basic(code)
+    assert df is not None and df.equals(expected)
+    assert fresh.get_cache('daily_basic').has(code)
+
+
+def test_default_cache_reloads_bad_shard(tmp_path):
+    path = str(tmp_path / 'values.shards')
+    cache = ShardedCache(path)
+    cache.load()
+    cache.set('a', [1, 2])
+    cache.set('none', None)
+    cache.save()
+    os.remove(cache._shard_path(cache._files['a']))
+
+    cache = ShardedCache(path)
+    cache.load()
+    assert cache.get_default_cache('a', lambda: [3]) == [3]
+    # 缓存的None是命中，不重新计算
+    assert cache.get_default_cache('none', lambda: 'computed') is None
+
+
+def test_legacy_frames_upgraded_per_key(data, tmp_path):
+    # 旧版本写入的表：字符串日期、带ts_code、float64，用到的代码才转换
+    codes = data.get_stock_basic().index[:3].tolist()
+    manager = CacheManager(str(tmp_path / 'legacy'), sharded=True)
+    cache = manager.get('daily_basic')
+    for code in codes:
+        cache.set(code, data.database.get_daily_basic(code))
+    manager.save_all()
+
+    fresh = CacheData(database=data.database, cache_manager=CacheManager(str(tmp_path / 'legacy'), sharded=True))
+    df = fresh.get_daily_basic(codes[0])
+    assert df.index.dtype.kind == 'i' and 'ts_code' not in df.columns
+    assert list(fresh.get_cache('daily_basic').cache_dict.keys()) == [codes[0]]
+    assert fresh.get_daily_basic(codes[0]) is df
@@ -0,0 +1,144 @@
+'''
+按交易日历补数据：规划的任务、横截面和区间的拆分、空缺的记录
+'''
+import numpy as np
+import pytest
+
+from data.repair import GAPS_COLL, RepairPlanner
+from data.synthetic import FakePro, make_database, make_market
+from data.ts_db import TsDatabase
+
+TABLES = ['trade_cal', 'stock_basic', 'daily', 'adj_factor', 'index_daily']
+
+
+@pytest.fixture(scope='module')
+def market():
+    return make_market(n_stocks=60, start='20170101', end='20181231', seed=0)
+
+
+def _open_dates(market):
+    cal = market['trade_cal']
+    return np.sort(cal['cal_date'].values[cal['is_open'].values == 1].astype(str))
+
+
+def _database(market, pro_market=None, **frames):
+    # frames替换数据库里的表，pro_market是接口能返回的数据，默认完整的行情
+    stored = dict(market, **frames)
+    return TsDatabase(db=make_database(stored, TABLES), pro=FakePro(pro_market or market))
+
+
+def _run(planner, tasks):
+    pro = planner.database.pro
+    for task in tasks:
+        planner.write(task, pro.query(task.api_name, **task.params))
+
+
+def _suspended(market):
+    # 有复权因子但没有行情的(代码, 日期)，就是停牌日
+    daily = set(zip(market['daily']['ts_code'], market['daily']['trade_date']))
+    adj = market['adj_factor']
+    return {(code, date) for code, date in zip(adj['ts_code'], adj['trade_date']) if (code, date) not in daily}
+
+
+def test_plans_new_trading_day(market):
+    last = _open_dates(market)[-1]
+    daily = market['daily'][market['daily']['trade_date'] < last]
+    index_daily = market['index_daily'][market['index_daily']['trade_date'] < last]
+    database = _database(market, daily=daily, index_daily=index_daily)
+
+    # 数据库落后一天，最后一个交易日用横截面请求补上
+    tasks = RepairPlanner(database, today='20190110').plan('daily')
+    assert {'trade_date': last} in [task.params for task in tasks]
+
+    # 指数接口必须传ts_code，即使每个指数都缺同一天也按代码请求
+    tasks = RepairPlanner(database, cross_threshold=1, today='20190110').plan('index_daily')
+    assert all('ts_code' in task.params for task in tasks)
+    assert sorted(task.params['ts_code'] for task in tasks if task.params['end_date'] == last) == \
+        sorted(index_daily['ts_code'].unique())
+
+    # 今天之后的交易日不请求
+    tasks = RepairPlanner(database, today='20181227').plan('index_daily')
+    assert all(task.params['end_date'] <= '20181227' for task in tasks)
+
+
+def test_fills_interior_gaps(market):
+    daily = market['daily']
+    code = daily['ts_code'].iloc[0]
+    dates = daily.loc[daily['ts_code'] == code, 'trade_date'].values
+    dropped = set(dates[[100, 101, 102, 250]])
+    keep = ~((daily['ts_code'] == code) & daily['trade_date'].isin(dropped))
+    database = _database(market, daily=daily[keep])
+
+    planner = RepairPlanner(database, today='20190110')
+    tasks = planner.plan('daily')
+    planned = {item for task in tasks for item in task.missing}
+    assert {(code, date) for date in dropped} <= planned
+    # 连续的缺口合并成一次区间请求
+    assert len([task for task in tasks if task.params.get('ts_code') == code]) == 1
+
+    _run(planner, tasks)
+    stored = database.db['daily'].select({'ts_code': code}, {'_id': 0})
+    assert set(stored['trade_date']) == set(dates)
+
+
+def test_records_suspended_days_once(market):
+    database = _database(market)
+    planner = RepairPlanner(database, today='20190110')
+    missing = {(code, date) for code, dates in planner.missing_dates('daily').items() for date in dates}
+    assert missing == _suspended(market)
+
+    _run(planner, planner.plan('daily'))
+    gaps = database.db[GAPS_COLL].select({'api_name': 'daily'}, {'_id': 0})
+    before = planner.gap_before()
+    assert set(zip(gaps['ts_code'], gaps['trade_date'])) == {item for item in missing if item[1] < before}
+
+    # 确认过的停牌日不再请求，最近几天的还会再查
+    replanned = {item for task in RepairPlanner(database, today='20190110').plan('daily') for item in task.missing}
+    assert replanned == {item for item in missing if item[1] >= before}
+
+
+def test_unpublished_day_not_recorded(market):
+    last = _open_dates(market)[-1]
+    early = {name: df[df['trade_date'] < last] if name == 'daily' else df for name, df in market.items()}
+    database = _database(market, pro_market=early, daily=early['daily'])
+
+    # 接口还没有发布最后一天，没有返回的不记为空缺
+    planner = RepairPlanner(database, today='20190110')
+    _run(planner, planner.plan('daily'))
+    assert database.db[GAPS_COLL].count_documents({'trade_date': last}) == 0
+
+    # 发布之后再补上
+    database.pro = FakePro(market)
+    planner = RepairPlanner(database, today='20190110')
+    _run(planner, planner.plan('daily'))
+    assert database.db['daily'].count_documents({'trade_date': last}) == \
+        (market['daily']['trade_date'] == last).sum()
+
+
+def test_truncated_response_not_recorded(market):
+    database = _database(market)
+    planner = RepairPlanner(database, max_rows=10, today='20190110')
+    task = planner.plan('daily')[0]
+    code, date = task.missing[0]
+    # 返回行数到了上限，可能被截断，不能确认空缺
+    df = market['daily'][market['daily']['trade_date'] == '20170103'].head(10)
+    planner.write(task, df)
+    assert database.db[GAPS_COLL].count_documents({}) == 0
+
+
+def test_splits_ranges_by_row_limit():
+    market = make_market(n_stocks=3, start='20020101', end='20191231', seed=0)
+    cal = _open_dates(market)
+    code = '600000.SH'
+    daily = market['daily'][market['daily']['ts_code'] != code]
+    database = _database(market, daily=daily)
+
+    tasks = [task for task in RepairPlanner(database, today='20200110').plan('daily')
+             if task.params.get('ts_code') == code]
+    assert len(cal[cal >= market['stock_basic'].set_index('ts_code').at[code, 'list_date']]) > 4000
+    assert len(tasks) == 2
+    for task in tasks:
+        span = np.searchsorted(cal, task.params['end_date']) - np.searchsorted(cal, task.params['start_date']) + 1
+        assert span <= 4000
+    assert tasks[0].params['end_date'] < tasks[1].params['start_date']
+    assert tasks[-1].params['end_date'] == cal[-1]
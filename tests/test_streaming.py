@@ -0,0 +1,90 @@
+'''
+增量指标和indicators里的批量函数逐根对照，缺失值的位置也要一致
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+import indicators
+from indicators import streaming
+from indicators.streaming import ATR, EMA, HHV, LLV, MA, RSI, SMA, ExpandingZScore, RollingZScore, Valuation, WeightMA
+
+# 每个增量指标类对应的对照用例
+COVERAGE = {
+    'MA': ['ma'],
+    'EMA': ['ema'],
+    'SMA': ['sma'],
+    'HHV': ['hhv'],
+    'LLV': ['llv'],
+    'ATR': ['calc_atr'],
+    'RSI': ['calc_rsi'],
+    'RollingZScore': ['rolling_zscore'],
+    'ExpandingZScore': ['expanding_zscore'],
+    'WeightMA': ['weight_ma', 'weight_ma_expanding'],
+    'Valuation': ['calc_valuation.mid', 'calc_valuation.top', 'calc_valuation.bot'],
+}
+SEEDS = (0, 1, 2)
+_cases = {}
+
+
+def _stream(indicator, *columns):
+    # 把整段序列逐根喂给增量指标，返回每一根的值
+    return [indicator.update(*row) for row in zip(*columns)]
+
+
+def _make_cases(n, seed):
+    # 在掺入缺失值的随机行情上分别用批量函数和增量指标计算，返回指标名到(批量结果, 逐根结果)
+    rng = np.random.default_rng(seed)
+    close = pd.Series(10 * np.exp(np.cumsum(rng.normal(0, 0.02, n))))
+    close[rng.choice(n, n // 50, replace=False)] = np.nan
+    high = close * (1 + rng.uniform(0, 0.03, n))
+    low = close * (1 - rng.uniform(0, 0.03, n))
+    kline = pd.DataFrame({'high': high, 'low': low, 'close': close})
+    weight = pd.Series(rng.uniform(1, 100, n))
+
+    cases = {
+        'ma': (indicators.ma(close, 20), _stream(MA(20), close)),
+        'ema': (indicators.ema(close, 12), _stream(EMA(12), close)),
+        'sma': (indicators.sma(close, 9, 2), _stream(SMA(9, 2), close)),
+        'hhv': (indicators.hhv(close, 20), _stream(HHV(20), close)),
+        'llv': (indicators.llv(close, 20), _stream(LLV(20), close)),
+        'calc_atr': (indicators.calc_atr(kline, 14), _stream(ATR(14), high, low, close)),
+        'calc_rsi': (indicators.calc_rsi(close, 14), _stream(RSI(14), close)),
+        'rolling_zscore': (indicators.rolling_zscore(close, 60), _stream(RollingZScore(60), close)),
+        'expanding_zscore': (indicators.expanding_zscore(close), _stream(ExpandingZScore(), close)),
+        'weight_ma': (indicators.weight_ma(weight, close, 30), _stream(WeightMA(30), weight, close)),
+        'weight_ma_expanding': (indicators.weight_ma(weight, close), _stream(WeightMA(), weight, close)),
+    }
+    # calc_valuation只比较预热期之后的部分
+    mid, top, bot = indicators.calc_valuation(close, min_periods=120)
+    values = np.array(_stream(Valuation(120), close))
+    warm = close.notna().cumsum().values >= 120
+    for name, batch, column in [('calc_valuation.mid', mid, 0), ('calc_valuation.top', top, 1),
+                                ('calc_valuation.bot', bot, 2)]:
+        cases[name] = (batch[warm], values[warm, column])
+    return {name: (np.asarray(batch, dtype=np.float64), np.asarray(streamed, dtype=np.float64))
+            for name, (batch, streamed) in cases.items()}
+
+
+def _case(seed, name):
+    if seed not in _cases:
+        _cases[seed] = _make_cases(n=1000, seed=seed)
+    return _cases[seed][name]
+
+
+def test_every_indicator_covered():
+    # EWM是EMA和SMA的基类，不单独对照
+    classes = {name for name, value in vars(streaming).items()
+               if isinstance(value, type) and hasattr(value, 'update') and not name.startswith('_')}
+    assert classes - {'EWM'} == set(COVERAGE)
+    assert set(_make_cases(n=200, seed=0)) == {name for names in COVERAGE.values() for name in names}
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('name', [name for names in COVERAGE.values() for name in names])
+def test_matches_batch(name, seed):
+    batch, streamed = _case(seed, name)
+    assert batch.shape == streamed.shape
+    np.testing.assert_array_equal(np.isnan(streamed), np.isnan(batch))
+    assert (~np.isnan(batch)).any()
+    np.testing.assert_allclose(streamed, batch, rtol=1e-8, atol=1e-10, equal_nan=True)